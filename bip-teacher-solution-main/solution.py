@@ -43,10 +43,12 @@ class BipTeacherSolution:
         self.hoist_event = Event()
         self.move_event = Event()
         self.G6_event = Event()
+        self.plan_event = Event()
         self.G4_answer = None
         self.aruco_answer = None
         self.hoist_answer = None
         self.move_answer = None
+        self.plan_answer = None
 
         # placeholder containers and loading order.
         self.loadingorder = [1, 2, 3, 4, 5, 6, 7, 8, 9]
@@ -105,6 +107,11 @@ class BipTeacherSolution:
                 self.move_event.set()
             elif command_action == "G6":
                 self.G6_event.set()
+            elif command_action == "plan-progress":
+                print(f"Finished step {received_response['step']}: {received_response['action']}")
+            elif command_action == "plan":
+                self.plan_answer = received_response
+                self.plan_event.set()
             else:
                 self.response_event.set()
         except Exception as e:
@@ -223,6 +230,42 @@ class BipTeacherSolution:
         self.G6_event.wait()
         self.G6_event.clear()
 
+    def executePlan(self, steps):
+        """
+        Executes a list of crane steps (hoist, move, magnet, wait) in a
+        single request, rather than one request per step.
+        """
+        request_topic = f"command/bip-server/{self.id}/req/{self.response_id}/plan"
+        payload = {
+            "steps": steps,
+        }
+        self.client.publish(request_topic, json.dumps(payload), qos=2)
+        print(f"Published request to topic: {request_topic}")
+        print("Waiting for crane response...")
+        self.plan_event.wait()
+        self.plan_event.clear()
+        if "error" in self.plan_answer:
+            raise RuntimeError(self.plan_answer["error"])
+        return self.plan_answer["results"]
+
+    def loadContainerPlan(self, container_position):
+        """
+        Returns the plan that picks up a container at the pickup
+        position and puts it down on the ship.
+        """
+        return [
+            {"action": "hoist", "height": MOVE_HEIGHT},
+            {"action": "move", "position": PICKUP_POSITION},
+            {"action": "hoist", "height": PICKUP_HEIGHT},
+            {"action": "magnet", "on/off": 1},
+            {"action": "wait", "seconds": 1},
+            {"action": "hoist", "height": MOVE_HEIGHT},
+            {"action": "move", "position": SHIP_POSITIONS[container_position[0]]},
+            {"action": "hoist", "height": SHIP_HEIGHT + CONTAINER_HEIGHT*(container_position[1]+1)},
+            {"action": "magnet", "on/off": 0},
+            {"action": "hoist", "height": MOVE_HEIGHT},
+        ]
+
     def updateShipSimulation(self, container_id, pos):
         request_topic = f"control/ship/{self.id}/containers/incoming"
         payload ={
@@ -252,6 +295,7 @@ class BipTeacherSolution:
         self.hoist_event.clear()
         self.move_event.clear()
         self.G6_event.clear()
+        self.plan_event.clear()
         
 if __name__ == "__main__":
     sol = BipTeacherSolution()
@@ -275,16 +319,8 @@ if __name__ == "__main__":
             print(f"Loading position is{sol.container_positions[scanned_id]}")
             #sol.acceptContainer()
             container_position = sol.container_positions[scanned_id-1]
-            sol.hoistCrane(MOVE_HEIGHT)
-            sol.moveCrane(PICKUP_POSITION)
-            sol.hoistCrane(PICKUP_HEIGHT)
-            sol.electromagnet(True)
-            sleep(1)
-            sol.hoistCrane(MOVE_HEIGHT)
-            sol.moveCrane(SHIP_POSITIONS[container_position[0]])
-            sol.hoistCrane(SHIP_HEIGHT + CONTAINER_HEIGHT*(container_position[1]+1))
-            sol.electromagnet(False)
-            sol.hoistCrane(MOVE_HEIGHT)
+            # the whole crane cycle is executed as one plan
+            sol.executePlan(sol.loadContainerPlan(container_position))
             # container should now have been placed down in on the ship,
             # this means we should notify the simulation
             # sol.updateShipSimulation(scanned_id, container_position)
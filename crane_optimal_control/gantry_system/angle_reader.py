@@ -0,0 +1,357 @@
+# reader for the pendulum angle sensor (Arduino) on angleUARTPort
+# the Arduino sends either ASCII lines "a theta omega\r\n" at 115200 baud,
+# or binary frames with a device timestamp, see BinaryAngleParser.
+
+import re
+import struct
+import time
+from collections import deque
+import numpy as np
+from .sampling import RingBuffer
+
+
+class AngleLineParser:
+    """
+    Incremental parser for the ASCII angle stream. Bytes are fed as they
+    arrive, complete lines are parsed and appended as (t, a, theta,
+    omega) to a RingBuffer. Only the unfinished last line is kept
+    between calls, and it is bounded to max_line bytes, so the work per
+    received byte is constant and memory does not grow.
+
+    Counters:
+    lines : number of correctly parsed lines
+    garbled : number of complete lines that could not be parsed
+    dropped : number of lines discarded because they were too long
+    """
+
+    pattern = re.compile(rb"(-?\d*\.\d*) (-?\d*\.\d*) (-?\d*\.\d*)\r?")
+
+    def __init__(self, samples, max_line = 64) -> None:
+        """
+        Parameters
+        ----------
+        samples : RingBuffer
+            buffer with columns t, a, theta, omega
+        max_line : int
+            longest line that is accepted [bytes]
+        """
+        self.samples = samples
+        self.max_line = max_line
+        self.partial = bytearray()
+        self.skipping = False # discarding the rest of a too long line
+        self.lines = 0
+        self.garbled = 0
+        self.dropped = 0
+
+    def reset(self):
+        """
+        forgets the unfinished line, e.g. after flushing the port
+        """
+        self.partial.clear()
+        self.skipping = False
+
+    def feed(self, data, t):
+        """
+        parses the received bytes
+
+        Parameters
+        ----------
+        data : bytes
+            newly received bytes
+        t : float
+            host time at which the bytes were received
+
+        Returns
+        -------
+        number of samples added
+        """
+        added = 0
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                if not self.skipping:
+                    if len(self.partial) + len(data) - start > self.max_line:
+                        self.dropped += 1
+                        self.partial.clear()
+                        self.skipping = True
+                    else:
+                        self.partial += data[start:]
+                return added
+            if self.skipping:
+                self.skipping = False
+            else:
+                self.partial += data[start:end]
+                if self._parseLine(bytes(self.partial), t):
+                    added += 1
+            self.partial.clear()
+            start = end + 1
+
+    def _parseLine(self, line, t):
+        if len(line) > self.max_line:
+            self.dropped += 1
+            return False
+        match = self.pattern.fullmatch(line)
+        if match is None:
+            self.garbled += 1
+            return False
+        try:
+            a, theta, omega = (float(value) for value in match.groups())
+        except ValueError:
+            # e.g. a lone "." or "-."
+            self.garbled += 1
+            return False
+        self.samples.append((t, a, theta, omega))
+        self.lines += 1
+        return True
+
+
+def crc8(data):
+    """
+    CRC-8 (polynomial 0x07, initial value 0) of data
+    """
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+def _crc8Table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+_CRC8_TABLE = _crc8Table()
+
+
+class ClockSync:
+    """
+    Estimates the relation between the clock of the angle sensor and the
+    host clock, host = device + offset + drift*(device - device0), with
+    device0 the first device time seen.
+
+    Every received sample gives an observation host receive time - device
+    time, which is the true offset plus a positive, varying transport
+    delay. Per segment of segment_length seconds only the smallest
+    observation is kept (the sample with the least delay), and a line is
+    fitted through the minima of the last window segments. That tracks
+    both the offset and the drift between the two crystals.
+    """
+
+    def __init__(self, segment_length = 1.0, window = 30) -> None:
+        self.segment_length = segment_length
+        self.minima = deque(maxlen=window) # (segment, device time, offset)
+        self.device0 = None
+        self.offset = None
+        self.drift = 0.0
+        self._dirty = False
+
+    def update(self, device_time, host_time):
+        """
+        adds an observation, times in seconds
+        """
+        if self.device0 is None:
+            self.device0 = device_time
+        observed = host_time - device_time
+        device_time -= self.device0
+        segment = int(device_time // self.segment_length)
+        if self.minima and self.minima[-1][0] == segment:
+            if observed < self.minima[-1][2]:
+                self.minima[-1] = (segment, device_time, observed)
+                # refit only while the running segment is used in the
+                # fit, otherwise when a segment is complete
+                self._dirty = self._dirty or len(self.minima) <= 2
+        else:
+            self.minima.append((segment, device_time, observed))
+            self._dirty = True
+
+    def _fit(self):
+        points = np.array([(d, o) for _, d, o in self.minima])
+        if len(points) > 2:
+            # the minimum of the running segment is not final yet
+            points = points[:-1]
+        if len(points) < 2:
+            self.drift, self.offset = 0.0, points[0, 1]
+        else:
+            self.drift, self.offset = np.polyfit(points[:, 0], points[:, 1], 1)
+        self._dirty = False
+
+    def toHost(self, device_time):
+        """
+        converts a device time to host time [s]
+        """
+        if self._dirty:
+            self._fit()
+        return device_time + self.offset + self.drift*(device_time - self.device0)
+
+
+class BinaryAngleParser:
+    """
+    Incremental parser for the binary angle protocol. Every sample is a
+    frame of 19 bytes:
+
+        0xA5 0x5A | uint32 device time [us] | float32 a | float32 theta
+        | float32 omega | uint8 CRC-8 of the 16 bytes in between
+
+    little endian. Samples are timestamped with the device time,
+    converted to host time with a ClockSync, and appended as (t, a,
+    theta, omega) to a RingBuffer. On a bad checksum the parser
+    resynchronizes on the next sync bytes.
+
+    Counters:
+    lines : number of valid frames
+    garbled : number of frames with a bad checksum
+    dropped : number of bytes skipped while searching for a frame
+    """
+
+    SYNC = b"\xa5\x5a"
+    FRAME = struct.Struct("<Ifff")
+    FRAME_LENGTH = 2 + FRAME.size + 1
+
+    def __init__(self, samples, clock_sync = None) -> None:
+        self.samples = samples
+        self.clock_sync = ClockSync() if clock_sync is None else clock_sync
+        self.buffer = bytearray()
+        self.lines = 0
+        self.garbled = 0
+        self.dropped = 0
+        # the device time is a 32 bit microsecond counter, it wraps
+        self._last_us = None
+        self._wraps = 0
+
+    def reset(self):
+        self.buffer.clear()
+
+    def _deviceTime(self, us):
+        if self._last_us is not None and us < self._last_us:
+            self._wraps += 1
+        self._last_us = us
+        return (us + self._wraps*2**32)*1e-6
+
+    def feed(self, data, t):
+        """
+        parses the received bytes
+
+        Parameters
+        ----------
+        data : bytes
+            newly received bytes
+        t : float
+            host time at which the bytes were received
+
+        Returns
+        -------
+        number of samples added
+        """
+        self.buffer += data
+        added = 0
+        pos = 0
+        n = len(self.buffer)
+        while n - pos >= self.FRAME_LENGTH:
+            start = self.buffer.find(self.SYNC, pos)
+            if start < 0:
+                # keep a possible first sync byte at the end
+                self.dropped += n - 1 - pos
+                pos = n - 1
+                break
+            self.dropped += start - pos
+            pos = start
+            if n - pos < self.FRAME_LENGTH:
+                break
+            payload = bytes(self.buffer[pos + 2:pos + 2 + self.FRAME.size])
+            if crc8(payload) != self.buffer[pos + self.FRAME_LENGTH - 1]:
+                self.garbled += 1
+                pos += 1
+                continue
+            us, a, theta, omega = self.FRAME.unpack(payload)
+            device_time = self._deviceTime(us)
+            self.clock_sync.update(device_time, t)
+            self.samples.append((self.clock_sync.toHost(device_time), a, theta, omega))
+            self.lines += 1
+            added += 1
+            pos += self.FRAME_LENGTH
+        del self.buffer[:pos]
+        return added
+
+
+class AngleReader:
+    """
+    Reads the angle sensor on a serial port into a timestamped ring
+    buffer of (t, a, theta, omega) samples. Values are stored as the
+    sensor sends them, without scaling or sign changes.
+    """
+
+    def __init__(self, serial_port, protocol = "ascii", capacity = 30000, clock = time.perf_counter) -> None:
+        """
+        Parameters
+        ----------
+        serial_port : serial.Serial
+            opened port of the angle sensor
+        protocol : String
+            "ascii" for text lines, timestamped on arrival, "binary"
+            for frames with a device timestamp
+        capacity : int
+            number of samples kept
+        clock : callable
+            host clock used to timestamp the samples
+        """
+        self.serial = serial_port
+        self.protocol = protocol
+        self.clock = clock
+        self.samples = RingBuffer(capacity, ["t", "a", "theta", "omega"])
+        if protocol == "ascii":
+            self.parser = AngleLineParser(self.samples)
+        elif protocol == "binary":
+            self.parser = BinaryAngleParser(self.samples)
+        else:
+            raise ValueError("unknown angle protocol: " + str(protocol))
+
+    def reset(self):
+        """
+        discards everything received so far
+        """
+        self.serial.reset_input_buffer()
+        self.parser.reset()
+        self.samples.clear()
+
+    def poll(self):
+        """
+        parses whatever is waiting on the port
+
+        Returns
+        -------
+        number of new samples
+        """
+        waiting = self.serial.in_waiting
+        if not waiting:
+            return 0
+        return self.parser.feed(self.serial.read(waiting), self.clock())
+
+    def latest(self):
+        """
+        Returns
+        -------
+        tuple (t, a, theta, omega) of the newest sample, None if there
+        are no samples yet.
+        """
+        return self.samples.latest()
+
+    def since(self, t):
+        """
+        Returns
+        -------
+        dict of numpy arrays t, a, theta, omega of all samples newer
+        than t
+        """
+        return self.samples.since(t)
+
+    def counters(self):
+        return {
+            "lines": self.parser.lines,
+            "garbled": self.parser.garbled,
+            "dropped": self.parser.dropped,
+            "overwritten": max(0, self.samples.count - self.samples.capacity),
+        }
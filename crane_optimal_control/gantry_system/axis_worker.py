@@ -0,0 +1,58 @@
+# one I/O thread per axis, the gantry and the hoist are on separate serial
+# links, so their commands can run at the same time.
+
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread
+
+
+class AxisWorker(Thread):
+    """
+    Executes the commands for one motor in order, on its own thread.
+
+    Commands are submitted as callables and return a Future, so the
+    caller can start commands on several axes and then wait for all of
+    them. Commands of one axis never overlap, commands of different axes
+    do.
+
+        gantry = AxisWorker(printer.gantryStepper, "gantry")
+        position = gantry.submit(gantry.motor.getPosition).result()
+    """
+
+    def __init__(self, motor, name) -> None:
+        super().__init__(name=name + " io", daemon=True)
+        self.motor = motor
+        self.queue = Queue()
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        queues fn(*args, **kwargs) for execution on this axis
+
+        Returns
+        -------
+        Future with the result of fn
+        """
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def stop(self):
+        """
+        executes the commands that are still queued and stops the thread
+        """
+        self.queue.put(None)
+        self.join()
@@ -0,0 +1,142 @@
+# persisted calibration state of the motors, such that a restart of the
+# services does not need to home and calibrate the crane again.
+#
+# The calibration itself (encoder initialization, position zero) lives in
+# the registers of the TMC4671, which keeps them as long as the board is
+# powered. The state file records what the registers looked like after
+# calibration, on startup the board is checked against it and a short
+# probe move verifies that the motor follows its position target.
+
+import os
+import time
+import logging
+import yaml
+
+CALIBRATION_VERSION = 1
+# phi_e from the ABN encoder, only selected after encoder initialization
+PHI_E_ABN = 3
+
+
+class CalibrationStore:
+    """
+    yaml file with the calibration state per axis, e.g.
+
+        gantry: {port: COM11, position: 0, decoder count: 0, ...}
+        hoist: {port: COM10, ...}
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+
+    def load(self):
+        """
+        Returns
+        -------
+        dict of axis name to calibration state, empty if there is no
+        (readable) state file
+        """
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as e:
+            logging.warning("could not read calibration state: " + str(e))
+            return {}
+
+    def save(self, states):
+        # write to a temporary file first, a crash must not leave half a file
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            yaml.safe_dump(states, f)
+        os.replace(tmp, self.path)
+
+    def invalidate(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def readCalibration(motor):
+    """
+    Reads the calibration related registers of a motor.
+
+    Returns
+    -------
+    dict with the calibration state
+    """
+    mc = motor.mc
+    return {
+        "version": CALIBRATION_VERSION,
+        "port": motor.port,
+        "saved": time.time(),
+        "phi_e selection": motor._read(mc.REG.PHI_E_SELECTION),
+        "decoder ppr": motor._read(mc.REG.ABN_DECODER_PPR),
+        "decoder offset": motor._read(mc.REG.ABN_DECODER_PHI_E_PHI_M_OFFSET),
+        "decoder count": motor._read(mc.REG.ABN_DECODER_COUNT),
+        "position": motor._read(mc.REG.PID_POSITION_ACTUAL, signed=True),
+    }
+
+def checkCalibration(motor, saved, tolerance = 0.01):
+    """
+    Checks whether the calibration in saved still holds on the board.
+
+    The encoder count wraps every revolution, the actual position is
+    accumulated from it, so as long as the board has not been reset
+    both must have moved by the same angle since the state was saved.
+
+    Parameters
+    ----------
+    motor : Motor
+    saved : dict
+        state as returned by readCalibration
+    tolerance : float
+        allowed mismatch between encoder count and position [revolutions]
+
+    Returns
+    -------
+    None if valid, otherwise the reason why not
+    """
+    if not saved:
+        return "no saved calibration"
+    if saved.get("version") != CALIBRATION_VERSION:
+        return "calibration state has another version"
+    if saved.get("port") != motor.port:
+        return "calibration state belongs to port " + str(saved.get("port"))
+    current = readCalibration(motor)
+    if current["phi_e selection"] != PHI_E_ABN:
+        return "encoder not initialized, the board was reset"
+    for key in ("phi_e selection", "decoder ppr", "decoder offset"):
+        if current[key] != saved[key]:
+            return key + " changed"
+    ppr = current["decoder ppr"]
+    if ppr == 0:
+        return "decoder ppr is 0"
+    moved = (current["position"] - saved["position"])/65536
+    counted = (current["decoder count"] - saved["decoder count"])/ppr
+    mismatch = (moved - counted) % 1
+    if min(mismatch, 1 - mismatch) > tolerance:
+        return "encoder count and position disagree by " + str(min(mismatch, 1 - mismatch)) + " revolutions"
+    return None
+
+def probeMove(motor, distance = 2000, timeout = 2):
+    """
+    Moves the motor a small distance [counts] and back in position mode,
+    inside the position limits.
+
+    Returns
+    -------
+    True if the motor reached both targets within timeout [s]
+    """
+    mc = motor.mc
+    start = motor.getPosition()
+    high = motor._read(mc.REG.POSITION_LIMIT_HIGH, signed=True)
+    target = start + distance if start + distance <= high else start - distance
+    motor.setPositionMode()
+    try:
+        for position in (target, start):
+            motor.setPosition(position)
+            motor.waitForTarget(position, timeout)
+    except TimeoutError as e:
+        logging.warning("probe move failed: " + str(e))
+        return False
+    return True
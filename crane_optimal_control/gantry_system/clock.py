@@ -0,0 +1,114 @@
+# clocks used by the gantry controllers to pass time.
+# the physical controller always runs in real time, the mock controller
+# can run faster than real time for capacity planning and load tests.
+
+import time
+from datetime import datetime
+from abc import ABCMeta, abstractmethod
+from threading import Lock
+
+
+class Clock(metaclass=ABCMeta):
+    """
+    Source of time for a gantry controller. All time that a controller
+    spends "executing" is passed through sleep() so that the same code
+    can run in real time, accelerated or fully virtual.
+    """
+
+    @abstractmethod
+    def now(self):
+        """
+        returns the current time of this clock in seconds
+        """
+
+    @abstractmethod
+    def sleep(self, seconds):
+        """
+        lets the given amount of clock time pass
+        """
+
+    def nowDatetime(self):
+        """
+        returns the current clock time as a datetime object, convenient
+        for timestamps that end up in the database.
+        """
+        return datetime.fromtimestamp(self.now())
+
+
+class RealTimeClock(Clock):
+    """
+    Wall clock, sleeping takes as long as requested. This is the
+    behaviour the controllers always had.
+    """
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(max(0, seconds))
+
+
+class AcceleratedClock(Clock):
+    """
+    Clock that runs speedup times faster than the wall clock. Sleeping
+    for 10 s of clock time takes 10/speedup s of wall time, and now()
+    advances accordingly.
+    """
+
+    def __init__(self, speedup) -> None:
+        if speedup <= 0:
+            raise ValueError("speedup must be positive, got " + str(speedup))
+        self.speedup = speedup
+        self._wall0 = time.time()
+
+    def now(self):
+        return self._wall0 + (time.time() - self._wall0) * self.speedup
+
+    def sleep(self, seconds):
+        time.sleep(max(0, seconds) / self.speedup)
+
+
+class VirtualClock(Clock):
+    """
+    Clock that only advances when slept on. Sleeping returns
+    immediately, but now() reports consistent timestamps as if the
+    time had really passed.
+    """
+
+    def __init__(self, start=None) -> None:
+        self._now = time.time() if start is None else start
+        self._lock = Lock()
+
+    def now(self):
+        with self._lock:
+            return self._now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self._now += max(0, seconds)
+
+
+def clockFromProperties(props):
+    """
+    creates the clock described in a properties dictionary, i.e.
+    the loaded crane-properties.yaml.
+
+    clock mode : "realtime" (default), "accelerated" or "virtual"
+    clock speedup : speedup factor, only used in accelerated mode
+    """
+    mode = props.get("clock mode", "realtime")
+    return createClock(mode, props.get("clock speedup", 1))
+
+
+def createClock(mode, speedup=1):
+    """
+    creates a clock by name, see clockFromProperties
+    """
+    if mode == "realtime":
+        return RealTimeClock()
+    elif mode == "accelerated":
+        return AcceleratedClock(speedup)
+    elif mode == "virtual":
+        return VirtualClock()
+    else:
+        raise ValueError("unknown clock mode: " + str(mode))
@@ -0,0 +1,167 @@
+# wide layout of the measurement and trajectory tables: one row per
+# timestamp with a column per quantity, instead of one row per quantity.
+#
+# After migration the wide data lives in measurement_wide and
+# trajectory_wide, and measurement and trajectory are views that present
+# the narrow layout (ts, machine_id, run_id, quantity, value), so existing
+# dashboards and queries keep working. The narrow tables are kept as
+# measurement_narrow and trajectory_narrow until dropped.
+#
+# usage: python -m gantry_system.db_schema status
+#        python -m gantry_system.db_schema migrate [--drop-narrow]
+
+import argparse
+import yaml
+
+MEASUREMENT_QUANTITIES = ['position', 'velocity', 'acceleration', 'angular position',
+                          'angular velocity']
+TRAJECTORY_QUANTITIES = ['position', 'velocity', 'acceleration', 'angular position',
+                         'angular velocity', 'angular acceleration', 'force']
+# quantities per table
+QUANTITIES = {
+    "measurement": MEASUREMENT_QUANTITIES,
+    "trajectory": TRAJECTORY_QUANTITIES,
+}
+KEY_COLUMNS = ["ts", "machine_id", "run_id"]
+
+
+class SchemaError(RuntimeError):
+    """
+    Raised when the layout of the tables does not match the configured
+    database schema.
+    """
+
+
+def quantityColumn(quantity):
+    """
+    column of a quantity in the wide tables, e.g. angular_position
+    """
+    return quantity.replace(" ", "_")
+
+def wideColumns(table):
+    """
+    columns of the wide version of table, in COPY order
+    """
+    return KEY_COLUMNS + [quantityColumn(q) for q in QUANTITIES[table]]
+
+def dsnFromProperties(props):
+    return "host=" + props["database address"]\
+           + " dbname=" + props["database name"]\
+           + " user=" + props["database user"]\
+           + " password=" + props["database password"]
+
+def tableType(conn, name):
+    """
+    Returns
+    -------
+    "BASE TABLE", "VIEW" or None if name does not exist
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT table_type FROM information_schema.tables \
+                    WHERE table_name = %s AND table_schema = ANY(current_schemas(false))",
+                    (name,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def schemaOf(conn, table):
+    """
+    Returns
+    -------
+    "wide" if table is the narrow view on table_wide, "narrow" if it is
+    still a table, None if it does not exist
+    """
+    return {"BASE TABLE": "narrow", "VIEW": "wide"}.get(tableType(conn, table))
+
+def createWideTable(conn, table):
+    columns = ", ".join(quantityColumn(q) + " double precision" for q in QUANTITIES[table])
+    with conn.cursor() as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS " + table + "_wide \
+                    (ts timestamp, machine_id integer, run_id integer, " + columns + ")")
+        cur.execute("CREATE INDEX IF NOT EXISTS " + table + "_wide_run_idx \
+                    ON " + table + "_wide (machine_id, run_id, ts)")
+
+def createNarrowView(conn, table):
+    """
+    (Re)creates table as a view with the narrow layout on table_wide.
+    Quantities that are NULL in a wide row have no narrow row.
+    """
+    values = ", ".join("('" + q + "', w." + quantityColumn(q) + ")" for q in QUANTITIES[table])
+    with conn.cursor() as cur:
+        cur.execute("CREATE OR REPLACE VIEW " + table + " AS \
+                    SELECT w.ts, w.machine_id, w.run_id, q.quantity::varchar AS quantity, q.value \
+                    FROM " + table + "_wide w \
+                    CROSS JOIN LATERAL (VALUES " + values + ") AS q(quantity, value) \
+                    WHERE q.value IS NOT NULL")
+
+def migrateRun(conn, table, source, machine_id, run_id):
+    """
+    pivots one run of the narrow source table into table_wide
+    """
+    pivot = ", ".join("max(value) FILTER (WHERE quantity = '" + q + "')" for q in QUANTITIES[table])
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO " + table + "_wide (" + ", ".join(wideColumns(table)) + ") \
+                    SELECT ts, machine_id, run_id, " + pivot + " FROM " + source + " \
+                    WHERE machine_id = %s AND run_id = %s \
+                    GROUP BY ts, machine_id, run_id",
+                    (machine_id, run_id))
+        return cur.rowcount
+
+def migrate(conn, table, drop_narrow = False):
+    """
+    Converts table to the wide layout. Every run is pivoted in its own
+    transaction and runs that are already in table_wide are skipped, so
+    an interrupted migration can be restarted. Once all runs are
+    converted, the narrow table is renamed to table_narrow (or dropped)
+    and replaced by the narrow view.
+
+    Returns
+    -------
+    number of runs migrated
+    """
+    createWideTable(conn, table)
+    conn.commit()
+    source = table if schemaOf(conn, table) == "narrow" else table + "_narrow"
+    if tableType(conn, source) is None:
+        # nothing to convert, a new database
+        createNarrowView(conn, table)
+        conn.commit()
+        return 0
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT machine_id, run_id FROM " + source + " n \
+                    WHERE NOT EXISTS (SELECT 1 FROM " + table + "_wide w \
+                    WHERE w.machine_id = n.machine_id AND w.run_id = n.run_id)")
+        runs = cur.fetchall()
+    for i, (machine_id, run_id) in enumerate(runs):
+        rows = migrateRun(conn, table, source, machine_id, run_id)
+        conn.commit()
+        print(f"{table}: run {run_id} of machine {machine_id}, {rows} rows ({i + 1}/{len(runs)})")
+    # a continuous aggregate of the narrow table (see timescale.py) blocks
+    # dropping it and would not see new runs, it is recreated on table_wide
+    # by the next provisioning
+    from .timescale import timescaleInstalled, dropOutdatedAggregate
+    if timescaleInstalled(conn):
+        dropOutdatedAggregate(conn, table, table + "_wide")
+    with conn.cursor() as cur:
+        if source == table:
+            cur.execute("ALTER TABLE " + table + " RENAME TO " + table + "_narrow")
+        if drop_narrow:
+            cur.execute("DROP TABLE " + table + "_narrow")
+    createNarrowView(conn, table)
+    conn.commit()
+    return len(runs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="wide layout of the measurement and trajectory tables")
+    parser.add_argument("command", choices=["status", "migrate"])
+    parser.add_argument("--config", default="./crane_optimal_control/gantry_system/crane-properties.yaml")
+    parser.add_argument("--drop-narrow", action="store_true", help="drop the narrow tables after migration")
+    args = parser.parse_args()
+
+    import psycopg
+    with open(args.config, 'r') as f:
+        props = yaml.safe_load(f)
+    with psycopg.connect(dsnFromProperties(props)) as conn:
+        for table in QUANTITIES:
+            if args.command == "migrate":
+                print(f"{table}: migrated {migrate(conn, table, args.drop_narrow)} runs")
+            print(f"{table}: {schemaOf(conn, table)}")
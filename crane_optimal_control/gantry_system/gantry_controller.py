@@ -1,17 +1,21 @@
 from abc import abstractmethod
 import json
+import os
 import pickle
-from threading import Event
+from threading import Event, Lock
+import uuid
 from typing_extensions import override
 import yaml
 from .trajectory_generator import TrajectoryGenerator
-import psycopg
 from datetime import timedelta, datetime
-from time import sleep
+from time import sleep, monotonic
 import logging
 import paho.mqtt.client as mqtt
 import sys
 from .printer2 import Printer, Waypoint
+from .clock import RealTimeClock, clockFromProperties
+from .plant import CranePlant
+from .telemetry import executionReport
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.signal import correlate
@@ -19,12 +23,15 @@ import re
 
 class GantryController():
 
-    def __init__(self, properties_file) -> None:
+    def __init__(self, properties_file, clock = None) -> None:
         """
         Parameters
         ----------
         properties_file : String
             path to the properties file of the gantrycrane
+        clock : Clock
+            clock used to pass time, if None, the clock is created
+            from the "clock mode" in the properties file.
         """
 
         # load properties file
@@ -33,29 +40,35 @@ class GantryController():
             # machine identification in database
             self.id = props["machine id"]
             self.name = props["machine name"]
-            # connection to database
-            self.dbaddr = "host="+props["database address"]\
-                                    + " dbname=" + props["database name"]\
-                                    + " user=" + props["database user"]\
-                                    + " password=" + props["database password"]
-            self.connect_to_db = props["connect to db"]
-            if self.connect_to_db:
-                self.dbconn = psycopg.connect(self.dbaddr)
-            else:
-                self.dbconn = None
+            # runs are stored and run ids allocated through the database
+            # writer, the controller does not connect to the database
             self.simulatortopic = props["simulator topic"]
             self.validatortopic = props["validator topic"]
+            if clock is None:
+                clock = clockFromProperties(props)
+            self.clock = clock
+            # run ids are requested from the database writer in blocks
+            self.run_id_block = props.get("run id block size", 10)
+            self.run_id_timeout = props.get("run id timeout", 10)
+            # longest wait for the trajectories of a move or plan and for
+            # the response to G6 of the conveyor belt service
+            self.trajectory_timeout = props.get("trajectory timeout", 60)
+            self.magnet_timeout = props.get("magnet timeout", 10)
 
         self.position = 0 # add code to request from printer
-        if self.dbconn:
-            with self.dbconn.cursor() as cur:
-                cur.execute("SELECT MAX(run_id) FROM run WHERE machine_id = 1;")
-                try:
-                    self.run = cur.fetchall()[0][0] + 1
-                except:
-                    # if an exception occurs, there simply aren't any runs yet.
-                    # so add run number 0.
-                    self.run = 0
+        # run id of the current (or last) logged move, allocated by the
+        # database writer so that concurrent controllers never collide.
+        self.run = None
+        self.run_ids = [] # cached block of allocated run ids
+        self.run_ids_lock = Lock()
+        self.run_ids_event = Event()
+        self.run_ids_error = None # error of the last allocation
+        # id that associates the responses of the database writer with this controller
+        self.response_id = str(uuid.uuid4())
+        # trajectories that are requested but not yet received, by request id
+        self.pending_trajectories = {}
+        self.trajectories_event = Event()
+        self.magnet_event = Event()
         self.repls = props["replications"]
 
         # mqtt setup
@@ -68,17 +81,19 @@ class GantryController():
         self.response_event = Event()  # Event to block until trajectory is received
         self.received_trajectory = None
 
+        # timing of the last executed trajectory as reported by the
+        # printer, None if it was not executed on hardware
+        self.timing = None
+        # execution report of the last logged move, see telemetry.executionReport
+        self.executionReport = None
+
         logging.info("Initialized " + str(self))
 
     def __enter__(self):
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            # self.printerconn.close() printerconn doensn't have close yet
-            self.dbconn.close()
-        except Exception:
-            pass
+        # self.printerconn.close() printerconn doensn't have close yet
         try:
             self.mqttc.loop_stop()
         except Exception:
@@ -93,20 +108,72 @@ class GantryController():
         response_topic = f"command/bip-server/{self.id}/res/store-measurement/#"
         client.subscribe(response_topic)
         print(f"Subscribed to topic: {response_topic}")
-        response_topic = f"command/bip-server/{self.id}/res/generate-trajectory/#"
+        response_topic = f"command/bip-server/{self.id}/res/store-execution-report/#"
+        client.subscribe(response_topic)
+        print(f"Subscribed to topic: {response_topic}")
+        response_topic = f"command/bip-server/{self.id}/res/+/generate-trajectory"
+        client.subscribe(response_topic)
+        print(f"Subscribed to topic: {response_topic}")
+        response_topic = f"command/bip-server/{self.id}/res/{self.response_id}/allocate-run-ids"
+        client.subscribe(response_topic)
+        print(f"Subscribed to topic: {response_topic}")
+        response_topic = f"command/bip-server/{self.id}/res/{self.response_id}/G6"
         client.subscribe(response_topic)
         print(f"Subscribed to topic: {response_topic}")
 
     def on_message(self, client, userdata, msg):
         try:
+            if msg.topic.endswith("allocate-run-ids"):
+                payload = json.loads(msg.payload)
+                with self.run_ids_lock:
+                    if "error" in payload:
+                        self.run_ids_error = payload["error"]
+                    else:
+                        self.run_ids.extend(payload["run_ids"])
+                print(f"Received {payload} on topic: {msg.topic}")
+                self.run_ids_event.set()
+                return
+            if msg.topic.endswith("G6"):
+                self.magnet_event.set()
+                return
             # Deserialize the trajectory
             if "generate-trajectory" in msg.topic:
-                self.received_trajectory = pickle.loads(msg.payload)
-                print(f"Received trajectory on topic: {msg.topic}")
+                request_id = msg.topic.split('/')[-2]
+                if request_id in self.pending_trajectories:
+                    self.pending_trajectories[request_id] = pickle.loads(msg.payload)
+                    print(f"Received trajectory on topic: {msg.topic}")
+                    self.trajectories_event.set()
+                return
             self.response_event.set()  # Signal that the response has been received
         except Exception as e:
             print(f"Error processing message: {e}")
     
+    def nextRun(self):
+        """
+        Returns a new run id. Run ids are allocated by the database
+        writer from a database sequence and cached here in blocks of
+        "run id block size", so only one in so many runs costs a
+        round trip.
+        """
+        with self.run_ids_lock:
+            if self.run_ids:
+                return self.run_ids.pop(0)
+            self.run_ids_event.clear()
+            self.run_ids_error = None
+        request_topic = f"command/bip-server/{self.id}/req/{self.response_id}/allocate-run-ids"
+        payload = {
+            "count": self.run_id_block
+        }
+        self.mqttc.publish(request_topic, json.dumps(payload), qos = 2, retain=False)
+        print(f"Published request to topic: {request_topic}")
+        print("Waiting for run ids...")
+        if not self.run_ids_event.wait(self.run_id_timeout):
+            raise TimeoutError("no run ids received from the database writer")
+        with self.run_ids_lock:
+            if not self.run_ids:
+                raise RuntimeError("the database writer could not allocate run ids: " + str(self.run_ids_error))
+            return self.run_ids.pop(0)
+
     @abstractmethod
     def connectToPrinter(self):
         """
@@ -117,20 +184,123 @@ class GantryController():
         return 0
     
     def generateTrajectory(self, start, stop, genmethod = "ocp"):
-        # Publish the request to generate a trajectory
-        request_topic = f"command/bip-server/{self.id}/req/generate-trajectory/generate-trajectory"
+        self.received_trajectory = self.fetchTrajectories([(start, stop)], genmethod)[0]
+        return self.received_trajectory
+
+    def fetchTrajectories(self, segments, genmethod = "ocp"):
+        """
+        Requests the trajectories for a list of (start, stop) segments
+        all at once and waits until all of them are received.
+
+        Returns
+        -------
+        list of trajectories, in the order of the segments
+        """
+        request_ids = [str(uuid.uuid4()) for _ in segments]
+        self.trajectories_event.clear()
+        for request_id in request_ids:
+            self.pending_trajectories[request_id] = None
+        for request_id, (start, stop) in zip(request_ids, segments):
+            # Publish the request to generate a trajectory
+            request_topic = f"command/bip-server/{self.id}/req/{request_id}/generate-trajectory"
+            payload = {
+                "start": start,
+                "stop": stop,
+                "genmethod": genmethod
+            }
+            self.mqttc.publish(request_topic, json.dumps(payload), qos = 2, retain=False)
+            print(f"Published request to topic: {request_topic}")
+        print("Waiting for trajectory response...")
+        deadline = monotonic() + self.trajectory_timeout
+        while any(self.pending_trajectories[request_id] is None for request_id in request_ids):
+            # Blocks until the next response is received
+            if not self.trajectories_event.wait(max(0, deadline - monotonic())):
+                for request_id in request_ids:
+                    self.pending_trajectories.pop(request_id, None)
+                raise TimeoutError("no trajectory received from the trajectory generator")
+            self.trajectories_event.clear()
+        return [self.pending_trajectories.pop(request_id) for request_id in request_ids]
+
+    def magnet(self, on):
+        """
+        Switches the electromagnet on the hoist on or off, through the
+        G6 command of the conveyor belt service.
+        """
+        request_topic = f"command/bip-server/{self.id}/req/{self.response_id}/G6"
         payload = {
-            "start": start,
-            "stop": stop,
-            "genmethod": genmethod
+            "on/off": 1 if on else 0
         }
+        self.magnet_event.clear()
         self.mqttc.publish(request_topic, json.dumps(payload), qos = 2, retain=False)
         print(f"Published request to topic: {request_topic}")
-        print("Waiting for trajectory response...")
-        self.response_event.wait()  # Blocks until the response is received
-        return self.received_trajectory
+        if not self.magnet_event.wait(self.magnet_timeout):
+            raise TimeoutError("no response to G6 from the conveyor belt service")
+        return bool(on)
 
-    def moveWithLog(self, target, generator = 'ocp'):
+    def executePlan(self, steps, generator = 'ocp', progress = None):
+        """
+        Executes an ordered list of steps back to back. The trajectories
+        for all moves are requested up front, so no time is lost
+        between the steps.
+
+        Parameters:
+        -----------
+        steps : list of dict
+            each step has an "action" and the argument of that action:
+            {"action": "hoist", "height": h}
+            {"action": "move", "position": x}       (logged move)
+            {"action": "simplemove", "position": x}
+            {"action": "simplemove", "position": x, "height": h}
+                                                    (hoists during the move)
+            {"action": "magnet", "on/off": 1}
+            {"action": "wait", "seconds": s}
+        progress : callable
+            called as progress(index, step, result) after every step
+
+        Returns
+        -------
+        list of the results of the steps
+        """
+        actions = ["hoist", "move", "simplemove", "magnet", "wait"]
+        for step in steps:
+            if step.get("action") not in actions:
+                raise ValueError("unknown plan action: " + str(step.get("action")))
+
+        # positions are known in advance, so all trajectories can be fetched now
+        segments = []
+        position = self.position
+        for step in steps:
+            if step["action"] == "move":
+                segments.append((position, step["position"]))
+            if step["action"] in ("move", "simplemove"):
+                position = step["position"]
+        trajs = iter(self.fetchTrajectories(segments, generator)) if segments else iter([])
+
+        results = []
+        for idx, step in enumerate(steps):
+            action = step["action"]
+            if action == "hoist":
+                result = self.hoist(step["height"])
+            elif action == "move":
+                traj, measurement = self.moveWithLog(step["position"], generator, traj=next(trajs))
+                result = measurement[1][-1]
+            elif action == "simplemove" and "height" in step:
+                result = list(self.simpleMoveAndHoist(step["position"], step["height"]))
+                self.position = result[0]
+            elif action == "simplemove":
+                result = self.simpleMove(step["position"])
+                self.position = result
+            elif action == "magnet":
+                result = self.magnet(step["on/off"])
+            else:
+                self.clock.sleep(step["seconds"])
+                result = step["seconds"]
+            results.append(result)
+            if progress is not None:
+                progress(idx, step, result)
+        return results
+
+    def moveWithLog(self, target, generator = 'ocp', traj = None):
         """
         Move to target position with log in the database
 
@@ -140,10 +310,15 @@ class GantryController():
             target position
         generator : strign
             'ocp', 'lqr'
+        traj : tuple
+            trajectory to the target if it was already generated,
+            e.g. by fetchTrajectories.
         """
-        logging.info("Generating trajectory to " + str(target))
-        traj = self.generateTrajectory(self.position, target, generator)
-        sleep(1.5) # sleep needed for initialization of the Arduino
+        self.run = self.nextRun()
+        if traj is None:
+            logging.info("Generating trajectory to " + str(target) + " for run " + str(self.run))
+            traj = self.generateTrajectory(self.position, target, generator)
+        self.clock.sleep(1.5) # sleep needed for initialization of the Arduino
         logging.info("Trajectory generated, storing in database")
         self.storeTrajectory(traj)
         logging.info("Trajectory stored, notifying simulator")
@@ -152,13 +327,15 @@ class GantryController():
         measurement = self.executeTrajectory(traj)
         logging.info("Trajectory executed, updating position and storing measurement")
         self.position = measurement[1][-1]
+        self.executionReport = executionReport(traj, measurement, self.timing)
+        logging.info("Execution report: " + str(self.executionReport))
         # align measurement to trajectory for storing
         measurement = self._align_measurement_to_trajectory(traj, measurement)
         self.storeMeasurement(measurement)
+        self.storeExecutionReport(self.executionReport)
         logging.info("Measurement stored in database, notifying validator")
         self.notifyValidator()
         logging.info("Validator notified, finished move")
-        self.run += 1
         return traj, measurement
 
     def notifySimulator(self):
@@ -188,6 +365,7 @@ class GantryController():
         """
         request_topic = f"command/bip-server/{self.id}/req/{self.run}/store-trajectory"
         serialized_trajectory = pickle.dumps(traj)
+        self.response_event.clear()
         self.mqttc.publish(request_topic, serialized_trajectory, qos = 2, retain=False)
         print(f"Published request to topic: {request_topic}")
         print("Waiting for trajectory store response...")
@@ -215,12 +393,26 @@ class GantryController():
         """
         request_topic = f"command/bip-server/{self.id}/req/{self.run}/store-measurement"
         serialized_trajectory = pickle.dumps(measurement)
+        self.response_event.clear()
         self.mqttc.publish(request_topic, serialized_trajectory, qos = 2, retain=False)
         print(f"Published request to topic: {request_topic}")
         print("Waiting for measurement store response...")
         self.response_event.wait()  # Blocks until the response is received
         return 
 
+    def storeExecutionReport(self, report):
+        """
+        stores the execution report of the current run, report is a
+        dict as returned by telemetry.executionReport
+        """
+        request_topic = f"command/bip-server/{self.id}/req/{self.run}/store-execution-report"
+        self.response_event.clear()
+        self.mqttc.publish(request_topic, json.dumps(report), qos = 2, retain=False)
+        print(f"Published request to topic: {request_topic}")
+        print("Waiting for execution report store response...")
+        self.response_event.wait()  # Blocks until the response is received
+        return
+
     def notifyValidator(self):
         # for testing phases, valconn may not exist yet
         try:
@@ -286,7 +478,7 @@ class GantryController():
         # trajectory is a tuple of shape: (ts, xs, dxs, ddxs, thetas, dthetas, ddthetas, us)
         # execute the trajectory
         # measurement is a tuple of shape (t, x, v, a, theta, omega)   
-        sleep(2)
+        self.clock.sleep(2)
         measurement = self.executeTrajectory(traj)
         self.position = measurement[1][-1]
         # align measurement to trajectory for storing
@@ -333,16 +525,31 @@ class GantryController():
         # to compute it, I can get it from there.
         # note that this is great, because otherwise I'd have had a problem
         # when it comes to the faulty data.
-        time_shift = self._find_time_shift(traj[0], traj[2], measurement[0], measurement[2])
-        logging.info("time shift is " + str(time_shift) + " seconds")
-        logging.info("difference between trajectory points" + str(traj[0][0] - traj[0][1]))
+        if not self._deviceTimestamped():
+            # only logged, to check the assumption above
+            time_shift = self._find_time_shift(traj[0], traj[2], measurement[0], measurement[2])
+            logging.info("time shift is " + str(time_shift) + " seconds")
+            logging.info("difference between trajectory points" + str(traj[0][0] - traj[0][1]))
         time_shift = traj[0][0] - traj[0][1]
+        # the angle columns (a, theta, omega) are shifted as well, for the
+        # lag of angles that are timestamped on arrival. Angles timestamped
+        # by the sensor are already aligned with the motor samples.
+        angle_shift = 0 if self._deviceTimestamped() else time_shift
         for i in range(1, 6):
-            measurement[i] = np.interp(traj[0], measurement[0] + time_shift, measurement[i])
+            shift = time_shift if i < 3 else angle_shift
+            measurement[i] = np.interp(traj[0], measurement[0] + shift, measurement[i])
         measurement[0] = traj[0]
 
         return tuple(measurement)
     
+    def _deviceTimestamped(self):
+        """
+        True if the angles in the measurements carry the times at which
+        the sensor took them, so they need no shift for the time they
+        took to arrive
+        """
+        return False
+
     @abstractmethod
     def simpleMove(self, target):
         pass
@@ -350,6 +557,18 @@ class GantryController():
     @abstractmethod
     def hoist(self, pos):
         pass
+
+    def simpleMoveAndHoist(self, target, pos):
+        """
+        simple move to target and hoist to pos. Controllers that can
+        drive both axes at the same time override this, by default they
+        move one after the other.
+
+        Returns
+        -------
+        tuple (position, height)
+        """
+        return self.simpleMove(target), self.hoist(pos)
     
 class MockGantryController(GantryController):
     """
@@ -358,9 +577,19 @@ class MockGantryController(GantryController):
     overriding the executeTrajectory method
     """
 
-    def __init__(self, properties_file) -> None:
-        super().__init__(properties_file)
+    def __init__(self, properties_file, clock = None) -> None:
+        super().__init__(properties_file, clock)
         self.position = 0
+        # start and end time (clock time) of the last executed trajectory
+        self.lastExecution = (None, None)
+        # "ideal" returns the trajectory with noise, "physics" simulates
+        # the crane with CranePlant.
+        with open(properties_file, 'r') as f:
+            props = yaml.safe_load(f)
+            if props.get("mock plant", "ideal") == "physics":
+                self.plant = CranePlant(properties_file)
+            else:
+                self.plant = None
 
     def __enter__(self):
         return super().__enter__()
@@ -381,9 +610,12 @@ class MockGantryController(GantryController):
         traj is the trajectory as generated by generateTrajectory
 
         this mock version just returns the ideal trajectory as if it
-        was executed perfectly. The ideal timestamps are replaced
-        with real system timestamps, and the function sleeps
-        until the real end time of the trajectory has passed.
+        was executed perfectly, or, when the mock has a plant, the
+        simulated response of the crane. The function lets the duration of the
+        trajectory pass on the clock of the controller, which takes
+        real time, a fraction of it, or no time at all depending on
+        the clock. The clock time at which the execution started and
+        ended is kept in lastExecution.
 
         Returns
         -------
@@ -393,10 +625,12 @@ class MockGantryController(GantryController):
         theta : angular position
         omega : angular velocity
         """
-        curr_time = datetime.min
-        real_time = [curr_time + timedelta(seconds=ts) for ts in traj[0]]
+        start = self.clock.now()
         # sleep for the duration of the trajectory to "execute" it
-        sleep(max(0, traj[0][-1]))
+        self.clock.sleep(max(0, traj[0][-1]))
+        self.lastExecution = (start, self.clock.now())
+        if self.plant is not None:
+            return self.plant.simulate(traj, x0=self.position)
         # add a bit of measurement noise to the trajectory
         noise = np.random.normal(loc=0, scale=0.005, size = (5, len(traj[0])))
         return (traj[0], traj[1] + noise[0,:], traj[2] + noise[1,:], traj[3] + noise[2,:], traj[4] + noise[3,:], traj[5] + noise[4,:])
@@ -411,8 +645,11 @@ class MockGantryController(GantryController):
 
 class PhysicalGantryController(GantryController):
 
-    def __init__(self, properties_file) -> None:
-        super().__init__(properties_file)
+    def __init__(self, properties_file, clock = None) -> None:
+        # the physical crane can only move in real time
+        if clock is not None and not isinstance(clock, RealTimeClock):
+            raise ValueError("PhysicalGantryController requires a RealTimeClock")
+        super().__init__(properties_file, RealTimeClock())
         self.printer = self.connectToPrinter(properties_file)
 
     def __enter__(self):
@@ -424,28 +661,32 @@ class PhysicalGantryController(GantryController):
 
     @override
     def connectToPrinter(self, properties_file):
-        with open(properties_file, 'r+') as f:
+        with open(properties_file, 'r') as f:
             props = yaml.safe_load(f)
             # machine identification in database
             gantryPort = props["gantryPort"]
             hoistPort = props["hoistPort"]
-            # angleUARTPort = props["angleUARTPort"]
-            angleUARTPort = None
-            # gantryUARTPort = props["gantryUARTPort"]
-            gantryUARTPort = None
+            # angle sensor, optional
+            angleUARTPort = props.get("angleUARTPort")
+            # UART logging interface of the gantry board, optional
+            gantryUARTPort = props.get("gantryUARTPort")
             calibrated = props["calibrated"]
             I_max = props["cart acceleration limit"] * 0.167 + 0.833
-            crane = Printer(gantryPort, hoistPort, angleUARTPort, gantryUARTPort, calibrated=bool(calibrated), I_max = I_max)
-            # if at this point a valid printer object was returned, it should have been calibrated successfully.
-            # therefore, alter the file
-
-            # if not calibrated:
-            #     f.seek(0)
-            #     content = f.read()
-            #     content = re.sub(r'calibrated:\s*False', 'calibrated: True', content)
-            #     f.seek(0)
-            #     f.truncate(0)
-            #     f.write(content)
+            # calibration state file, relative to the properties file
+            calibration_file = os.path.join(os.path.dirname(os.path.abspath(properties_file)),
+                                            props.get("calibration file", "calibration-state.yaml"))
+            crane = Printer(gantryPort, hoistPort, angleUARTPort, gantryUARTPort, calibrated=bool(calibrated), I_max = I_max,
+                            sampling_rate = props.get("sampling rate", 200),
+                            angle_protocol = props.get("angle protocol", "ascii"),
+                            angle_baudrate = props.get("angle baudrate", 115200),
+                            calibration_file = calibration_file,
+                            derived_omega = props.get("derived omega", False),
+                            uart_sampling_rate = props.get("uart sampling rate", 1000))
+            # timeout for simple moves and hoisting to complete
+            crane.gantryStepper.motion.timeout = props.get("motion timeout", 30)
+            crane.hoistStepper.motion.timeout = props.get("motion timeout", 30)
+            # if at this point a valid printer object was returned, it has been
+            # calibrated successfully, the Printer saved that in the calibration file.
             return crane
     
     @override
@@ -490,7 +731,8 @@ class PhysicalGantryController(GantryController):
         self.printer.waypoints = waypoints
 
         # execute the waypoints (starting condition check?)
-        ret = self.printer.executeWaypointsPositionV3()
+        # the timing of the execution goes into the execution report
+        ret, self.timing = self.printer.executeWaypointsPositionV3()
 
         """
         ret is a tuple (t, x, v, theta, omega)
@@ -503,6 +745,13 @@ class PhysicalGantryController(GantryController):
         """
         return ret
     
+    @override
+    def _deviceTimestamped(self):
+        # the binary angle protocol timestamps the angles on the sensor,
+        # the printer merges them onto the motor sample times
+        reader = self.printer.angleReader
+        return reader is not None and reader.protocol == "binary"
+
     @override
     def hoist(self, pos):
         """
@@ -510,10 +759,9 @@ class PhysicalGantryController(GantryController):
 
         returns the exact final position
         """
-        # inverts direction.
-        self.printer.hoistStepper.setPosition(int(262144 - self.printer.hoistStepper.mm_to_counts * pos * 1000))
-        # while(round(self.printer.hoistStepper.getPosition(), 3))
-        return (262144 - self.printer.hoistStepper.getPosition())/self.printer.hoistStepper.mm_to_counts/1000
+        # wait for move to complete.
+        position = self.printer.moveHoist(self._hoistCounts(pos)).result()
+        return self._hoistHeight(position)
     
     @override
     def simpleMove(self, target):
@@ -521,15 +769,29 @@ class PhysicalGantryController(GantryController):
         command to do a simple move. This move is a slow move
         without trajectory generation. Can be used e.g. for 
         """
-        self.printer.gantryStepper.setPositionMode()
-        self.printer.gantryStepper.setAccelLimit(2147483647)
-        self.printer.gantryStepper.setVelocityLimit(2000)
-        self.printer.gantryStepper.setPosition(target * 1000*self.printer.gantryStepper.mm_to_counts)
         # wait for move to complete.
-        while (round(self.printer.gantryStepper.getPosition(), -2) != round(target * 1000*self.printer.gantryStepper.mm_to_counts, -2)):
-            sleep(0.1)
-        
-        return self.printer.gantryStepper.getPosition()/self.printer.gantryStepper.mm_to_counts/1000
+        position = self.printer.moveGantry(self._gantryCounts(target), 2000).result()
+        return position/self.printer.gantryStepper.mm_to_counts/1000
+
+    @override
+    def simpleMoveAndHoist(self, target, pos):
+        """
+        simple move and hoist at the same time, on the separate links
+        of the gantry and the hoist
+        """
+        position, height = self.printer.moveAxes(gantry=self._gantryCounts(target),
+                                                 hoist=self._hoistCounts(pos))
+        return position/self.printer.gantryStepper.mm_to_counts/1000, self._hoistHeight(height)
+
+    def _gantryCounts(self, target):
+        return int(target * 1000*self.printer.gantryStepper.mm_to_counts)
+
+    def _hoistCounts(self, pos):
+        # inverts direction.
+        return int(262144 - self.printer.hoistStepper.mm_to_counts * pos * 1000)
+
+    def _hoistHeight(self, counts):
+        return (262144 - counts)/self.printer.hoistStepper.mm_to_counts/1000
 
 if __name__ == "__main__":
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
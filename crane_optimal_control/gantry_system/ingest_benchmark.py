@@ -0,0 +1,99 @@
+# benchmark of the ingestion of a measurement by the database writer
+# compares the per row encoding that storeMeasurement used to do with the
+# vectorized binary COPY encoding, and optionally COPYs both into a
+# temporary table of a real database.
+#
+# usage: python -m gantry_system.ingest_benchmark --samples 2000
+#        python -m gantry_system.ingest_benchmark --dsn "host=localhost dbname=bip"
+
+import argparse
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from .pg_copy import BinaryCopyEncoder, relativeTimestamps, PGCOPY_HEADER, PGCOPY_TRAILER
+
+QUANTITIES = ['position', 'velocity', 'acceleration', 'angular position', 'angular velocity']
+TYPES = ["timestamp without time zone", "integer", "integer", "character varying", "double precision"]
+
+
+def _measurement(samples, sampling_rate):
+    t = np.arange(samples)/sampling_rate
+    return (t,) + tuple(np.sin(t*(i + 1)) for i in range(len(QUANTITIES)))
+
+def _rowsPython(measurement):
+    # what storeMeasurement used to do before handing the rows to write_row
+    ts = [datetime.min + timedelta(seconds=t) for t in measurement[0]]
+    return [(t, 1, 1, qty, value)
+            for idx, qty in enumerate(QUANTITIES, 1)
+            for (t, value) in zip(ts, measurement[idx])]
+
+def _rowsBinary(encoder, measurement):
+    ts = relativeTimestamps(measurement[0])
+    return PGCOPY_HEADER + b"".join(encoder.encodeRows([ts, 1, 1, qty, measurement[idx]])
+                                    for idx, qty in enumerate(QUANTITIES, 1)) + PGCOPY_TRAILER
+
+def _time(fn, repeats):
+    durations = np.empty(repeats)
+    for i in range(repeats):
+        tick = time.perf_counter()
+        fn()
+        durations[i] = time.perf_counter() - tick
+    return float(np.median(durations))
+
+def benchmarkIngest(samples = 2000, sampling_rate = 200, repeats = 20, dsn = None):
+    """
+    Encodes (and with dsn, COPYs) a measurement of samples samples per
+    quantity, once row by row and once vectorized.
+
+    Returns
+    -------
+    dict per method with the median duration [s] and the rows per second
+    """
+    measurement = _measurement(samples, sampling_rate)
+    rows = samples*len(QUANTITIES)
+    encoder = BinaryCopyEncoder(TYPES)
+    methods = {
+        "python rows": lambda: _rowsPython(measurement),
+        "binary encoding": lambda: _rowsBinary(encoder, measurement),
+    }
+    if dsn is not None:
+        import psycopg
+        conn = psycopg.connect(dsn)
+        conn.execute("CREATE TEMPORARY TABLE ingest_benchmark \
+                     (ts timestamp, machine_id integer, run_id integer, quantity varchar(20), value double precision)")
+        # keep the table, the copies below are rolled back
+        conn.commit()
+        columns = "ingest_benchmark (ts, machine_id, run_id, quantity, value)"
+
+        def copyRows():
+            with conn.cursor() as cur:
+                with cur.copy("COPY " + columns + " FROM STDIN") as copy:
+                    for row in _rowsPython(measurement):
+                        copy.write_row(row)
+            conn.rollback()
+
+        def copyBinary():
+            with conn.cursor() as cur:
+                with cur.copy("COPY " + columns + " FROM STDIN (FORMAT BINARY)") as copy:
+                    copy.write(_rowsBinary(encoder, measurement))
+            conn.rollback()
+
+        methods["copy write_row"] = copyRows
+        methods["copy binary"] = copyBinary
+    results = {}
+    for name, fn in methods.items():
+        duration = _time(fn, repeats)
+        results[name] = {"duration": duration, "rows per second": rows/duration}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark of the ingestion of measurements")
+    parser.add_argument("--samples", type=int, default=2000, help="samples per quantity")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--dsn", default=None, help="database to COPY into, e.g. \"host=localhost dbname=bip\"")
+    args = parser.parse_args()
+
+    for name, result in benchmarkIngest(args.samples, repeats=args.repeats, dsn=args.dsn).items():
+        print(name)
+        for key, value in result.items():
+            print(f"  {key}: {value:.6g}")
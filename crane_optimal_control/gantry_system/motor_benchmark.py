@@ -0,0 +1,76 @@
+# benchmark of the serial link to the TMC4671 boards
+# measures the round trips and latency that one waypoint costs, with
+# separate register accesses and with a batched transaction.
+#
+# The gantry is created as calibrated, so it first moves to position 0,
+# the benchmark itself does not move it.
+#
+# usage: python -m gantry_system.motor_benchmark COM11 --waypoints 500
+
+import argparse
+import time
+import numpy as np
+from .motors import GantryStepper
+
+
+def _waypointSequential(motor, vel_limit):
+    # what executeWaypointsPositionV3 used to do for every waypoint
+    motor.setVelocityLimit(vel_limit)
+    motor.getPosition()
+    motor.getVelocity()
+
+def _waypointTransaction(motor, vel_limit):
+    with motor.transaction() as tx:
+        tx.write(motor.mc.REG.PID_VELOCITY_LIMIT, vel_limit)
+        tx.read(motor.mc.REG.PID_POSITION_ACTUAL, signed=True)
+        tx.read(motor.mc.REG.PID_VELOCITY_ACTUAL, signed=True)
+
+def benchmarkWaypoints(motor, waypoints = 200):
+    """
+    Executes the register traffic of a waypoint (set velocity limit,
+    read position and velocity) a number of times, once with separate
+    accesses and once as a transaction. The motor does not move, the
+    velocity limit alternates between its current value and one rpm
+    more, such that the shadow registers do not skip the writes.
+
+    Returns
+    -------
+    dict per method with the round trips, requests, writes sent and
+    writes saved by the shadow registers per waypoint and the mean,
+    median and 99th percentile latency per waypoint [s]
+    """
+    vel_limit = motor._read(motor.mc.REG.PID_VELOCITY_LIMIT)
+    limits = (vel_limit + 1, vel_limit)
+    results = {}
+    for name, waypoint in (("sequential", _waypointSequential), ("transaction", _waypointTransaction)):
+        requests, round_trips = motor.requests, motor.round_trips
+        sent, saved = motor.writes_sent, motor.writes_saved
+        durations = np.empty(waypoints)
+        for i in range(waypoints):
+            tick = time.perf_counter()
+            waypoint(motor, limits[i % 2])
+            durations[i] = time.perf_counter() - tick
+        results[name] = {
+            "round trips per waypoint": (motor.round_trips - round_trips)/waypoints,
+            "requests per waypoint": (motor.requests - requests)/waypoints,
+            "writes per waypoint": (motor.writes_sent - sent)/waypoints,
+            "writes saved per waypoint": (motor.writes_saved - saved)/waypoints,
+            "mean latency": float(np.mean(durations)),
+            "p50 latency": float(np.percentile(durations, 50)),
+            "p99 latency": float(np.percentile(durations, 99)),
+            "max waypoint rate": 1/float(np.mean(durations)),
+        }
+    motor.setVelocityLimit(vel_limit)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark of the serial link to the gantry motor")
+    parser.add_argument("port", help="port of the gantry board, e.g. COM11")
+    parser.add_argument("--waypoints", type=int, default=200)
+    args = parser.parse_args()
+
+    motor = GantryStepper(port=args.port, calibrated=True)
+    for name, result in benchmarkWaypoints(motor, args.waypoints).items():
+        print(name)
+        for key, value in result.items():
+            print(f"  {key}: {value:.6g}")
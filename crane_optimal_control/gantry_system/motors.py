@@ -1,15 +1,232 @@
 import time
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, RLock
 from pytrinamic.evalboards import TMC4671_eval
 from pytrinamic.ic import TMC4671
 import pytrinamic
 from pytrinamic.connections import ConnectionManager
+from pytrinamic.tmcl import TMCLRequest, TMCLReply, TMCLCommand, TMCLReplyStatusError
+from pytrinamic.helpers import to_signed_32
 from numpy import pi
+from .tmc_simulator import isSimulatorPort, simulatorFromPort
+from .calibration import checkCalibration, probeMove
+from .uart_reader import signedTorque
+
+class MotionTimeout(TimeoutError):
+    """
+    Raised when a motor does not settle at its target in time.
+    """
+
+class MotionMonitor:
+    """
+    Detects completion of a motion of a motor, shared by everything that
+    needs to wait for a move to finish.
+
+    A motion is complete when the position stays within
+    position_tolerance [counts] of the target and the velocity below
+    velocity_tolerance [rpm] for settle_time [s]. The polling interval
+    adapts to the expected remaining time of the move: far away from the
+    target the motor is polled rarely, close to it and while settling
+    it is polled every min_interval.
+
+    Listeners added with addListener are called on every completed
+    motion as listener(motor, target, position, duration).
+    """
+
+    def __init__(self, motor, position_tolerance = 100, velocity_tolerance = 2,
+                 settle_time = 0.05, min_interval = 0.005, max_interval = 0.1,
+                 timeout = 30) -> None:
+        self.motor = motor
+        self.position_tolerance = position_tolerance
+        self.velocity_tolerance = velocity_tolerance
+        self.settle_time = settle_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.listeners = []
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
+    def _interval(self, distance, velocity):
+        """
+        polling interval for the given distance to the target [counts]
+        and velocity [rpm]
+        """
+        # velocity in rpm, 65536 counts per revolution
+        speed = abs(velocity)*65536/60
+        if speed < 1:
+            return self.min_interval
+        remaining = distance/speed
+        return min(self.max_interval, max(self.min_interval, remaining/2))
+
+    def wait(self, target, timeout = None):
+        """
+        Blocks until the motor has settled at target [counts].
+
+        Returns
+        -------
+        the final position in counts
+
+        Raises
+        ------
+        MotionTimeout if the motor did not settle within timeout [s],
+        defaults to the timeout of the monitor.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.perf_counter()
+        settled_since = None
+        while True:
+            now = time.perf_counter()
+            position = self.motor.getPosition()
+            velocity = self.motor.getVelocity()
+            distance = abs(target - position)
+            if distance <= self.position_tolerance and abs(velocity) <= self.velocity_tolerance:
+                if settled_since is None:
+                    settled_since = now
+                if now - settled_since >= self.settle_time:
+                    break
+                interval = self.min_interval
+            else:
+                settled_since = None
+                interval = self._interval(distance, velocity)
+            if now - start > timeout:
+                raise MotionTimeout("motor did not reach " + str(target) + " within " + str(timeout)\
+                                    + " s, position is " + str(position))
+            time.sleep(interval)
+
+        duration = time.perf_counter() - start
+        for listener in self.listeners:
+            listener(self.motor, target, position, duration)
+        return position
+
+    def waitAsync(self, target, timeout = None):
+        """
+        Non-blocking version of wait.
+
+        Returns
+        -------
+        concurrent.futures.Future that completes with the final
+        position, or with MotionTimeout.
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.wait(target, timeout))
+            except Exception as e:
+                future.set_exception(e)
+        Thread(target=run, daemon=True).start()
+        return future
+
+class RegisterTransaction:
+    """
+    Queue of register reads and writes of a motor that is flushed in one
+    go. On a TMCL connection (Landungsbrücke) all requests of a flush are
+    sent back to back and the replies are read afterwards, so the flush
+    costs a single serial round trip instead of one per register. Other
+    connections fall back to one round trip per register, but still
+    hold the lock of the motor for the whole flush.
+
+    Consecutive writes to the same register are coalesced, only the last
+    value is sent.
+
+    Use as a context manager, the transaction is flushed on exit:
+
+        with motor.transaction() as tx:
+            tx.write(motor.mc.REG.PID_VELOCITY_LIMIT, 100)
+            pos = tx.read(motor.mc.REG.PID_POSITION_ACTUAL, signed=True)
+        print(tx.results[pos])
+    """
+
+    def __init__(self, motor) -> None:
+        self.motor = motor
+        self.ops = [] # (register, value or None for reads, signed)
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def read(self, register, signed = False):
+        """
+        queues a register read
+
+        Returns
+        -------
+        index of the value in the results of the flush
+        """
+        self.ops.append((register, None, signed))
+        return sum(1 for op in self.ops if op[1] is None) - 1
+
+    def write(self, register, value):
+        """
+        queues a register write
+        """
+        if self.ops and self.ops[-1][0] == register and self.ops[-1][1] is not None:
+            self.ops[-1] = (register, int(value), False)
+        else:
+            self.ops.append((register, int(value), False))
+
+    def flush(self):
+        """
+        executes all queued operations
+
+        Returns
+        -------
+        list with the values of the queued reads, in order
+        """
+        ops, self.ops = self.ops, []
+        self.results = self.motor._execute(ops)
+        return self.results
 
 class Motor(metaclass=ABCMeta):
 
     def __init__(self, port, pulley_circumference, I_max) -> None:
-        self.mc_interface = ConnectionManager(arg_list="--port="+port).connect()
+        self.port = port
+        self._connect()
+
+        # parameters
+        self.pulley_diameter = pulley_circumference
+        self.mm_to_counts = 65536/self.pulley_diameter
+        self.mm_s_to_rpm = 60/self.pulley_diameter
+        self.I_max = int(1000*I_max) # convert amps to mA.
+
+        # the connection is shared by the command thread and the
+        # sampling thread, register access must not interleave.
+        self.lock = RLock()
+
+        # statistics of the serial link: register requests, blocking
+        # round trips and the duration of the last round trips [s]
+        self.requests = 0
+        self.round_trips = 0
+        self.latencies = deque(maxlen=10000)
+        # shadow copy of the last value written to every register, writes
+        # that would not change the register are skipped.
+        self.shadow = {}
+        self.writes_sent = 0
+        self.writes_saved = 0
+
+        # completion detection of moves
+        self.motion = MotionMonitor(self)
+
+        # increase baudrate of UART logging interface
+        # 921600 is the maximum the FTDI adapter does in windows
+        self.board.write_register(self.mc.REG.UART_BPS, 0x00921600)
+        
+    def _connect(self):
+        if isSimulatorPort(self.port):
+            self.mc_interface = simulatorFromPort(self.port)
+        else:
+            self.mc_interface = ConnectionManager(arg_list="--port="+self.port).connect()
 
         if self.mc_interface.supports_tmcl():
             # Create an TMC4671 IC class which communicates over the Landungsbrücke via TMCL
@@ -20,17 +237,50 @@ class Motor(metaclass=ABCMeta):
             self.mc = TMC4671(self.mc_interface)
             # Use IC like an "EVAL" to use this example for both access variants
             self.board = self.mc
+        # requests can only be pipelined over the TMCL protocol
+        self.pipelining = self.mc_interface.supports_tmcl() and hasattr(self.mc_interface, "_send")
 
-        # parameters
-        self.pulley_diameter = pulley_circumference
-        self.mm_to_counts = 65536/self.pulley_diameter
-        self.mm_s_to_rpm = 60/self.pulley_diameter
-        self.I_max = int(1000*I_max) # convert amps to mA.
+    def reconnect(self):
+        """
+        Closes and reopens the connection to the board. The board may
+        have been reset in the meantime, so the shadow registers are
+        invalidated.
+        """
+        with self.lock:
+            try:
+                self.mc_interface.close()
+            except Exception:
+                pass
+            self._connect()
+            self.invalidateShadow()
+
+    def invalidateShadow(self, register = None):
+        """
+        Forgets the shadow copy of register, or of all registers if
+        None. Needed whenever registers are written without _write,
+        e.g. during calibration.
+        """
+        with self.lock:
+            if register is None:
+                self.shadow.clear()
+            else:
+                self.shadow.pop(register, None)
+
+    def _shadowed(self, register, value):
+        """
+        True if writing value to register would not change anything.
+        Also updates the shadow copy and the counters.
+        """
+        if self.shadow.get(register) == value:
+            self.writes_saved += 1
+            return True
+        if register == self.mc.REG.MODE_RAMP_MODE_MOTION:
+            # targets and limits may be reinterpreted in the new mode
+            self.shadow.clear()
+        self.shadow[register] = value
+        self.writes_sent += 1
+        return False
 
-        # increase baudrate of UART logging interface
-        # 921600 is the maximum the FTDI adapter does in windows
-        self.board.write_register(self.mc.REG.UART_BPS, 0x00921600)
-        
     @abstractmethod
     def _motorConfig(self):
         """
@@ -73,47 +323,210 @@ class Motor(metaclass=ABCMeta):
         method to home and calibrate the motor
         """
 
+    def _restoreCalibration(self, saved):
+        """
+        Uses the calibration that is still on the board instead of homing
+        again, if it matches the saved state and a probe move succeeds.
+
+        Parameters
+        ----------
+        saved : dict
+            calibration state, see calibration.readCalibration
+
+        Returns
+        -------
+        True if the calibration could be restored
+        """
+        if saved is None:
+            return False
+        reason = checkCalibration(self, saved)
+        if reason is not None:
+            print("calibration of", self.port, "not restored:", reason)
+            return False
+        if not probeMove(self):
+            print("calibration of", self.port, "not restored: probe move failed")
+            return False
+        print("restored calibration of", self.port, "position", self.getPosition())
+        return True
+
+    def _read(self, register, signed = False):
+        with self.lock:
+            tick = time.perf_counter()
+            value = self.board.read_register(register, signed=signed)
+            self._count(1, 1, time.perf_counter() - tick)
+            return value
+
+    def _write(self, register, value):
+        with self.lock:
+            if self._shadowed(register, value):
+                return
+            tick = time.perf_counter()
+            try:
+                self.board.write_register(register, value)
+            except Exception:
+                # unknown whether the write made it to the board
+                self.invalidateShadow(register)
+                raise
+            self._count(1, 1, time.perf_counter() - tick)
+
+    def _writeField(self, field, value):
+        with self.lock:
+            # read-modify-write, the rest of the register is not known here
+            self.invalidateShadow(field[0])
+            tick = time.perf_counter()
+            self.board.write_register_field(field, value)
+            # read-modify-write
+            self._count(2, 2, time.perf_counter() - tick)
+
+    def _count(self, requests, round_trips, latency):
+        self.requests += requests
+        self.round_trips += round_trips
+        self.latencies.append(latency)
+
+    def _execute(self, ops):
+        """
+        executes a list of (register, value, signed) operations, value
+        None means read. Returns the values of the reads.
+        """
+        if not ops:
+            return []
+        if not self.pipelining:
+            results = []
+            with self.lock:
+                for register, value, signed in ops:
+                    if value is None:
+                        results.append(self._read(register, signed))
+                    else:
+                        self._write(register, value)
+            return results
+
+        conn = self.mc_interface
+        with self.lock:
+            ops = [op for op in ops if op[1] is None or not self._shadowed(op[0], op[1])]
+            requests = [self._registerRequest(TMCLCommand.READ_MC if value is None else TMCLCommand.WRITE_MC,
+                                              register, 0 if value is None else value)
+                        for register, value, signed in ops]
+            if not requests:
+                return []
+            tick = time.perf_counter()
+            try:
+                for request in requests:
+                    conn._send(conn._host_id, request.moduleAddress, request.to_buffer())
+                replies = [TMCLReply.from_buffer(conn._recv(conn._host_id, request.moduleAddress))
+                           for request in requests]
+            except Exception:
+                # unknown which writes made it to the board
+                self.invalidateShadow()
+                raise
+            self._count(len(requests), 1, time.perf_counter() - tick)
+        results = []
+        for (register, value, signed), reply in zip(ops, replies):
+            try:
+                conn._reply_check(reply)
+                if reply.status < 100:
+                    raise TMCLReplyStatusError(reply)
+            except Exception:
+                self.invalidateShadow(register)
+                raise
+            if value is None:
+                results.append(to_signed_32(reply.value) if signed else reply.value)
+        return results
+
+    def _registerRequest(self, command, register, value):
+        """
+        TMCL request for a register access, encoded the same way as
+        pytrinamic does for read_mc/write_mc (channel 0).
+        """
+        address_bit_width = self.mc_interface._default_register_address_bit_width
+        address_shift = 8 - (16 - address_bit_width)
+        address_mask = ((2**address_bit_width) - 1) << 8
+        motor = (register & address_mask) >> address_shift
+        return TMCLRequest(self.board._module_id, command, register & 0xFF, motor, value)
+
+    def transaction(self):
+        """
+        Returns a new RegisterTransaction on this motor
+        """
+        return RegisterTransaction(self)
+
+    def readState(self):
+        """
+        Reads position [counts], velocity [rpm] and torque (signed
+        torque part of PID_TORQUE_FLUX_ACTUAL) in one transaction.
+
+        Returns
+        -------
+        tuple (position, velocity, torque)
+        """
+        with self.transaction() as tx:
+            tx.read(self.mc.REG.PID_POSITION_ACTUAL, signed=True)
+            tx.read(self.mc.REG.PID_VELOCITY_ACTUAL, signed=True)
+            tx.read(self.mc.REG.PID_TORQUE_FLUX_ACTUAL)
+        position, velocity, torque_flux = tx.results
+        return position, velocity, signedTorque(torque_flux)
+
     def setTorqueMode(self):
-        self.board.write_register(self.mc.REG.MODE_RAMP_MODE_MOTION, self.mc.ENUM.MOTION_MODE_TORQUE)
+        self._write(self.mc.REG.MODE_RAMP_MODE_MOTION, self.mc.ENUM.MOTION_MODE_TORQUE)
 
     def setVelocityMode(self):
         #self.board.write_register(self.mc.REG.MODE_RAMP_MODE_MOTION, self.mc.ENUM.MOTION_MODE_VELOCITY)
-        self.board.write_register(self.mc.REG.MODE_RAMP_MODE_MOTION, 0x00000002)
+        self._write(self.mc.REG.MODE_RAMP_MODE_MOTION, 0x00000002)
     
     def setPositionMode(self):
-        self.board.write_register(self.mc.REG.MODE_RAMP_MODE_MOTION, self.mc.ENUM.MOTION_MODE_POSITION)
+        self._write(self.mc.REG.MODE_RAMP_MODE_MOTION, self.mc.ENUM.MOTION_MODE_POSITION)
 
     def setTorque(self, tgt):
         """
         Function assumes user has put printer in torque mode with setTorqueMode!
         """
-        self.board.write_register_field(self.mc.FIELD.PID_TORQUE_TARGET, int(tgt))
-        self.board.write_register_field(self.mc.FIELD.PID_FLUX_TARGET, 0)
+        self._writeField(self.mc.FIELD.PID_TORQUE_TARGET, int(tgt))
+        self._writeField(self.mc.FIELD.PID_FLUX_TARGET, 0)
 
     def getTorque(self):
-        return self.board.read_register(self.mc.REG.PID_TORQUE_FLUX_ACTUAL, signed=True)
+        return self._read(self.mc.REG.PID_TORQUE_FLUX_ACTUAL, signed=True)
 
     def getVelocity(self):
-        return self.board.read_register(self.mc.REG.PID_VELOCITY_ACTUAL, signed=True)
+        return self._read(self.mc.REG.PID_VELOCITY_ACTUAL, signed=True)
 
     def getPosition(self):
-        return self.board.read_register(self.mc.REG.PID_POSITION_ACTUAL, signed=True)
+        return self._read(self.mc.REG.PID_POSITION_ACTUAL, signed=True)
 
     def setLimits(self, acc, vel):
-        self.board.write_register(self.mc.REG.PID_ACCELERATION_LIMIT, int(acc))
-        self.board.write_register(self.mc.REG.PID_VELOCITY_LIMIT, int(vel))
+        self._write(self.mc.REG.PID_ACCELERATION_LIMIT, int(acc))
+        self._write(self.mc.REG.PID_VELOCITY_LIMIT, int(vel))
 
     def setAccelLimit(self, acc):
-        self.board.write_register(self.mc.REG.PID_ACCELERATION_LIMIT, int(acc))
+        self._write(self.mc.REG.PID_ACCELERATION_LIMIT, int(acc))
 
     def setVelocityLimit(self, vel):
-        self.board.write_register(self.mc.REG.PID_VELOCITY_LIMIT, int(vel))
+        self._write(self.mc.REG.PID_VELOCITY_LIMIT, int(vel))
 
     def setPosition(self, pos):
-        self.board.write_register(self.mc.REG.PID_POSITION_TARGET, int(pos))
+        self._write(self.mc.REG.PID_POSITION_TARGET, int(pos))
+
+    def clampPosition(self, pos):
+        """
+        Returns pos [counts] limited to the position limits of the
+        board. The board clamps position targets to these limits, so
+        waiting for an unclamped target outside them never completes.
+        """
+        with self.transaction() as tx:
+            tx.read(self.mc.REG.PID_POSITION_LIMIT_LOW, signed=True)
+            tx.read(self.mc.REG.POSITION_LIMIT_HIGH, signed=True)
+        low, high = tx.results
+        if low >= high:
+            return int(pos)
+        return min(max(int(pos), low), high)
+
+    def waitForTarget(self, target, timeout = None):
+        """
+        Blocks until the motor has settled at target [counts], see
+        MotionMonitor.wait
+        """
+        return self.motion.wait(target, timeout)
 
     def setVelocity(self, vel):
-        self.board.write_register(self.mc.REG.PID_VELOCITY_TARGET, int(vel))
+        self._write(self.mc.REG.PID_VELOCITY_TARGET, int(vel))
 
 class Stepper(Motor, metaclass=ABCMeta):
 
@@ -163,7 +576,7 @@ class Stepper(Motor, metaclass=ABCMeta):
 
 class GantryStepper(Stepper):
 
-    def __init__(self, port, calibrated=False, I_max = 1) -> None:
+    def __init__(self, port, calibrated=False, I_max = 1, calibration = None) -> None:
         super().__init__(port, pulley_diameter=40, I_max=I_max)
         self._motorConfig()
         self._ADCConfig()
@@ -172,13 +585,17 @@ class GantryStepper(Stepper):
         self._PIConfig()
         self._feedbackSelection()
 
-        if not calibrated:
+        if self._restoreCalibration(calibration):
+            pass
+        elif not calibrated:
             self._homeAndCalibrate()
         else:
             self.setPositionMode()
             print("current position:", self.getPosition())
             print("setting position to 0")
             while(round(self.getPosition(),-2) !=0):
+                # resend the target on every attempt, the shadow would skip it
+                self.invalidateShadow(self.mc.REG.PID_POSITION_TARGET)
                 self.setPosition(0)
                 time.sleep(4)
             print("current position:", self.getPosition())
@@ -286,15 +703,18 @@ class GantryStepper(Stepper):
         # potential todo: if whole range of gantry is needed, I should switch to velocity mode here and 
         # home a second time, but since I'm only losing about 0.5 cm I think this would just lenthen the startup process.
 
+        # registers were written directly, shadow copies are outdated
+        self.invalidateShadow()
+
     def _testMove(self):
         self.setPositionMode()
         # Rotate right
-        self.board.write_register(self.mc.REG.PID_POSITION_TARGET, 400000)
+        self.setPosition(400000)
         time.sleep(2)
         # print(self.board.read_register(self.mc.REG.PID_POSITION_ACTUAL))
 
         # Rotate left
-        self.board.write_register(self.mc.REG.PID_POSITION_TARGET, 0)
+        self.setPosition(0)
         time.sleep(2)
         # print(self.board.read_register(self.mc.REG.PID_POSITION_ACTUAL))
 
@@ -303,7 +723,7 @@ class GantryStepper(Stepper):
 
 class HoistStepper(Stepper):
 
-    def __init__(self, port, calibrated=False, I_max = 1) -> None:
+    def __init__(self, port, calibrated=False, I_max = 1, calibration = None) -> None:
         super().__init__(port, pulley_diameter=21*pi, I_max = I_max)
         self._motorConfig()
         self._ADCConfig()
@@ -312,7 +732,9 @@ class HoistStepper(Stepper):
         self._PIConfig()
         self._feedbackSelection()
 
-        if not calibrated:
+        if self._restoreCalibration(calibration):
+            pass
+        elif not calibrated:
             self._homeAndCalibrate()
         else:
             self.setPositionMode()
@@ -399,16 +821,19 @@ class HoistStepper(Stepper):
         # top of container is at 150 cm, but center of mass is at 140
         # self.board.write_register(self.mc.REG.PID_POSITION_ACTUAL, int(130/21.22*65536))
 
+        # registers were written directly, shadow copies are outdated
+        self.invalidateShadow()
+
 
     def _testMove(self):
         self.setPositionMode()
         # Rotate right
-        self.board.write_register(self.mc.REG.PID_POSITION_TARGET, 65536)
+        self.setPosition(65536)
         time.sleep(2)
         # print(self.board.read_register(self.mc.REG.PID_POSITION_ACTUAL))
 
         # Rotate left
-        self.board.write_register(self.mc.REG.PID_POSITION_TARGET, 0)
+        self.setPosition(0)
         time.sleep(2)
         # print(self.board.read_register(self.mc.REG.PID_POSITION_ACTUAL))
 
@@ -0,0 +1,178 @@
+# vectorized encoding of rows for PostgreSQL binary COPY, used by the
+# database writer to store measurements and trajectories.
+#
+# A binary COPY stream is a header, the rows and a trailer. Every row is
+# the number of fields (int16) followed by, per field, its length (int32)
+# and its value in network byte order. For fixed width columns and a
+# constant text column per block, all rows of a block have the same
+# layout, so a block is encoded as one numpy structured array.
+
+import struct
+import numpy as np
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+
+# PostgreSQL timestamps are microseconds since 2000-01-01
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+# the database stores times of a run relative to datetime.min
+DATETIME_MIN = np.datetime64("0001-01-01T00:00:00", "us")
+
+# information_schema data_type to numpy type of the binary value
+FIXED_TYPES = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double precision": ">f8",
+    "timestamp without time zone": ">i8",
+    "timestamp with time zone": ">i8",
+}
+TEXT_TYPES = ("text", "character varying", "character")
+
+
+def relativeTimestamps(seconds):
+    """
+    datetime.min + timedelta(seconds=t) for an array of t, as a
+    datetime64[us] array
+    """
+    us = np.round(np.asarray(seconds, dtype=float)*1e6).astype(np.int64)
+    return DATETIME_MIN + us.astype("timedelta64[us]")
+
+def columnTypes(conn, table, columns):
+    """
+    data types of columns of table, as in information_schema.columns
+
+    Returns
+    -------
+    list of type names, in the order of columns
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT column_name, data_type FROM information_schema.columns \
+                    WHERE table_name = %s AND table_schema = ANY(current_schemas(false))",
+                    (table,))
+        types = dict(cur.fetchall())
+    missing = [c for c in columns if c not in types]
+    if missing:
+        raise ValueError("table " + table + " has no columns " + str(missing))
+    return [types[c] for c in columns]
+
+
+class BinaryCopyEncoder:
+    """
+    Encodes blocks of rows for COPY ... FROM STDIN (FORMAT BINARY).
+
+    Every column is given as a numpy array with one value per row or a
+    scalar that is the same for all rows. Text columns must be scalars.
+    Only the rows are encoded, the caller writes PGCOPY_HEADER before
+    the first block and PGCOPY_TRAILER after the last one.
+
+        encoder = BinaryCopyEncoder(columnTypes(conn, "measurement", columns))
+        with cur.copy("COPY measurement (...) FROM STDIN (FORMAT BINARY)") as copy:
+            copy.write(PGCOPY_HEADER + encoder.encodeRows(values) + PGCOPY_TRAILER)
+    """
+
+    def __init__(self, types) -> None:
+        """
+        Parameters
+        ----------
+        types : list of String
+            data types of the columns, as returned by columnTypes
+
+        Raises
+        ------
+        ValueError if a column type can not be encoded
+        """
+        for t in types:
+            if t not in FIXED_TYPES and t not in TEXT_TYPES:
+                raise ValueError("no binary encoding for column type " + t)
+        self.types = list(types)
+
+    def _encodeColumn(self, column_type, value):
+        if column_type.startswith("timestamp"):
+            value = np.asarray(value)
+            if not np.issubdtype(value.dtype, np.datetime64):
+                raise TypeError("timestamp columns need datetime64 values")
+            return (value.astype("datetime64[us]") - PG_EPOCH).astype(np.int64), FIXED_TYPES[column_type]
+        if column_type in TEXT_TYPES:
+            if not isinstance(value, (str, bytes)) or len(value) == 0:
+                raise TypeError("text columns need a single, non-empty str per block")
+            value = value.encode() if isinstance(value, str) else value
+            return np.bytes_(value), "S" + str(len(value))
+        if np.ndim(value) == 0 and column_type in ("smallint", "integer", "bigint"):
+            value = int(value)
+        return value, FIXED_TYPES[column_type]
+
+    def encodeRows(self, values):
+        """
+        Parameters
+        ----------
+        values : list
+            one array or scalar per column
+
+        Returns
+        -------
+        bytes with the encoded rows
+        """
+        encoded = [self._encodeColumn(t, v) for t, v in zip(self.types, values)]
+        n = max((len(v) for v, _ in encoded if np.ndim(v) == 1), default=1)
+        fields = [("n", ">i2")]
+        for i, (value, fmt) in enumerate(encoded):
+            fields += [("l" + str(i), ">i4"), ("v" + str(i), fmt)]
+        rows = np.empty(n, dtype=np.dtype(fields))
+        rows["n"] = len(encoded)
+        for i, (value, fmt) in enumerate(encoded):
+            rows["l" + str(i)] = np.dtype(fmt).itemsize
+            rows["v" + str(i)] = value
+        return rows.tobytes()
+
+
+class CopyBatch:
+    """
+    Encoded rows for several tables, gathered over one or more writes and
+    sent with one binary COPY per table on flush.
+
+        batch = CopyBatch(conn)
+        batch.add("measurement", columns, encoder.encodeRows(values), rows)
+        batch.flush()
+        conn.commit()
+    """
+
+    def __init__(self, connection) -> None:
+        self.connection = connection
+        # (table, columns): list of encoded blocks
+        self.blocks = {}
+        self.rows = 0
+
+    def add(self, table, columns, block, rows):
+        """
+        adds a block of rows as returned by BinaryCopyEncoder.encodeRows
+        """
+        self.blocks.setdefault((table, tuple(columns)), []).append(block)
+        self.rows += rows
+
+    def mark(self):
+        """
+        Returns
+        -------
+        the current content, to undo later additions with reset
+        """
+        return {key: len(blocks) for key, blocks in self.blocks.items()}, self.rows
+
+    def reset(self, mark):
+        counts, self.rows = mark
+        self.blocks = {key: blocks[:counts[key]] for key, blocks in self.blocks.items() if counts.get(key)}
+
+    def flush(self):
+        """
+        COPYs the gathered rows, one COPY per table
+        """
+        with self.connection.cursor() as cur:
+            for (table, columns), blocks in self.blocks.items():
+                with cur.copy("COPY " + table + " (" + ", ".join(columns) + ") FROM STDIN (FORMAT BINARY)") as copy:
+                    copy.write(PGCOPY_HEADER)
+                    for block in blocks:
+                        copy.write(block)
+                    copy.write(PGCOPY_TRAILER)
+        self.blocks = {}
+        self.rows = 0
@@ -0,0 +1,119 @@
+# simulated gantry crane plant, used by the MockGantryController to
+# produce realistic measurements without hardware.
+
+import yaml
+import numpy as np
+from scipy.constants import g
+
+
+class CranePlant:
+    """
+    Nonlinear cart-pendulum model of the gantry crane, the same
+    dynamics that the TrajectoryGenerator uses to plan trajectories,
+    with a pendulum damping term added:
+
+        theta'' = -g sin(theta)/r - dp/(mp r^2) theta' - x'' cos(theta)/r
+
+    The cart is not driven by the ideal acceleration, but follows the
+    commanded position through a first-order position loop with time
+    constant tau, which gives tracking error and residual swing like
+    the real crane. Measured position and angle are quantized to the
+    resolution of the encoder and angle sensor.
+
+    The model is integrated with a fixed step RK4 scheme. All states
+    are numpy arrays, so a batch of initial conditions (e.g.
+    replications) is integrated in one go.
+    """
+
+    def __init__(self, properties_file) -> None:
+        """
+        Parameters
+        ----------
+        properties_file : String
+            path to the properties file of the gantrycrane
+        """
+        with open(properties_file, 'r') as f:
+            props = yaml.safe_load(f)
+            self.mp = props["pendulum mass"]
+            self.dp = props["pendulum damping"]
+            self.r = props["rope length"]
+            self.v_cart_lim = props["cart velocity limit"]
+            self.tau = props.get("position loop time constant", 0.02)
+            self.dt = props.get("plant step", 0.001)
+            # encoder: 65536 counts per revolution of the 40 mm pulley
+            self.x_resolution = props.get("position resolution", 0.040/65536)
+            self.theta_resolution = props.get("angle resolution", 0.0017)
+
+    def _derivatives(self, x, theta, omega, x_ref, v_ref):
+        """
+        derivatives of the states for the commanded position x_ref and
+        velocity v_ref. Returns (x', theta', omega') and the cart
+        acceleration.
+        """
+        v = np.clip((x_ref - x)/self.tau, -self.v_cart_lim, self.v_cart_lim)
+        a = (v_ref - v)/self.tau
+        alpha = -g*np.sin(theta)/self.r \
+                - self.dp/(self.mp*self.r**2)*omega \
+                - a*np.cos(theta)/self.r
+        return v, omega, alpha, a
+
+    def simulate(self, traj, x0 = None, theta0 = 0, omega0 = 0):
+        """
+        simulates execution of a trajectory
+
+        Parameters
+        ----------
+        traj : tuple
+            trajectory as returned by generateTrajectory, only the
+            sample times, positions and velocities are used as command
+        x0, theta0, omega0 : float or np.array
+            initial state, x0 defaults to the start of the trajectory.
+            Passing arrays simulates a batch of initial conditions.
+
+        Returns
+        -------
+        tuple(ts, x, v, a, theta, omega), sampled at the trajectory
+        sample times. For a batch, every quantity except ts has shape
+        (batch size, len(ts)).
+        """
+        ts = np.asarray(traj[0], dtype=float)
+        xs = np.asarray(traj[1], dtype=float)
+        vs = np.asarray(traj[2], dtype=float)
+        if x0 is None:
+            x0 = xs[0]
+        x0, theta0, omega0 = np.broadcast_arrays(np.asarray(x0, dtype=float),
+                                                 np.asarray(theta0, dtype=float),
+                                                 np.asarray(omega0, dtype=float))
+        x, theta, omega = x0.astype(float), theta0.astype(float), omega0.astype(float)
+
+        # command on the integration grid, including the half steps of RK4
+        n = int(np.ceil((ts[-1] - ts[0])/self.dt))
+        grid = ts[0] + self.dt*np.arange(2*n + 1)/2
+        x_ref = np.interp(grid, ts, xs)
+        v_ref = np.interp(grid, ts, vs)
+
+        out = np.empty((5, n + 1) + x.shape)
+        h = self.dt
+        for k in range(n):
+            i = 2*k
+            d1 = self._derivatives(x, theta, omega, x_ref[i], v_ref[i])
+            out[:, k] = (x, d1[0], d1[3], theta, omega)
+            d2 = self._derivatives(x + h/2*d1[0], theta + h/2*d1[1], omega + h/2*d1[2], x_ref[i+1], v_ref[i+1])
+            d3 = self._derivatives(x + h/2*d2[0], theta + h/2*d2[1], omega + h/2*d2[2], x_ref[i+1], v_ref[i+1])
+            d4 = self._derivatives(x + h*d3[0], theta + h*d3[1], omega + h*d3[2], x_ref[i+2], v_ref[i+2])
+            x = x + h/6*(d1[0] + 2*d2[0] + 2*d3[0] + d4[0])
+            theta = theta + h/6*(d1[1] + 2*d2[1] + 2*d3[1] + d4[1])
+            omega = omega + h/6*(d1[2] + 2*d2[2] + 2*d3[2] + d4[2])
+        d = self._derivatives(x, theta, omega, x_ref[-1], v_ref[-1])
+        out[:, n] = (x, d[0], d[3], theta, omega)
+
+        # resample to the trajectory sample times, batch dimension first
+        t_grid = grid[::2]
+        out = np.moveaxis(out, 1, -1)
+        x, v, a, theta, omega = (np.apply_along_axis(lambda q: np.interp(ts, t_grid, q), -1, o) for o in out)
+
+        # sensor quantization
+        x = np.round(x/self.x_resolution)*self.x_resolution
+        theta = np.round(theta/self.theta_resolution)*self.theta_resolution
+
+        return (ts, x, v, a, theta, omega)
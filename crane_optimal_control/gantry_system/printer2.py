@@ -4,8 +4,13 @@
 import time
 from datetime import datetime, timedelta
 import numpy as np
-from .motors import GantryStepper, HoistStepper
-import re
+from .motors import GantryStepper, HoistStepper, MotionTimeout
+from .scheduler import WaypointScheduler
+from .sampling import RingBuffer, Sampler
+from .angle_reader import AngleReader
+from .calibration import CalibrationStore, readCalibration
+from .axis_worker import AxisWorker
+from .uart_reader import UartStateReader
 import serial
 
 from pytrinamic.connections import ConnectionManager
@@ -14,18 +19,53 @@ from scipy.signal import savgol_filter
 from scipy.signal import correlate
 
 import logging
+
+# sensor angle (degrees, sign flipped by readAngle) to rad, 0.806 is the
+# experimentally derived scaling factor of the angle sensor
+ANGLE_SCALE = -1/0.806*2*np.pi/360
+
 class Printer:
     """
     Class to control the 3D printer.
     """
 
-    def __init__(self, gantryPort, hoistPort, angleUARTPort, gantryUARTPort, calibrated = False, I_max = 1) -> None:
+    def __init__(self, gantryPort, hoistPort, angleUARTPort, gantryUARTPort, calibrated = False, I_max = 1,
+                 sampling_rate = 200, max_move_duration = 60, angle_protocol = "ascii", angle_baudrate = 115200,
+                 calibration_file = None, derived_omega = False, uart_sampling_rate = 1000) -> None:
         
+        # calibration state of a previous run, the motors only home and
+        # calibrate if the boards no longer hold that calibration.
+        calibrationStore = CalibrationStore(calibration_file) if calibration_file is not None else None
+        saved = calibrationStore.load() if calibrationStore is not None else {}
+
         # create motors
-        self.gantryStepper = GantryStepper(port=gantryPort, calibrated=calibrated, I_max= I_max)
-        self.hoistStepper = HoistStepper(port=hoistPort, calibrated=calibrated)
+        self.gantryStepper = GantryStepper(port=gantryPort, calibrated=calibrated, I_max= I_max, calibration=saved.get("gantry"))
+        self.hoistStepper = HoistStepper(port=hoistPort, calibrated=calibrated, calibration=saved.get("hoist"))
+        if calibrationStore is not None:
+            calibrationStore.save({"gantry": readCalibration(self.gantryStepper),
+                                   "hoist": readCalibration(self.hoistStepper)})
+        # the axes are on separate serial links, each gets its own I/O
+        # thread such that they can move and be read at the same time.
+        self.gantryIO = AxisWorker(self.gantryStepper, "gantry")
+        self.hoistIO = AxisWorker(self.hoistStepper, "hoist")
         # set waypoints to empty
         self.waypoints = []
+        # releases the waypoints at their deadlines
+        self.scheduler = WaypointScheduler()
+        # position, velocity and torque of the gantry are read over the
+        # UART logging interface of the board if it is connected, which
+        # leaves the TMCL link for the setpoints and allows a higher rate.
+        if gantryUARTPort is not None:
+            self.gantryUART = UartStateReader.open(gantryUARTPort)
+            sampling_rate = uart_sampling_rate
+        else:
+            self.gantryUART = None
+        # the state of the crane is logged by a separate thread at
+        # sampling_rate [Hz] into a buffer that holds max_move_duration [s]
+        self.sampling_rate = sampling_rate
+        self.samples = RingBuffer(sampling_rate*max_move_duration, ["t", "x", "v", "theta", "omega", "a", "torque"])
+        # also derive omega from theta after a move, to compare with the sensor
+        self.derived_omega = derived_omega
 
         # write baudrate register via SPI interface
         # This is done in the constructor of the motor object over the
@@ -33,31 +73,29 @@ class Printer:
 
         # create serial connections for logging, or None if no logging is needed.
         if angleUARTPort is not None:
-            self.angleUART = serial.Serial(angleUARTPort, 115200)
+            self.angleUART = serial.Serial(angleUARTPort, angle_baudrate)
+            self.angleReader = AngleReader(self.angleUART, protocol=angle_protocol)
         else:
             self.angleUART = None
-        # self.gantryUART = ConnectionManager(arg_list="--interface=uart_ic --data-rate=921600 --port="+gantryUARTPort).connect()
-        # self.mc = TMC4671(self.gantryUART)
-
-        # angle pattern regex
-        self.pattern = re.compile(r"(-?\d*\.\d*) (-?\d*\.\d*) (-?\d*\.\d*)\r\n")
+            self.angleReader = None
 
         # last angle
         self.lastAngle = 0
         self.lastAccel = 0
         self.lastOmega = 0
 
-        self.buffer = ""
-
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.gantryIO.stop()
+        self.hoistIO.stop()
         self.gantryStepper.mc_interface.close()
         self.hoistStepper.mc_interface.close()
         if self.angleUART is not None:
             self.angleUART.close()
-        self.gantryUART.close()
+        if self.gantryUART is not None:
+            self.gantryUART.close()
 
     def setWaypoints(self, waypoints):
         self.waypoints = waypoints
@@ -67,106 +105,251 @@ class Printer:
         Attempt to execute the waypoints in position mode,
         works with "global" timing rather than delta timing.
 
+        Returns
+        -------
+        tuple (t, x, v, a, theta, omega), the measurement
+        dict, timing report of the scheduler, see WaypointScheduler.report,
+        with the durations of the serial round trips in "latencies" [s]
         """
         self.gantryStepper.setPositionMode()
 
         # logging:
-        # we can log the following: t, x, v, theta
-        # omega is not logged but is calculated afterwards
-        # by differentiating theta w.r.t. t
-
-        # assume t = 0
-        t = [0]
-        x = [self.gantryStepper.getPosition()/self.gantryStepper.mm_to_counts]
-        v = [0]
-        theta = [0]
-        omega_arduino = [0]
-        a = [0]
-        wp_dt = []
+        # we log the following: t, x, v, theta, omega, a
+        # in a separate thread, this loop only sends the setpoints.
+        wp_dt = np.empty(len(self.waypoints) - 1)
         # reset angle logger input buffer
-        if self.angleUART is not None:
-            self.angleUART.reset_input_buffer()
+        if self.angleReader is not None:
+            self.angleReader.reset()
+        self.samples.clear()
 
         # set target position
         self.gantryStepper.setAccelLimit(2147483647)
         self.gantryStepper.setVelocityLimit(abs(self.waypoints[1].v*self.gantryStepper.mm_s_to_rpm))
-        t0 = time.time()
-        now = 0
+        round_trips = self.gantryStepper.round_trips
+        self.scheduler.start()
+        sampler = Sampler(self._sample, self.samples, self.sampling_rate, clock=self.scheduler.now)
+        sampler.start()
         self.gantryStepper.setPosition(self.waypoints[-1].x * self.gantryStepper.mm_to_counts)
 
-        for wp in self.waypoints[1:]:
+        for i, wp in enumerate(self.waypoints[1:]):
             
-            wp_start = time.time()
+            wp_start = time.perf_counter()
             # in proper version I must not forget to consider direction of the movement as well.
-            while(now < wp.t):
-                now = time.time() - t0
+            self.scheduler.waitUntil(wp.t)
 
             self.gantryStepper.setVelocityLimit(abs(wp.v)*self.gantryStepper.mm_s_to_rpm)
             
-            # logging
-            
-            t.append(time.time() - t0)
-            tick = time.time()
-            #x.append(self.mc.read_register(self.mc.REG.PID_POSITION_ACTUAL, signed=True))
-            x.append(self.gantryStepper.getPosition()) 
-            #v.append(self.mc.read_register(self.mc.REG.PID_VELOCITY_ACTUAL, signed=True))
-            v.append(self.gantryStepper.getVelocity())
-            dt = time.time() - tick
-            new_a, new_theta, new_omega = self.readAngle()
-            theta.append(new_theta)
-            a.append(new_a)
-            omega_arduino.append(new_omega)
-            
-            #print("logging time:" +str(dt)) 
-            wp_end = time.time()
-            wp_dt.append(wp_end-wp_start)
-
+            wp_end = time.perf_counter()
+            wp_dt[i] = wp_end-wp_start
+
+        sampler.stop()
+        if self.gantryUART is not None and self.gantryUART.errors:
+            logging.warning("gantry UART: " + str(self.gantryUART.errors) + " failed reads")
+        if self.angleReader is not None:
+            logging.info("angle reader: " + str(self.angleReader.counters()))
+        if self.samples.overflowed:
+            logging.warning("move took longer than the sample buffer, the start of the move is lost")
+        samples = self.samples.snapshot()
 
         self.gantryStepper.setTorqueMode()
         # self.hoistStepper.setTorqueMode()
         self.gantryStepper.setTorque(0)
         # self.hoistStepper.setTorque(0)
 
-        # For logging:
+        measurement = self._postProcess(samples)
+
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        t = measurement[0]
+        dt = np.diff(t)
+        logging.info("tstep: " + str(len(t)) + ", max dt: " + str(dt.max() if len(dt) else 0))
+        if debug:
+            logging.debug("wp dt:" + str(wp_dt))
+            logging.debug("dt: " + str(dt))
+            logging.debug("a" + str(measurement[3]))
+
+        report = self.scheduler.report()
+        # duration of the serial round trips to the gantry board during the move
+        moved = min(self.gantryStepper.round_trips - round_trips, len(self.gantryStepper.latencies))
+        report["latencies"] = np.array(self.gantryStepper.latencies)[len(self.gantryStepper.latencies) - moved:]
+        logging.info("waypoint lateness: mean " + str(report["mean lateness"]) + " s, p99 "\
+                     + str(report["p99 lateness"]) + " s, max " + str(report["max lateness"]) + " s")
+
+        return measurement, report
+
+    def _postProcess(self, samples):
+        """
+        converts the raw samples of a move to the measurement, in one
+        vectorized pass over the columns.
+
+        Parameters
+        ----------
+        samples : dict
+            snapshot of the sample buffer, raw units
+
+        Returns
+        -------
+        tuple (t, x, v, a, theta, omega) of numpy arrays in s, m, m/s,
+        m/s^2, rad and rad/s
+        """
+        t = samples["t"]
+        # the snapshot is a copy, convert in place
         # returned angle requires scaling and is expected to be in radians
         # also need to flip the sign
         # (for scaling, see curve_fitting.py in angle-calibration folder)
-        theta = [-1/0.806*angle*2*np.pi/360 for angle in theta] # 0.806 is experimentally derived scaling factor of angle
-        omega_arduino = [-1/0.806*angular_vel*2*np.pi/360 for angular_vel in omega_arduino]
-        # we don't have omega, calculate it with numpy gradient
-        # apply filtering first because taking derivative gets noisy quick
-        omega = np.gradient(savgol_filter(np.array(theta), 15, 6), np.array(t))
-        # x is still in counts and should be in meters
-        x = [xs/self.gantryStepper.mm_to_counts/1000 for xs in x]
-        # v is also in the wrong unit, should m/s^2
-        v = [vs/self.gantryStepper.mm_s_to_rpm/1000 for vs in v]
-
-        logging.info("wp dt:" + str(wp_dt))
-        logging.info("dt: " + str(np.array(t[1:-1]) - np.array(t[0:-2])))
-        logging.info("tstep: " + str(len(t)))
-        logging.info("max dt" + str(max(np.array(t[1:-1]) - np.array(t[0:-2]))))
-        logging.info("a" + str(a))
-
-        logging.info("Comparison between two omegas")
-        logging.info("Arduino based:" + str(omega_arduino))
-        logging.info("derivation based:" + str(omega))
-
-        omega = omega_arduino
+        # 0.806 is experimentally derived scaling factor of angle
+        if self.angleReader is not None:
+            theta, omega, a = self._mergeAngles(t)
+        else:
+            theta, omega, a = samples["theta"], samples["omega"], samples["a"]
+        theta *= ANGLE_SCALE
+        omega *= ANGLE_SCALE
+        # x is in counts and v in rpm, convert to m and m/s
+        x = samples["x"]
+        x *= 1/(self.gantryStepper.mm_to_counts*1000)
+        v = samples["v"]
+        v *= 1/(self.gantryStepper.mm_s_to_rpm*1000)
+
+        if self.derived_omega and len(t) > 15:
+            # omega from the angle, filtered first because taking the
+            # derivative gets noisy quick. Only for comparison with the
+            # sensor.
+            derived = np.gradient(savgol_filter(theta, 15, 6), t)
+            logging.info("derived omega deviates from sensor omega by max "
+                         + str(np.max(np.abs(derived - omega))) + " rad/s")
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Arduino based:" + str(omega))
+                logging.debug("derivation based:" + str(derived))
 
         # there seems to be a small chance that two timestamps are the same,
         # which gives an error when writing to database.
         # Likely has to do with the microsecond accuracy of datetime 
         # solution: round to microseconds, then use numpy unique to filter out duplicates.
-        un, un_idx = np.unique(np.round(np.array(t),6), return_index=True)
-
-        t = np.array(t)[un_idx]
-        theta = np.array(theta)[un_idx]
-        omega = np.array(omega)[un_idx]
-        x = np.array(x)[un_idx]
-        v = np.array(v)[un_idx]
-        a = np.array(a)[un_idx]
-        
-        return (t, x, v, a, theta, omega)
+        _, un_idx = np.unique(np.round(t, 6), return_index=True)
+        if len(un_idx) == len(t):
+            return (t, x, v, a, theta, omega)
+        return tuple(column[un_idx] for column in (t, x, v, a, theta, omega))
+
+    def _sample(self):
+        """
+        one sample of the state of the crane, in raw units, taken by
+        the sampling thread.
+
+        Returns
+        -------
+        tuple (x, v, theta, omega, a, torque), torque is NaN if the
+        gantry UART is not connected
+        """
+        x = None
+        if self.gantryUART is not None:
+            try:
+                x, v, torque = self.gantryUART.readState()
+            except (TimeoutError, IOError) as e:
+                logging.debug("gantry UART: " + str(e) + ", reading over TMCL")
+        if x is None:
+            with self.gantryStepper.transaction() as tx:
+                tx.read(self.gantryStepper.mc.REG.PID_POSITION_ACTUAL, signed=True)
+                tx.read(self.gantryStepper.mc.REG.PID_VELOCITY_ACTUAL, signed=True)
+            x, v = tx.results
+            torque = np.nan
+        a, theta, omega = self.readAngle()
+        return (x, v, theta, omega, a, torque)
+
+    def _mergeAngles(self, t):
+        """
+        interpolates the angle samples received during the move onto the
+        motor sample times t [s since the start of the schedule]. With
+        the binary angle protocol the angle samples carry the time at
+        which the sensor took them, so theta lines up with x without a
+        time shift.
+
+        Returns
+        -------
+        tuple (theta, omega, a), with the sign of theta and omega flipped
+        like readAngle does
+        """
+        angles = self.angleReader.since(self.scheduler.t0)
+        if len(angles["t"]) < 2:
+            logging.warning("no angle samples received during the move")
+            return np.zeros_like(t), np.zeros_like(t), np.zeros_like(t)
+        t_angle = angles["t"] - self.scheduler.t0
+        theta = -1*np.interp(t, t_angle, angles["theta"])
+        omega = -1*np.interp(t, t_angle, angles["omega"])
+        a = np.interp(t, t_angle, angles["a"])
+        return theta, omega, a
+
+    @staticmethod
+    def _moveTo(motor, target, velocity = None):
+        motor.setPositionMode()
+        if velocity is not None:
+            motor.setAccelLimit(2147483647)
+            motor.setVelocityLimit(velocity)
+        clamped = motor.clampPosition(target)
+        if clamped != target:
+            logging.warning("target " + str(target) + " is outside the position limits, moving to " + str(clamped))
+        motor.setPosition(clamped)
+        return motor.waitForTarget(clamped)
+
+    def moveGantry(self, target, velocity = 2000):
+        """
+        starts a position mode move of the gantry on its I/O thread
+
+        Parameters
+        ----------
+        target : int
+            target position [counts]
+        velocity : int
+            velocity limit [rpm]
+
+        Returns
+        -------
+        Future with the final position [counts]
+        """
+        return self.gantryIO.submit(self._moveTo, self.gantryStepper, int(target), velocity)
+
+    def moveHoist(self, target):
+        """
+        starts a move of the hoist to target [counts] on its I/O thread,
+        at the velocity limit of the hoist
+
+        Returns
+        -------
+        Future with the final position [counts]
+        """
+        return self.hoistIO.submit(self._moveTo, self.hoistStepper, int(target))
+
+    def moveAxes(self, gantry = None, hoist = None, velocity = 2000):
+        """
+        moves the gantry and the hoist at the same time, e.g. lowering
+        while traversing, and waits until both are done
+
+        Parameters
+        ----------
+        gantry, hoist : int
+            target positions [counts], None to leave the axis where it is
+        velocity : int
+            velocity limit of the gantry [rpm]
+
+        Returns
+        -------
+        tuple (gantry position, hoist position) [counts], None for an
+        axis that did not move
+        """
+        gantry_move = self.moveGantry(gantry, velocity) if gantry is not None else None
+        hoist_move = self.moveHoist(hoist) if hoist is not None else None
+        return (gantry_move.result() if gantry_move is not None else None,
+                hoist_move.result() if hoist_move is not None else None)
+
+    def readAxes(self):
+        """
+        reads the state of both axes in parallel
+
+        Returns
+        -------
+        tuple of (position, velocity, torque) of the gantry and the hoist
+        """
+        gantry = self.gantryIO.submit(self.gantryStepper.readState)
+        hoist = self.hoistIO.submit(self.hoistStepper.readState)
+        return gantry.result(), hoist.result()
 
     def _testMove(self):
         self.gantryStepper._testMove()
@@ -189,37 +372,27 @@ class Printer:
         self.gantryStepper.setPosition(0)
         self.gantryStepper.setLimits(acc=2147483647, vel=420)
 
-        start = time.time()
-        while(round(self.gantryStepper.getPosition(), -2) != 0 and time.time() - start < 20):
-            pass
+        try:
+            self.gantryStepper.waitForTarget(0, timeout=20)
+        except MotionTimeout as e:
+            logging.warning(str(e))
     
     def readAngle(self):
-        if self.angleUART is not None:
-            # Add incoming data to the buffer
-            self.buffer += self.angleUART.read(self.angleUART.in_waiting).decode('utf-8')
-
-            # Find all matches in the buffer
-            matches = self.pattern.findall(self.buffer)
-
-            # Check if a match is found
-            if matches:
-                last_match = matches[-1]
-
-                a = float(last_match[0])
-                theta = -1* float(last_match[1])
-                omega = -1* float(last_match[2])
-
-                # Remove the parsed data from the buffer, keep only the last (unparsed) part
-                self.buffer = self.buffer.split(last_match[2])[-1]
-
-                self.lastAccel = a 
-                self.lastAngle = theta # * 1/0.76023946 scale factor that might be needed
-                self.lastOmega = omega
-                return a, theta, omega
+        """
+        Returns
+        -------
+        tuple (a, theta, omega) of the newest angle sample, or the
+        previous values if nothing new was received.
+        """
+        if self.angleReader is not None:
+            if self.angleReader.poll():
+                t, a, theta, omega = self.angleReader.latest()
+                self.lastAccel = a
+                self.lastAngle = -1*theta # * 1/0.76023946 scale factor that might be needed
+                self.lastOmega = -1*omega
             else:
-                # No match found, return None
-                logging.info("no match, returning previous values")
-                return self.lastAccel, self.lastAngle, self.lastOmega
+                logging.debug("no new angle, returning previous values")
+            return self.lastAccel, self.lastAngle, self.lastOmega
         else:
             return (0, 0, 0)
 
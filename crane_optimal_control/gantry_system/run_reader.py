@@ -0,0 +1,182 @@
+# bulk reads of stored runs as numpy arrays, the counterpart of the COPY
+# ingestion of the database writer.
+#
+# The samples are read with one binary COPY ... TO STDOUT per table. The
+# query only selects fixed width columns, cast to the types the decoder
+# expects (the quantity as its index in the list of quantities, missing
+# values as NaN), so every row of the stream has the same layout and the whole stream is decoded with one
+# np.frombuffer on a structured dtype.
+
+import struct
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from .pg_copy import PG_EPOCH, DATETIME_MIN
+from .db_schema import QUANTITIES, quantityColumn, schemaOf
+
+# offset of the PostgreSQL epoch from datetime.min, times are stored
+# relative to datetime.min
+EPOCH_OFFSET_US = int((PG_EPOCH - DATETIME_MIN).astype(np.int64))
+
+
+def _copyOut(conn, query, params):
+    with conn.cursor() as cur:
+        with cur.copy(query, params) as copy:
+            return b"".join(copy)
+
+def decodeBinaryCopy(data, fields):
+    """
+    Decodes the output of COPY ... TO STDOUT (FORMAT BINARY) with fixed
+    width, non-NULL columns.
+
+    Parameters
+    ----------
+    data : bytes
+        the COPY stream, header and trailer included
+    fields : list
+        (name, numpy type) per column, e.g. ("value", ">f8")
+
+    Returns
+    -------
+    numpy structured array with a field per column
+    """
+    if data[:11] != b"PGCOPY\n\xff\r\n\x00":
+        raise ValueError("not a binary COPY stream")
+    extension, = struct.unpack(">i", data[15:19])
+    body = data[19 + extension:len(data) - 2]
+    dtype = [("n", ">i2")]
+    for name, fmt in fields:
+        dtype += [("l_" + name, ">i4"), (name, fmt)]
+    rows = np.frombuffer(body, dtype=np.dtype(dtype))
+    if np.any(rows["n"] != len(fields)):
+        raise ValueError("unexpected number of columns in COPY stream")
+    return rows
+
+def _seconds(ts):
+    # microseconds since 2000-01-01 to seconds relative to datetime.min
+    return (ts.astype(np.int64) + EPOCH_OFFSET_US)/1e6
+
+def _splitRuns(run, columns):
+    # splits the columns (sorted by run) into a dict per run
+    starts = np.flatnonzero(np.r_[True, run[1:] != run[:-1]])
+    ends = np.r_[starts[1:], len(run)]
+    return {int(run[s]): {name: values[s:e] for name, values in columns.items()}
+            for s, e in zip(starts, ends)}
+
+def _readNarrow(conn, table, machine_id, runs, quantities):
+    data = _copyOut(conn, "COPY (SELECT run_id::int4, array_position(%s::varchar[], quantity::varchar)::smallint, \
+                    ts::timestamp, value::float8 \
+                    FROM " + table + " WHERE machine_id = %s AND run_id = ANY(%s) \
+                    AND quantity = ANY(%s) AND value IS NOT NULL AND ts IS NOT NULL \
+                    ORDER BY run_id, ts) TO STDOUT (FORMAT BINARY)",
+                    (quantities, machine_id, runs, quantities))
+    rows = decodeBinaryCopy(data, [("run", ">i4"), ("q", ">i2"), ("ts", ">i8"), ("value", ">f8")])
+    if len(rows) == 0:
+        return {}
+    # pivot: one row per (run, ts), a column per quantity
+    run, ts = rows["run"], rows["ts"]
+    new = np.r_[True, (run[1:] != run[:-1]) | (ts[1:] != ts[:-1])]
+    row = np.cumsum(new) - 1
+    pivot = np.full((row[-1] + 1, len(quantities)), np.nan)
+    pivot[row, rows["q"] - 1] = rows["value"]
+    columns = {"t": _seconds(ts[new])}
+    columns.update({q: pivot[:, i] for i, q in enumerate(quantities)})
+    return _splitRuns(run[new], columns)
+
+def _readWide(conn, table, machine_id, runs, quantities):
+    columns = ", ".join("coalesce(" + quantityColumn(q) + ", 'NaN')::float8" for q in quantities)
+    data = _copyOut(conn, "COPY (SELECT run_id::int4, ts::timestamp, " + columns + " FROM " + table + "_wide \
+                    WHERE machine_id = %s AND run_id = ANY(%s) AND ts IS NOT NULL \
+                    ORDER BY run_id, ts) TO STDOUT (FORMAT BINARY)",
+                    (machine_id, runs))
+    fields = [("run", ">i4"), ("ts", ">i8")] + [("q" + str(i), ">f8") for i in range(len(quantities))]
+    rows = decodeBinaryCopy(data, fields)
+    if len(rows) == 0:
+        return {}
+    columns = {"t": _seconds(rows["ts"])}
+    columns.update({q: rows["q" + str(i)].astype(float) for i, q in enumerate(quantities)})
+    return _splitRuns(rows["run"], columns)
+
+def readRuns(conn, machine_id, runs, table = "measurement", wide = None):
+    """
+    Reads runs of a machine from table measurement or trajectory.
+
+    Parameters
+    ----------
+    machine_id : int
+    runs : list of int
+        run ids
+    table : String
+        measurement or trajectory
+    wide : bool
+        whether the database has the wide layout (see db_schema), None to
+        look it up
+
+    Returns
+    -------
+    dict of run id to dict with "t", the sample times [s], and an array
+    per quantity, NaN where a quantity has no sample. Runs without
+    samples are left out.
+    """
+    if wide is None:
+        wide = schemaOf(conn, table) == "wide"
+    runs = [int(run) for run in runs]
+    read = _readWide if wide else _readNarrow
+    return read(conn, table, machine_id, runs, QUANTITIES[table])
+
+
+class RunReader:
+    """
+    readRuns with an LRU cache of the runs that were read last.
+
+    Runs are stored once, so cached runs only change when a run is
+    stored again; the database writer calls invalidate when it stores a
+    run.
+    """
+
+    def __init__(self, cache_runs = 0) -> None:
+        """
+        Parameters
+        ----------
+        cache_runs : int
+            number of (table, machine, run) entries to keep, 0 for no cache
+        """
+        self.cache_runs = cache_runs
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, conn, machine_id, runs, table = "measurement", wide = None):
+        """
+        readRuns, with the runs in the cache taken from there
+        """
+        result = {}
+        missing = []
+        with self.lock:
+            for run in runs:
+                key = (table, machine_id, int(run))
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    result[int(run)] = self.cache[key]
+                    self.hits += 1
+                else:
+                    missing.append(int(run))
+                    self.misses += 1
+        if missing:
+            read = readRuns(conn, machine_id, missing, table, wide)
+            result.update(read)
+            if self.cache_runs > 0:
+                with self.lock:
+                    for run, columns in read.items():
+                        # shared by all readers of the run
+                        for values in columns.values():
+                            values.flags.writeable = False
+                        self.cache[(table, machine_id, run)] = columns
+                    while len(self.cache) > self.cache_runs:
+                        self.cache.popitem(last=False)
+        return result
+
+    def invalidate(self, table, machine_id, run):
+        with self.lock:
+            self.cache.pop((table, machine_id, int(run)), None)
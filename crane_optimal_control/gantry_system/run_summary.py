@@ -0,0 +1,152 @@
+# per run and per quantity aggregates of the measurements and trajectories,
+# kept in table run_summary so dashboards and validators read a few rows
+# per run instead of all samples. The database writer computes them while
+# it ingests a run, backfill computes them in SQL for existing runs.
+#
+# usage: python -m gantry_system.run_summary backfill [--all]
+
+import argparse
+import numpy as np
+import yaml
+from .db_schema import dsnFromProperties
+
+# aggregates per quantity, in the order of the columns of run_summary
+SUMMARY_COLUMNS = ["samples", "duration", "min", "max", "mean_abs", "rms", "peak_abs", "final"]
+# the same aggregates in SQL, over the narrow layout (ts, value)
+SUMMARY_SQL = [
+    "count(*)",
+    "extract(epoch FROM max(ts) - min(ts))",
+    "min(value)",
+    "max(value)",
+    "avg(abs(value))",
+    "sqrt(avg(value*value))",
+    "max(abs(value))",
+    "(array_agg(value ORDER BY ts DESC))[1]",
+]
+KEYS = ["run_id", "machine_id", "source", "quantity"]
+
+
+def summarize(data, quantities):
+    """
+    Aggregates of a measurement or trajectory.
+
+    Parameters
+    ----------
+    data : tuple
+        (t, quantity 1, quantity 2, ...), t in seconds
+    quantities : list of String
+        names of the quantities in data
+
+    Returns
+    -------
+    dict of quantity to dict with the SUMMARY_COLUMNS, None where a
+    quantity has no samples
+    """
+    t = np.asarray(data[0], dtype=float)
+    summary = {}
+    for idx, quantity in enumerate(quantities, 1):
+        values = np.asarray(data[idx], dtype=float)
+        # NaN samples are left out, also of the duration, as in backfill
+        finite = np.isfinite(values)
+        values = values[finite]
+        if len(values) == 0:
+            summary[quantity] = dict.fromkeys(SUMMARY_COLUMNS)
+            summary[quantity]["samples"] = 0
+            continue
+        magnitude = np.abs(values)
+        times = t[finite]
+        summary[quantity] = {
+            "samples": len(values),
+            "duration": float(times[-1] - times[0]),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean_abs": float(magnitude.mean()),
+            "rms": float(np.sqrt(np.mean(values*values))),
+            "peak_abs": float(magnitude.max()),
+            "final": float(values[-1]),
+        }
+    return summary
+
+def createRunSummaryTable(conn):
+    """
+    Creates table run_summary if it does not exist yet. source is
+    measurement or trajectory, final_error is the final value of the
+    measurement minus that of the trajectory.
+    """
+    columns = ", ".join(c + (" integer" if c == "samples" else " double precision") for c in SUMMARY_COLUMNS)
+    with conn.cursor() as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS run_summary \
+                    (run_id integer, machine_id integer, source varchar(20), quantity varchar(20), \
+                    " + columns + ", final_error double precision, \
+                    PRIMARY KEY (run_id, machine_id, source, quantity))")
+
+def updateFinalErrors(conn, where = "", params = ()):
+    """
+    sets final_error of the measurement rows that have a trajectory row,
+    optionally restricted by a condition on m (the measurement rows)
+    """
+    with conn.cursor() as cur:
+        cur.execute("UPDATE run_summary m SET final_error = m.final - t.final \
+                    FROM run_summary t \
+                    WHERE m.source = 'measurement' AND t.source = 'trajectory' \
+                    AND t.run_id = m.run_id AND t.machine_id = m.machine_id \
+                    AND t.quantity = m.quantity" + where, params)
+
+def _upsert(columns):
+    return "ON CONFLICT (" + ", ".join(KEYS) + ") DO UPDATE SET " \
+           + ", ".join(c + " = EXCLUDED." + c for c in columns)
+
+def storeSummary(conn, machine_id, run, source, summary):
+    """
+    upserts the summary of a run as returned by summarize, source is
+    measurement or trajectory
+    """
+    rows = [[int(run), machine_id, source, quantity] + [aggregates[c] for c in SUMMARY_COLUMNS]
+            for quantity, aggregates in summary.items()]
+    with conn.cursor() as cur:
+        cur.executemany("INSERT INTO run_summary (" + ", ".join(KEYS + SUMMARY_COLUMNS) + ") \
+                        VALUES (" + ", ".join(["%s"]*len(KEYS + SUMMARY_COLUMNS)) + ") " + _upsert(SUMMARY_COLUMNS),
+                        rows)
+    updateFinalErrors(conn, " AND m.run_id = %s AND m.machine_id = %s", (int(run), machine_id))
+
+def backfill(conn, missing_only = True):
+    """
+    Computes the summaries of the runs in measurement and trajectory in
+    SQL, for all runs or only those without a summary.
+
+    Returns
+    -------
+    number of run_summary rows written
+    """
+    rows = 0
+    for source in ("measurement", "trajectory"):
+        # NaN samples are left out, as in summarize
+        condition = " WHERE value <> 'NaN'"
+        if missing_only:
+            condition += " AND NOT EXISTS (SELECT 1 FROM run_summary r \
+                        WHERE r.run_id = s.run_id AND r.machine_id = s.machine_id \
+                        AND r.source = '" + source + "')"
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO run_summary (" + ", ".join(KEYS + SUMMARY_COLUMNS) + ") \
+                        SELECT run_id, machine_id, '" + source + "', quantity, " + ", ".join(SUMMARY_SQL) + " \
+                        FROM " + source + " s" + condition + " \
+                        GROUP BY run_id, machine_id, quantity " + _upsert(SUMMARY_COLUMNS))
+            rows += cur.rowcount
+        conn.commit()
+    updateFinalErrors(conn)
+    conn.commit()
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per run summary of measurements and trajectories")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--config", default="./crane_optimal_control/gantry_system/crane-properties.yaml")
+    parser.add_argument("--all", action="store_true", help="recompute the summaries of all runs")
+    args = parser.parse_args()
+
+    import psycopg
+    with open(args.config, 'r') as f:
+        props = yaml.safe_load(f)
+    with psycopg.connect(dsnFromProperties(props)) as conn:
+        createRunSummaryTable(conn)
+        print(f"run_summary: {backfill(conn, not args.all)} rows written")
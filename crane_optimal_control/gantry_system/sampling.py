@@ -0,0 +1,134 @@
+# sampling of the crane state in a separate thread, decoupled from the
+# thread that sends the setpoints.
+
+import time
+from threading import Thread, Event, Lock
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated ring buffer for samples with a fixed set of columns.
+    Appending never allocates, once the buffer is full the oldest
+    samples are overwritten. The first column is assumed to be time.
+    """
+
+    def __init__(self, capacity, columns) -> None:
+        """
+        Parameters
+        ----------
+        capacity : int
+            number of samples the buffer can hold
+        columns : list of String
+            names of the columns, e.g. ["t", "x", "v"]
+        """
+        self.capacity = int(capacity)
+        self.columns = list(columns)
+        self.data = np.zeros((len(self.columns), self.capacity))
+        self.count = 0 # total number of samples appended since clear()
+        self.lock = Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+
+    @property
+    def overflowed(self):
+        """
+        True if samples were overwritten since the last clear()
+        """
+        return self.count > self.capacity
+
+    def append(self, row):
+        with self.lock:
+            self.data[:, self.count % self.capacity] = row
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict of column name to numpy array with the samples in the
+        buffer, oldest first.
+        """
+        with self.lock:
+            n = len(self)
+            start = self.count - n
+            idx = np.arange(start, start + n) % self.capacity
+            data = self.data[:, idx]
+        return dict(zip(self.columns, data))
+
+    def latest(self):
+        """
+        Returns
+        -------
+        the last appended sample as a tuple, or None if empty
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            return tuple(self.data[:, (self.count - 1) % self.capacity])
+
+    def since(self, t):
+        """
+        Returns
+        -------
+        snapshot of all samples with time > t
+        """
+        snap = self.snapshot()
+        mask = snap[self.columns[0]] > t
+        return {k: v[mask] for k, v in snap.items()}
+
+
+class Sampler(Thread):
+    """
+    Thread that calls sample_fn at a fixed rate and appends
+    (time,) + sample_fn() to a RingBuffer.
+
+    The thread sleeps until the next sample is due instead of spinning,
+    every sample is timestamped with the time it was actually taken, so
+    jitter on the sample moments does not make the log less accurate.
+    """
+
+    def __init__(self, sample_fn, buffer, rate, clock = time.perf_counter) -> None:
+        """
+        Parameters
+        ----------
+        sample_fn : callable
+            returns a tuple with the values of the non-time columns
+        buffer : RingBuffer
+        rate : float
+            sample rate [Hz]
+        clock : callable
+            returns the time that is logged in the first column
+        """
+        super().__init__(daemon=True)
+        self.sample_fn = sample_fn
+        self.buffer = buffer
+        self.period = 1/rate
+        self.clock = clock
+        self._stop_event = Event()
+
+    def run(self):
+        next_sample = time.perf_counter()
+        while not self._stop_event.is_set():
+            t = self.clock()
+            values = self.sample_fn()
+            self.buffer.append((t,) + tuple(values))
+            next_sample += self.period
+            delay = next_sample - time.perf_counter()
+            if delay > 0:
+                self._stop_event.wait(delay)
+            else:
+                # fell behind, don't try to catch up with a burst
+                next_sample = time.perf_counter()
+
+    def stop(self):
+        """
+        stops sampling and waits for the thread to finish
+        """
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,89 @@
+# scheduler to release waypoints at their deadlines
+# based on the busy loop that used to be in Printer.executeWaypointsPositionV3
+
+import sys
+import time
+import numpy as np
+
+
+class WaypointScheduler:
+    """
+    Waits for waypoint deadlines with a hybrid sleep-then-spin strategy.
+
+    Until spin_margin before a deadline the thread sleeps, which frees
+    the core for the mqtt thread and the angle reader, the last stretch
+    is spent spinning on a monotonic high resolution clock to release
+    the waypoint on time. The spin margin grows when the OS oversleeps
+    (e.g. the ~15 ms timer resolution on Windows), up to max_margin.
+
+    For every deadline the lateness (time between the deadline and the
+    moment the waypoint was released) is recorded.
+    """
+
+    def __init__(self, spin_margin = None, max_margin = 0.02) -> None:
+        if spin_margin is None:
+            # default sleep resolution of windows is a lot coarser
+            spin_margin = 0.016 if sys.platform.startswith("win") else 0.002
+        self.spin_margin = spin_margin
+        self.max_margin = max_margin
+        self.t0 = time.perf_counter()
+        self.lateness = []
+
+    def start(self):
+        """
+        starts a new schedule, deadlines are relative to this moment
+        """
+        self.lateness = []
+        self.t0 = time.perf_counter()
+
+    def now(self):
+        """
+        time since start [s]
+        """
+        return time.perf_counter() - self.t0
+
+    def waitUntil(self, deadline):
+        """
+        blocks until deadline [s since start] and records the lateness
+
+        Returns
+        -------
+        the lateness in s
+        """
+        remaining = deadline - self.now()
+        if remaining > self.spin_margin:
+            sleep_time = remaining - self.spin_margin
+            before = time.perf_counter()
+            time.sleep(sleep_time)
+            overshoot = time.perf_counter() - before - sleep_time
+            if overshoot > self.spin_margin/2:
+                self.spin_margin = min(self.max_margin, 2*overshoot)
+        while self.now() < deadline:
+            pass
+        late = self.now() - deadline
+        self.lateness.append(late)
+        return late
+
+    def report(self, bins = None):
+        """
+        Summarizes the timing of the schedule so far.
+
+        Returns
+        -------
+        dict with
+        lateness : lateness of every deadline [s]
+        jitter histogram : (counts, bin edges [s]) of the lateness
+        mean lateness, max lateness, p99 lateness : [s]
+        """
+        lateness = np.array(self.lateness)
+        if bins is None:
+            # 0.1 ms bins up to 5 ms, everything later in the last bin
+            bins = np.append(np.arange(0, 0.0051, 0.0001), np.inf)
+        counts, edges = np.histogram(lateness, bins=bins)
+        return {
+            "lateness": lateness,
+            "jitter histogram": (counts, edges),
+            "mean lateness": float(np.mean(lateness)) if len(lateness) else 0.0,
+            "max lateness": float(np.max(lateness)) if len(lateness) else 0.0,
+            "p99 lateness": float(np.percentile(lateness, 99)) if len(lateness) else 0.0,
+        }
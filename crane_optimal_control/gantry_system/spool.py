@@ -0,0 +1,119 @@
+# local spool of the database writer: the store commands that could not be
+# written while the database was unreachable, kept in an SQLite file until
+# they are replayed. The commands are kept as received (machine, run,
+# command and payload), replaying them runs the same stores as the writer.
+# The file also keeps a reserve of run ids, allocated from the database
+# sequence while it is reachable and handed out while it is not.
+
+import time
+import sqlite3
+from threading import Lock
+
+
+class Spool:
+    """
+    SQLite file with the pending store commands, in the order they were
+    received.
+
+        spool = Spool("db-spool.sqlite")
+        spool.append(1, "42", "store-measurement", payload)
+        for id, machine_id, run, command, payload in spool.peek(50):
+            ...
+        spool.remove(id)
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS spool \
+                              (id INTEGER PRIMARY KEY AUTOINCREMENT, received REAL, \
+                              machine_id INTEGER, run TEXT, command TEXT, payload BLOB)")
+            # commands that failed on replay for another reason than the
+            # database being unreachable, kept for inspection
+            self.conn.execute("CREATE TABLE IF NOT EXISTS failed \
+                              (id INTEGER PRIMARY KEY, received REAL, machine_id INTEGER, \
+                              run TEXT, command TEXT, payload BLOB, error TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS run_ids (run_id INTEGER PRIMARY KEY)")
+
+    def append(self, machine_id, run, command, payload):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO spool (received, machine_id, run, command, payload) \
+                              VALUES (?, ?, ?, ?, ?)",
+                              (time.time(), machine_id, run, command, payload))
+
+    def peek(self, limit):
+        """
+        Returns
+        -------
+        list of the oldest limit commands, as (id, machine_id, run,
+        command, payload)
+        """
+        with self.lock:
+            return self.conn.execute("SELECT id, machine_id, run, command, payload FROM spool \
+                                     ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def remove(self, last_id, failed = ()):
+        """
+        removes the commands up to and including last_id, after they are
+        replayed. failed is a list of (id, error) of the commands that
+        could not be stored, these are moved to table failed.
+        """
+        with self.lock, self.conn:
+            for id, error in failed:
+                self.conn.execute("INSERT INTO failed SELECT id, received, machine_id, run, command, payload, ? \
+                                  FROM spool WHERE id = ?", (str(error), id))
+            self.conn.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+
+    def addRunIds(self, run_ids):
+        """
+        adds run ids, allocated from the database sequence, to the reserve
+        """
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO run_ids (run_id) VALUES (?)",
+                                  [(int(run_id),) for run_id in run_ids])
+
+    def takeRunIds(self, count):
+        """
+        removes up to count run ids from the reserve
+
+        Returns
+        -------
+        list of the run ids, lowest first
+        """
+        with self.lock, self.conn:
+            run_ids = [row[0] for row in self.conn.execute("SELECT run_id FROM run_ids ORDER BY run_id LIMIT ?",
+                                                           (int(count),))]
+            self.conn.executemany("DELETE FROM run_ids WHERE run_id = ?", [(run_id,) for run_id in run_ids])
+        return run_ids
+
+    def reservedRunIds(self):
+        """
+        Returns
+        -------
+        number of run ids in the reserve
+        """
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM run_ids").fetchone()[0]
+
+    def backlog(self):
+        """
+        Returns
+        -------
+        dict with the number of spooled commands, their size [bytes],
+        the age of the oldest one [s] and the number of failed commands
+        """
+        with self.lock:
+            count, size, oldest = self.conn.execute("SELECT count(*), coalesce(sum(length(payload)), 0), \
+                                                    min(received) FROM spool").fetchone()
+            failed = self.conn.execute("SELECT count(*) FROM failed").fetchone()[0]
+        return {
+            "commands": count,
+            "bytes": size,
+            "oldest": time.time() - oldest if oldest is not None else None,
+            "failed": failed,
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,70 @@
+# execution report of a move: timing of the serial link and the
+# waypoints, and how well the measurement followed the trajectory.
+
+import numpy as np
+
+# scalar entries of the report, in the order of the columns of the
+# execution_report table (spaces become underscores)
+REPORT_KEYS = [
+    "samples",
+    "duration",
+    "sample rate",
+    "latency p50",
+    "latency p99",
+    "latency max",
+    "mean lateness",
+    "p99 lateness",
+    "max lateness",
+    "max tracking error",
+    "residual swing",
+]
+
+
+def _percentiles(values, *qs):
+    if values is None or len(values) == 0:
+        return (None,)*len(qs)
+    return tuple(float(p) for p in np.percentile(values, qs))
+
+def executionReport(traj, measurement, timing = None, residual_window = 1.0):
+    """
+    Summarizes the execution of a trajectory.
+
+    Parameters
+    ----------
+    traj : tuple
+        trajectory as returned by generateTrajectory
+    measurement : tuple
+        (t, x, v, a, theta, omega) as returned by executeTrajectory,
+        t in seconds
+    timing : dict
+        timing of the execution as reported by the printer, with the
+        serial round trip "latencies" and the waypoint "lateness" [s].
+        None if the move was not executed on hardware.
+    residual_window : float
+        the residual swing is the largest angle in the last
+        residual_window seconds of the measurement [s]
+
+    Returns
+    -------
+    dict with the entries in REPORT_KEYS, floats or None if unknown
+    """
+    t = np.asarray(measurement[0], dtype=float)
+    x = np.asarray(measurement[1], dtype=float)
+    theta = np.asarray(measurement[4], dtype=float)
+    report = dict.fromkeys(REPORT_KEYS)
+
+    report["samples"] = len(t)
+    if len(t) > 1:
+        report["duration"] = float(t[-1] - t[0])
+        report["sample rate"] = (len(t) - 1)/report["duration"] if report["duration"] > 0 else None
+    if len(t):
+        commanded = np.interp(t, np.asarray(traj[0], dtype=float), np.asarray(traj[1], dtype=float))
+        report["max tracking error"] = float(np.max(np.abs(x - commanded)))
+        report["residual swing"] = float(np.max(np.abs(theta[t >= t[-1] - residual_window])))
+
+    if timing is not None:
+        report["latency p50"], report["latency p99"], report["latency max"] = \
+            _percentiles(timing.get("latencies"), 50, 99, 100)
+        for key in ("mean lateness", "p99 lateness", "max lateness"):
+            report[key] = timing.get(key)
+    return report
@@ -0,0 +1,201 @@
+# TimescaleDB layout of the measurement and trajectory tables: hypertables,
+# indexes, native compression and continuous aggregates per run. Every
+# step checks what is already there, so provisioning can run at every
+# start of the database writer.
+#
+# The times of a run are stored relative to datetime.min, every run starts
+# at 0001-01-01, so the hypertables are partitioned on run_id instead of
+# ts. Run ids only grow, current_run_id() (the highest run id in table run)
+# is the "now" for compression and the refresh of the aggregates.
+#
+# usage: python -m gantry_system.timescale
+
+import argparse
+import logging
+import yaml
+from .db_schema import QUANTITIES, quantityColumn, dsnFromProperties, schemaOf
+
+# aggregates of a quantity per run in the continuous aggregates, as
+# (column suffix, aggregate of x)
+RUN_AGGREGATES = [
+    ("samples", "count({x})"),
+    ("min", "min({x})"),
+    ("max", "max({x})"),
+    ("mean_abs", "avg(abs({x}))"),
+    ("rms", "sqrt(avg({x}*{x}))"),
+    ("peak_abs", "max(abs({x}))"),
+]
+
+
+def _query(conn, sql, params = ()):
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall() if cur.description else None
+
+def hasTimescale(conn):
+    """
+    creates the timescaledb extension if it is available. Creating it
+    fails if timescaledb is not in shared_preload_libraries of the server.
+
+    Returns
+    -------
+    True if the extension is installed
+    """
+    import psycopg
+    if not _query(conn, "SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb'"):
+        return False
+    try:
+        _query(conn, "CREATE EXTENSION IF NOT EXISTS timescaledb")
+    except psycopg.Error as e:
+        conn.rollback()
+        logging.warning("timescaledb extension can not be created: %s", e)
+        return False
+    return True
+
+def timescaleInstalled(conn):
+    return bool(_query(conn, "SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'"))
+
+def physicalTable(conn, table):
+    """
+    the table that holds the samples of table, table_wide for the wide
+    layout (see db_schema)
+    """
+    return table + "_wide" if schemaOf(conn, table) == "wide" else table
+
+def isHypertable(conn, name):
+    return bool(_query(conn, "SELECT 1 FROM timescaledb_information.hypertables \
+                       WHERE hypertable_name = %s", (name,)))
+
+def compressionEnabled(conn, name):
+    rows = _query(conn, "SELECT compression_enabled FROM timescaledb_information.hypertables \
+                  WHERE hypertable_name = %s", (name,))
+    return bool(rows and rows[0][0])
+
+def createRunNow(conn):
+    _query(conn, "CREATE OR REPLACE FUNCTION current_run_id() RETURNS integer \
+           LANGUAGE SQL STABLE AS $$ SELECT coalesce(max(run_id), 0) FROM run $$")
+
+def createHypertable(conn, name, chunk_runs):
+    """
+    turns name into a hypertable partitioned on run_id, with chunk_runs
+    runs per chunk. Existing rows are moved into the chunks.
+    """
+    created = not isHypertable(conn, name)
+    if created:
+        _query(conn, "SELECT create_hypertable(%s::regclass, 'run_id', chunk_time_interval => %s::integer, \
+               migrate_data => true)", (name, chunk_runs))
+    _query(conn, "SELECT set_integer_now_func(%s::regclass, 'current_run_id', replace_if_exists => true)", (name,))
+    return created
+
+def createIndex(conn, name, wide):
+    columns = "machine_id, run_id, ts" if wide else "machine_id, run_id, quantity, ts"
+    _query(conn, "CREATE INDEX IF NOT EXISTS " + name + "_machine_run_idx ON " + name + " (" + columns + ")")
+
+def enableCompression(conn, name, wide, compress_after):
+    """
+    compresses the chunks of the runs that are compress_after runs older
+    than the last one, segmented by machine and run
+    """
+    if not compressionEnabled(conn, name):
+        _query(conn, "ALTER TABLE " + name + " SET (timescaledb.compress, \
+               timescaledb.compress_segmentby = 'machine_id, run_id', \
+               timescaledb.compress_orderby = '" + ("ts" if wide else "quantity, ts") + "')")
+    _query(conn, "SELECT add_compression_policy(%s::regclass, compress_after => %s::integer, if_not_exists => true)",
+           (name, compress_after))
+
+def aggregateSource(conn, view):
+    """
+    the hypertable of the continuous aggregate view, None if there is no
+    such aggregate
+    """
+    rows = _query(conn, "SELECT hypertable_name FROM timescaledb_information.continuous_aggregates \
+                  WHERE view_name = %s", (view,))
+    return rows[0][0] if rows else None
+
+def dropOutdatedAggregate(conn, table, name):
+    """
+    Drops the continuous aggregate table_run_stats if it is not on name,
+    e.g. still on table_narrow after a migration to the wide layout.
+
+    Returns
+    -------
+    True if it was dropped
+    """
+    view = table + "_run_stats"
+    source = aggregateSource(conn, view)
+    if source is None or source == name:
+        return False
+    _query(conn, "DROP MATERIALIZED VIEW " + view)
+    print(f"{view}: dropped, it was on {source} instead of {name}")
+    return True
+
+def createRunAggregate(conn, table, name, wide, refresh_runs):
+    """
+    Creates the continuous aggregate table_run_stats, the RUN_AGGREGATES
+    per machine, run (and quantity) of name. For the wide layout the
+    columns are named after the quantity, e.g. position_rms. An
+    aggregate on another table than name is recreated on name.
+    """
+    view = table + "_run_stats"
+    dropOutdatedAggregate(conn, table, name)
+    if wide:
+        group = "machine_id, run"
+        columns = ", ".join(sql.format(x=quantityColumn(q)) + " AS " + quantityColumn(q) + "_" + suffix
+                            for q in QUANTITIES[table] for suffix, sql in RUN_AGGREGATES)
+    else:
+        group = "machine_id, run, quantity"
+        columns = "quantity, " + ", ".join(sql.format(x="value") + " AS " + suffix for suffix, sql in RUN_AGGREGATES)
+    _query(conn, "CREATE MATERIALIZED VIEW IF NOT EXISTS " + view + " \
+           WITH (timescaledb.continuous) AS \
+           SELECT time_bucket(1, run_id) AS run, machine_id, " + columns + " \
+           FROM " + name + " GROUP BY " + group + " WITH NO DATA")
+    _query(conn, "SELECT add_continuous_aggregate_policy(%s::regclass, start_offset => %s::integer, end_offset => NULL, \
+           schedule_interval => interval '1 minute', if_not_exists => true)",
+           (view, refresh_runs))
+
+def provision(conn, chunk_runs = 100, compress_after = 200, refresh_runs = 50):
+    """
+    Sets up the TimescaleDB layout of measurement and trajectory. conn
+    must be in autocommit mode, continuous aggregates can not be created
+    inside a transaction.
+
+    Parameters
+    ----------
+    chunk_runs : int
+        runs per chunk of the hypertables
+    compress_after : int
+        chunks of runs that are this many runs older than the last one
+        are compressed
+    refresh_runs : int
+        the continuous aggregates are refreshed for the last refresh_runs
+        runs every minute
+
+    Returns
+    -------
+    False if TimescaleDB is not available
+    """
+    if not hasTimescale(conn):
+        logging.warning("timescaledb extension is not available, tables are left as they are")
+        return False
+    createRunNow(conn)
+    for table in QUANTITIES:
+        name = physicalTable(conn, table)
+        wide = name != table
+        if createHypertable(conn, name, chunk_runs):
+            print(f"{name}: converted to a hypertable with {chunk_runs} runs per chunk")
+        createIndex(conn, name, wide)
+        enableCompression(conn, name, wide, compress_after)
+        createRunAggregate(conn, table, name, wide, refresh_runs)
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TimescaleDB layout of the measurement and trajectory tables")
+    parser.add_argument("--config", default="./crane_optimal_control/gantry_system/crane-properties.yaml")
+    args = parser.parse_args()
+
+    import psycopg
+    with open(args.config, 'r') as f:
+        props = yaml.safe_load(f)
+    with psycopg.connect(dsnFromProperties(props), autocommit=True) as conn:
+        provision(conn, props.get("timescale chunk runs", 100), props.get("timescale compress after runs", 200),
+                  props.get("timescale refresh runs", 50))
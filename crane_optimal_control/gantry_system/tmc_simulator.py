@@ -0,0 +1,241 @@
+# simulated TMC4671 board, a TMCL connection that can be used instead of
+# ConnectionManager(...).connect() to run the motors without hardware.
+#
+# usage: set gantryPort and/or hoistPort to "sim" in crane-properties.yaml,
+# options are appended as "sim:latency=0.002,datarate=115200,position=262144"
+
+import time
+from collections import deque
+from threading import Lock
+from pytrinamic.connections.tmcl_interface import TmclInterface
+from pytrinamic.ic import TMC4671
+from pytrinamic.tmcl import TMCLRequest, TMCLReply, TMCLCommand, TMCLStatus
+from pytrinamic.helpers import to_signed_32
+
+REG = TMC4671.REG
+ENUM = TMC4671.ENUM
+
+# encoder counts per revolution
+COUNTS_PER_REV = 65536
+
+def to_unsigned_32(value):
+    return value & 0xFFFFFFFF
+
+
+class SimulatedTMC4671:
+    """
+    Register map of a TMC4671 with a simple model of the motor behind it.
+
+    Registers that are not modelled just store the last written value.
+    The motion registers follow the mode in MODE_RAMP_MODE_MOTION:
+
+    position mode : the position loop commands a velocity proportional
+        to the position error (time constant position_tau), limited by
+        PID_VELOCITY_LIMIT; the target is clamped to the position limits
+    velocity mode : the velocity target, limited by PID_VELOCITY_LIMIT
+    open loop (uq_ud_ext) mode : OPENLOOP_VELOCITY_TARGET
+    stopped, torque mode : the motor coasts to a stop
+
+    The velocity follows the commanded velocity through a first-order
+    velocity loop (time constant velocity_tau), limited by
+    PID_ACCELERATION_LIMIT. The axis has mechanical end stops, which is
+    what the homing sequences run into. Velocities are in rpm and
+    positions in encoder counts, like on the board.
+    """
+
+    def __init__(self, position = 0, end_stops = (-30000, 1100000),
+                 position_tau = 0.02, velocity_tau = 0.005, step = 0.0005,
+                 clock = time.perf_counter) -> None:
+        """
+        Parameters
+        ----------
+        position : int
+            initial position [counts]
+        end_stops : tuple
+            (low, high) position of the mechanical end stops [counts]
+        position_tau, velocity_tau : float
+            time constants of the position and velocity loop [s]
+        step : float
+            integration step [s]
+        clock : callable
+            time source, the model is advanced to clock() on every access
+        """
+        self.registers = {
+            REG.PID_ACCELERATION_LIMIT: 0x7FFFFFFF,
+            REG.PID_VELOCITY_LIMIT: 0x7FFFFFFF,
+            REG.PID_POSITION_LIMIT_LOW: to_unsigned_32(-2**31),
+            REG.POSITION_LIMIT_HIGH: 0x7FFFFFFF,
+        }
+        self.position = float(position)
+        # the encoder count was last written at this position
+        self.count_base = (0, self.position)
+        self.velocity = 0.0
+        self.acceleration = 0.0
+        self.end_stops = end_stops
+        self.position_tau = position_tau
+        self.velocity_tau = velocity_tau
+        self.step = step
+        self.clock = clock
+        self.t = clock()
+
+    def _signed(self, register):
+        return to_signed_32(self.registers.get(register, 0))
+
+    def _commandedVelocity(self):
+        mode = self.registers.get(REG.MODE_RAMP_MODE_MOTION, ENUM.MOTION_MODE_STOPPED)
+        v_lim = abs(self._signed(REG.PID_VELOCITY_LIMIT))
+        if mode == ENUM.MOTION_MODE_POSITION:
+            low = self._signed(REG.PID_POSITION_LIMIT_LOW)
+            high = self._signed(REG.POSITION_LIMIT_HIGH)
+            target = self._signed(REG.PID_POSITION_TARGET)
+            if low < high:
+                target = min(max(target, low), high)
+            v = (target - self.position)*60/COUNTS_PER_REV/self.position_tau
+            return min(max(v, -v_lim), v_lim)
+        if mode == ENUM.MOTION_MODE_VELOCITY:
+            v = self._signed(REG.PID_VELOCITY_TARGET)
+            return min(max(v, -v_lim), v_lim)
+        if mode == ENUM.MOTION_MODE_UQ_UD_EXT:
+            return self._signed(REG.OPENLOOP_VELOCITY_TARGET)
+        return 0.0
+
+    def advance(self):
+        """
+        integrates the motor model up to clock()
+        """
+        now = self.clock()
+        a_lim = abs(self._signed(REG.PID_ACCELERATION_LIMIT))
+        while self.t < now:
+            h = min(self.step, now - self.t)
+            a = (self._commandedVelocity() - self.velocity)/self.velocity_tau
+            a = min(max(a, -a_lim), a_lim)
+            self.velocity += h*a
+            self.position += h*self.velocity*COUNTS_PER_REV/60
+            low, high = self.end_stops
+            if self.position <= low or self.position >= high:
+                self.position = min(max(self.position, low), high)
+                self.velocity = 0.0
+            self.acceleration = a
+            self.t += h
+
+    def read(self, register):
+        self.advance()
+        if register == REG.PID_POSITION_ACTUAL:
+            return to_unsigned_32(int(round(self.position)))
+        if register == REG.PID_VELOCITY_ACTUAL:
+            return to_unsigned_32(int(round(self.velocity)))
+        if register == REG.ABN_DECODER_COUNT:
+            ppr = self.registers.get(REG.ABN_DECODER_PPR, 0) or COUNTS_PER_REV
+            count, position = self.count_base
+            return int(count + round((self.position - position)*ppr/COUNTS_PER_REV)) % ppr
+        if register == REG.PID_TORQUE_FLUX_ACTUAL:
+            # torque follows the acceleration, within the current limit
+            torque_lim = self.registers.get(REG.PID_TORQUE_FLUX_LIMITS, 0x7FFF) & 0x7FFF
+            torque = int(min(max(self.acceleration/100, -torque_lim), torque_lim))
+            return (torque & 0xFFFF) << 16
+        return self.registers.get(register, 0)
+
+    def write(self, register, value):
+        self.advance()
+        self.registers[register] = value & 0xFFFFFFFF
+        if register == REG.ABN_DECODER_COUNT:
+            self.count_base = (value, self.position)
+        if register == REG.PID_POSITION_ACTUAL:
+            # moves the encoder zero, not the motor
+            self.end_stops = tuple(stop - self.position + to_signed_32(value) for stop in self.end_stops)
+            self.position = float(to_signed_32(value))
+
+
+class TmcSimulatorInterface(TmclInterface):
+    """
+    TMCL connection to a SimulatedTMC4671, a drop-in replacement for the
+    connection returned by ConnectionManager.
+
+    Every request costs transfer time on the simulated link (9 bytes of
+    request and reply at datarate baud), and a link that was idle adds
+    latency for the turnaround (USB frame, board firmware). Requests
+    that are sent before the replies are read are pipelined, like on
+    the real link, so the effect of batching register accesses on the
+    execution loop can be measured without hardware.
+    """
+
+    def __init__(self, port = "sim", latency = 0.001, datarate = None, host_id = 2, module_id = 1, **model) -> None:
+        """
+        Parameters
+        ----------
+        port : String
+            name of the connection, only used for logging
+        latency : float
+            turnaround time of a request on an idle link [s]
+        datarate : int
+            baudrate of the simulated link, None for no transfer time
+        model
+            keyword arguments for SimulatedTMC4671
+        """
+        super().__init__(host_id, module_id)
+        self.port = port
+        self.latency = latency
+        self.byte_time = 0 if not datarate else 10/datarate
+        self.chip = SimulatedTMC4671(**model)
+        self.replies = deque() # (time at which the reply is available, reply)
+        self.busy_until = 0.0
+        self.lock = Lock()
+
+    def __str__(self):
+        return "Connection: type={} port={}".format(type(self).__name__, self.port)
+
+    def _execute(self, request):
+        # inverse of the register address encoding in TmclInterface
+        address_shift = 8 - (16 - self._default_register_address_bit_width)
+        register = request.commandType | ((request.motorBank << address_shift) & 0xFF00)
+        if request.command == TMCLCommand.READ_MC:
+            return TMCLStatus.SUCCESS, self.chip.read(register)
+        if request.command == TMCLCommand.WRITE_MC:
+            self.chip.write(register, request.value)
+            return TMCLStatus.SUCCESS, request.value
+        return TMCLStatus.INVALID_COMMAND, 0
+
+    def _send(self, host_id, module_id, data):
+        with self.lock:
+            now = time.perf_counter()
+            start = max(now, self.busy_until)
+            if start == now:
+                start += self.latency
+            self.busy_until = start + 18*self.byte_time
+            request = TMCLRequest.from_buffer(data)
+            status, value = self._execute(request)
+            reply = TMCLReply(host_id, module_id, status, request.command, value)
+            self.replies.append((self.busy_until, reply.to_buffer()))
+
+    def _recv(self, host_id, module_id):
+        with self.lock:
+            ready, data = self.replies.popleft()
+        while time.perf_counter() < ready:
+            pass
+        return data
+
+    @staticmethod
+    def supports_tmcl():
+        return True
+
+    @staticmethod
+    def list():
+        return ["sim"]
+
+
+def isSimulatorPort(port):
+    return isinstance(port, str) and (port == "sim" or port.startswith("sim:"))
+
+def simulatorFromPort(port):
+    """
+    creates a TmcSimulatorInterface from a port string like
+    "sim" or "sim:latency=0.002,datarate=115200,position=262144"
+    """
+    options = {}
+    if ":" in port:
+        for option in port.split(":", 1)[1].split(","):
+            key, value = option.split("=")
+            options[key.strip()] = float(value)
+    if "datarate" in options:
+        options["datarate"] = int(options["datarate"])
+    return TmcSimulatorInterface(port, **options)
@@ -0,0 +1,265 @@
+# bounded queue of database writes, executed by writer threads that each
+# own a connection. Used by the database writer, such that a slow COPY or
+# commit does not block the MQTT network thread (and its keepalives).
+#
+# With a group window, a writer thread gathers the writes that arrive
+# within the window into one transaction: their rows are sent with one
+# COPY per table and committed once, which saves a commit (and fsync) per
+# write at the cost of up to one window of latency.
+
+import time
+import logging
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+import psycopg
+from .pg_copy import CopyBatch
+
+# errors after which the write is retried, on a new connection
+TRANSIENT_ERRORS = (psycopg.OperationalError,)
+
+
+def executeWrites(cur, batch, writes, savepoints = True):
+    """
+    Executes writes fn(batch, *args) in the current transaction of cur.
+
+    Parameters
+    ----------
+    writes : list
+        (fn, args) per write
+    savepoints : bool
+        run every write in its own savepoint, such that a failing write
+        is rolled back (also its rows in batch) and the others are kept.
+        Without, the first error is raised.
+
+    Returns
+    -------
+    list of (result, error) per write
+
+    Raises
+    ------
+    TRANSIENT_ERRORS, always
+    """
+    outcomes = []
+    for fn, args in writes:
+        if not savepoints:
+            outcomes.append((fn(batch, *args), None))
+            continue
+        mark = batch.mark()
+        cur.execute("SAVEPOINT write")
+        try:
+            outcomes.append((fn(batch, *args), None))
+            cur.execute("RELEASE SAVEPOINT write")
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT write")
+            batch.reset(mark)
+            outcomes.append((None, e))
+    return outcomes
+
+
+class WriteQueue:
+    """
+    Executes writes fn(batch, *args) on a pool of writer threads.
+
+    Every writer thread owns one connection, which it opens on first use
+    and opens again after a transient error. A write executes statements
+    on batch.connection and adds its COPY rows to batch, a CopyBatch. The
+    rows are COPYed and the transaction is committed after fn returns, or
+    rolled back when fn raises. Transient errors (lost connection, server
+    restart) are retried with exponential backoff, other errors are
+    reported right away.
+
+    With group_window > 0, the writes that arrive within group_window
+    seconds after the first one, or until the group has group_rows COPY
+    rows, share one transaction. Every write of a group runs in its own
+    savepoint, so a failing write does not take the others with it. If
+    the COPY or commit of the group fails, its writes are executed again
+    one by one.
+
+        writes = WriteQueue(dsn, workers=2)
+        writes.submit(storeMeasurement, machine_id, run, measurement,
+                      on_done=lambda result, error: ack(error))
+    """
+
+    def __init__(self, dsn, workers = 2, maxsize = 100, retries = 5, backoff = 0.5, max_backoff = 10,
+                 group_window = 0, group_rows = 0) -> None:
+        """
+        Parameters
+        ----------
+        dsn : String
+            connection string of the database
+        workers : int
+            number of writer threads (and connections)
+        maxsize : int
+            maximum number of queued writes, submit raises queue.Full
+            beyond that
+        retries : int
+            number of retries of a write after a transient error
+        backoff : float
+            wait before the first retry, doubled on every next one [s]
+        max_backoff : float
+            longest wait between retries [s]
+        group_window : float
+            time to gather writes into one transaction, 0 to commit every
+            write on its own [s]
+        group_rows : int
+            a group is committed as soon as it has this many COPY rows, 0
+            for no limit
+        """
+        self.dsn = dsn
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.group_window = group_window
+        self.group_rows = group_rows
+        self.queue = Queue(maxsize=maxsize)
+        self.lock = Lock()
+        self.counters = dict.fromkeys(["submitted", "rejected", "completed", "failed",
+                                       "retries", "reconnects", "commits", "max depth"], 0)
+        self.busy = 0
+        self.workers = [Thread(target=self._run, name="db writer " + str(i), daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _count(self, key, n = 1):
+        with self.lock:
+            self.counters[key] += n
+
+    def submit(self, fn, *args, on_done = None):
+        """
+        queues the write fn(batch, *args), without blocking
+
+        Parameters
+        ----------
+        on_done : callable
+            called as on_done(result, error) on the writer thread once the
+            write is committed (error None) or has failed
+
+        Raises
+        ------
+        queue.Full if maxsize writes are already queued
+        """
+        try:
+            self.queue.put_nowait((fn, args, on_done))
+        except Full:
+            self._count("rejected")
+            raise
+        with self.lock:
+            self.counters["submitted"] += 1
+            self.counters["max depth"] = max(self.counters["max depth"], self.queue.qsize())
+
+    def metrics(self):
+        """
+        Returns
+        -------
+        dict with the queue depth, the writer threads that are busy and
+        the counters since start
+        """
+        with self.lock:
+            return dict(self.counters, depth=self.queue.qsize(), capacity=self.queue.maxsize,
+                        busy=self.busy, workers=len(self.workers))
+
+    def stop(self):
+        """
+        executes the writes that are still queued and stops the writer
+        threads
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _connect(self, conn):
+        if conn is not None and not conn.closed:
+            return conn
+        if conn is not None:
+            self._count("reconnects")
+        return psycopg.connect(self.dsn)
+
+    def _transaction(self, conn, group, gather):
+        # executes the writes of group in one transaction, with gather the
+        # writes that arrive within the group window are added to group
+        savepoints = self.group_window > 0
+        batch = CopyBatch(conn)
+        outcomes = []
+        deadline = time.perf_counter() + self.group_window
+        with conn.cursor() as cur:
+            while True:
+                outcomes += executeWrites(cur, batch, [(fn, args) for fn, args, _ in group[len(outcomes):]],
+                                          savepoints)
+                if not gather or 0 < self.group_rows <= batch.rows:
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    # stop after this group
+                    self.queue.put(None)
+                    break
+                group.append(item)
+        batch.flush()
+        conn.commit()
+        self._count("commits")
+        return outcomes
+
+    def _execute(self, conn, group, gather):
+        # executes group in one transaction, retrying transient errors
+        # Returns conn, the (result, error) per write or None, and the
+        # error of the transaction
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self._connect(conn)
+                return conn, self._transaction(conn, group, gather and attempt == 0), None
+            except TRANSIENT_ERRORS as e:
+                error = e
+                logging.warning("transient database error, attempt " + str(attempt + 1) + ": " + str(e))
+                if conn is not None:
+                    conn.close()
+                if attempt < self.retries:
+                    self._count("retries")
+                    time.sleep(min(self.backoff*2**attempt, self.max_backoff))
+            except Exception as e:
+                error = e
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+                break
+        return conn, None, error
+
+    def _run(self):
+        conn = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            with self.lock:
+                self.busy += 1
+            group = [item]
+            conn, outcomes, error = self._execute(conn, group, self.group_window > 0)
+            if outcomes is None and len(group) > 1 and not isinstance(error, TRANSIENT_ERRORS):
+                # the COPY or commit of the group failed, find the culprit
+                outcomes = []
+                for item in group:
+                    conn, single, single_error = self._execute(conn, [item], False)
+                    outcomes += single or [(None, single_error)]
+            elif outcomes is None:
+                outcomes = [(None, error)]*len(group)
+            with self.lock:
+                self.busy -= 1
+                for _, error in outcomes:
+                    self.counters["failed" if error else "completed"] += 1
+            for (_, _, on_done), (result, error) in zip(group, outcomes):
+                if on_done is None:
+                    continue
+                try:
+                    on_done(result, error)
+                except Exception as e:
+                    logging.error("error in write callback: " + str(e))
+        if conn is not None:
+            conn.close()
@@ -7,6 +7,19 @@ import json
 import paho.mqtt.client as mqtt
 import pickle
 import os
+import time
+import numpy as np
+from queue import Full
+from threading import Thread, Lock
+from gantry_system.telemetry import REPORT_KEYS
+from gantry_system.pg_copy import BinaryCopyEncoder, CopyBatch, columnTypes, relativeTimestamps
+from gantry_system.db_schema import MEASUREMENT_QUANTITIES, TRAJECTORY_QUANTITIES, QUANTITIES, \
+    wideColumns, createWideTable, createNarrowView, schemaOf, SchemaError
+from gantry_system.run_summary import summarize, storeSummary, createRunSummaryTable
+from gantry_system import timescale
+from gantry_system.write_queue import WriteQueue, executeWrites, TRANSIENT_ERRORS
+from gantry_system.spool import Spool
+from gantry_system.run_reader import RunReader
 
 # Load the ID from the YAML configuration file
 def load_config(config_file="config.yaml"):
@@ -14,6 +27,14 @@ def load_config(config_file="config.yaml"):
         config = yaml.safe_load(f)
     return config.get("machine id")
 
+# columns of the narrow measurement and trajectory tables
+COPY_COLUMNS = ["ts", "machine_id", "run_id", "quantity", "value"]
+# commands that are spooled while the database is unreachable
+SPOOLED_COMMANDS = ["store-trajectory", "store-measurement", "store-execution-report"]
+SPOOLED = "spooled"
+# table of the runs written by a store command
+STORED_TABLES = {"store-trajectory": "trajectory", "store-measurement": "measurement"}
+
 class DatabaseMQTTWrapper:
     def __init__(self, config_path='config.yaml'):
         # Load the ID from the YAML configuration file
@@ -27,10 +48,59 @@ class DatabaseMQTTWrapper:
                                     + " user=" + props["database user"]\
                                     + " password=" + props["database password"]
             self.connect_to_db = props["connect to db"]
+            # narrow: a row per quantity, wide: a row per timestamp in
+            # measurement_wide and trajectory_wide, see gantry_system/db_schema.py
+            self.wide = props.get("database schema", "narrow") == "wide"
+            # reads of stored runs, with an LRU cache of the last runs read
+            self.reader = RunReader(props.get("read cache runs", 0))
+            # binary COPY encoder per table, created on first use
+            self.encoders = {}
+            # chunk runs, compress after runs and refresh runs of the
+            # TimescaleDB layout, None to leave the tables as they are
+            self.timescale = None
+            if props.get("timescale", False):
+                self.timescale = (props.get("timescale chunk runs", 100),
+                                  props.get("timescale compress after runs", 200),
+                                  props.get("timescale refresh runs", 50))
             if self.connect_to_db:
-                self.dbconn = psycopg.connect(self.dbaddr)
+                # while the database is unreachable, stores are spooled to a
+                # local file and replayed once it is back
+                spool_file = os.path.join(os.path.dirname(os.path.abspath(config_path)),
+                                          props.get("spool file", "db-spool.sqlite"))
+                self.spool = Spool(spool_file)
+                self.spool_lock = Lock()
+                self.spool_retry = props.get("spool retry interval", 5)
+                self.spool_batch = props.get("spool replay batch", 50)
+                # run ids kept in the spool file, handed out while the
+                # database is unreachable
+                self.run_id_reserve = props.get("run id reserve", 100)
+                self.spooled = 0
+                self.replayed = 0
+                self.healthy = False
+                self.setup_done = False
+                try:
+                    self.setupDatabase()
+                except TRANSIENT_ERRORS as e:
+                    print(f"Database unreachable, spooling stores to {spool_file}: {e}")
+                # the writes are executed on writer threads, each with its
+                # own connection, the MQTT thread only queues them
+                self.writes = WriteQueue(self.dbaddr,
+                                         workers=props.get("database writers", 2),
+                                         maxsize=props.get("database queue size", 100),
+                                         group_window=props.get("group commit window", 0),
+                                         group_rows=props.get("group commit rows", 0))
+                Thread(target=self.replayLoop, name="db replay", daemon=True).start()
             else:
-                self.dbconn = None
+                self.writes = None
+
+        # command: (decoder of the payload, write)
+        self.commands = {
+            "store-trajectory": (pickle.loads, self.storeTrajectory),
+            "store-measurement": (pickle.loads, self.storeMeasurement),
+            "store-execution-report": (lambda payload: json.loads(payload.decode('utf-8')), self.storeExecutionReport),
+            "allocate-run-ids": (lambda payload: json.loads(payload.decode('utf-8')).get("count", 1), self.allocateRunIds),
+            "read-runs": (lambda payload: json.loads(payload.decode('utf-8')), self.readRuns),
+        }
         
         self.tg = TrajectoryGenerator(config_path)
 
@@ -42,55 +112,309 @@ class DatabaseMQTTWrapper:
 
     def on_connect(self, client, userdata, flags, rc):
         print(f"Connected with result code {rc}")
-        # Subscribe to the command topic
-        topic = f"command/bip-server/{self.id}/req/#"
+        # Subscribe to the command topic of all controllers
+        topic = "command/bip-server/+/req/#"
         client.subscribe(topic)
         print(f"Subscribed to topic: {topic}")
 
     def on_message(self, client, userdata, msg):
-        # Parse the topic to extract the trajectory-id
+        # Parse the topic to extract the machine id, the run (or
+        # response) id and the command
         topic_parts = msg.topic.split('/')
-        self.run = topic_parts[-2]
+        request_id = topic_parts[-2]
         command_action = topic_parts[-1]
 
-        # Validate if the command is the correct one
-        if command_action == "store-trajectory":
-            try:
-                # Deserialize the trajectory
-                self.received_trajectory = pickle.loads(msg.payload)
-                print(f"Received trajectory on topic: {msg.topic}")
-
-                # store it
-                self.storeTrajectory(self.received_trajectory)
-
-                # Publish the generated trajectory to the response topic
-                response_topic = f"command/bip-server/{self.id}/res/store-trajectory/200"
-                client.publish(response_topic)
-                print(f"Published trajectory to topic: {response_topic}")
-            except Exception as e:
-                print(f"Error processing message: {e}")
-        if command_action == "store-measurement":
-            try:
-                # Deserialize the trajectory
-                self.received_measurement = pickle.loads(msg.payload)
-                print(f"Received measurement on topic: {msg.topic}")
+        if command_action == "db-writer-metrics":
+            response_topic = f"command/bip-server/{topic_parts[2]}/res/{request_id}/db-writer-metrics"
+            client.publish(response_topic, json.dumps(self.metrics()))
+            return
+        if command_action not in self.commands or len(topic_parts) < 6:
+            return
+        try:
+            machine_id = int(topic_parts[2])
+        except ValueError:
+            print(f"Error processing message: machine id in {msg.topic} is not a number")
+            return
+        print(f"Received {command_action} on topic: {msg.topic}")
+
+        def done(result, error):
+            if isinstance(error, TRANSIENT_ERRORS) and command_action in SPOOLED_COMMANDS:
+                # the database went down, keep the store for later
+                self.spoolCommand(machine_id, request_id, command_action, msg.payload, error)
+                result, error = SPOOLED, None
+            elif isinstance(error, TRANSIENT_ERRORS) and command_action == "allocate-run-ids":
+                # the database went down, hand out reserved run ids
+                self.markUnhealthy(error)
+                result, error = self.reservedRunIds(msg.payload)
+            if error is None and command_action in STORED_TABLES:
+                self.reader.invalidate(STORED_TABLES[command_action], machine_id, request_id)
+            self.acknowledge(machine_id, request_id, command_action, result, error)
 
-                # store it
-                self.storeMeasurement(self.received_measurement)
+        if self.writes is None:
+            # no database, acknowledge without storing
+            done(None, None if command_action in SPOOLED_COMMANDS else ConnectionError("no database"))
+            return
+        if command_action in SPOOLED_COMMANDS and self.spoolIfDown(machine_id, request_id, command_action, msg.payload):
+            done(SPOOLED, None)
+            return
+        if command_action == "allocate-run-ids" and not self.healthy:
+            done(*self.reservedRunIds(msg.payload))
+            return
+        if command_action not in SPOOLED_COMMANDS and not self.healthy:
+            done(None, ConnectionError("database unreachable"))
+            return
+        decode, write = self.commands[command_action]
+        try:
+            self.writes.submit(self.execute, decode, write, machine_id, request_id, msg.payload, on_done=done)
+        except Full:
+            done(None, Full("write queue is full"))
 
-                # Publish the generated trajectory to the response topic
-                response_topic = f"command/bip-server/{self.id}/res/store-measurement/200"
-                client.publish(response_topic)
-                print(f"Published measurement to topic: {response_topic}")
-            except Exception as e:
-                print(f"Error processing message: {e}")               
+    def execute(self, batch, decode, write, machine_id, run, payload):
+        """
+        executed on a writer thread, decodes the payload of a command and
+        writes it. Statements are executed on batch.connection, rows for
+        COPY are added to batch, the write queue COPYs and commits them.
+        """
+        return write(batch, machine_id, run, decode(payload))
+
+    def acknowledge(self, machine_id, request_id, command_action, result, error):
+        """
+        publishes the response to a command once it is committed (200)
+        or spooled (202), or the error if it failed (500) or the queue was
+        full (503)
+        """
+        if error is not None:
+            print(f"Error processing {command_action} of machine {machine_id}: {error}")
+        if command_action == "read-runs":
+            # numpy arrays, pickled like the trajectories and measurements
+            response_topic = f"command/bip-server/{machine_id}/res/{request_id}/read-runs"
+            payload = result if error is None else {"error": str(error)}
+            self.client.publish(response_topic, pickle.dumps(payload), qos=2)
+        elif command_action == "allocate-run-ids":
+            # Publish the run ids to the response topic of the requester
+            response_topic = f"command/bip-server/{machine_id}/res/{request_id}/allocate-run-ids"
+            payload = {"run_ids": result} if error is None else {"error": str(error)}
+            self.client.publish(response_topic, json.dumps(payload), qos=2)
+        else:
+            if error is None:
+                code = 202 if result == SPOOLED else 200
+            else:
+                code = 503 if isinstance(error, Full) else 500
+            response_topic = f"command/bip-server/{machine_id}/res/{command_action}/{code}"
+            self.client.publish(response_topic, None if error is None else json.dumps({"error": str(error)}))
+        print(f"Published response to topic: {response_topic}")
+
+    def metrics(self):
+        """
+        state of the write queue, the health of the database and the
+        backlog of the spool
+        """
+        if self.writes is None:
+            return {}
+        return dict(self.writes.metrics(), healthy=self.healthy, spooled=self.spooled,
+                    replayed=self.replayed, spool=self.spool.backlog(),
+                    reserved_run_ids=self.spool.reservedRunIds(),
+                    read_cache_hits=self.reader.hits, read_cache_misses=self.reader.misses)
+
+    def setupDatabase(self):
+        """
+        Creates the sequence and tables the writer needs and sets up the
+        TimescaleDB layout. Marks the database healthy once done.
+        """
+        with psycopg.connect(self.dbaddr) as conn:
+            self.createRunSequence(conn)
+            self.nextRunIds(conn, 0)
+            self.createExecutionReportTable(conn)
+            createRunSummaryTable(conn)
+            if self.wide:
+                self.createWideTables(conn)
+            else:
+                self.checkNarrowTables(conn)
+        if self.timescale is not None:
+            # continuous aggregates can not be created in a transaction
+            with psycopg.connect(self.dbaddr, autocommit=True) as conn:
+                timescale.provision(conn, *self.timescale)
+        self.setup_done = True
+        self.healthy = True
+
+    def spoolIfDown(self, machine_id, run, command, payload):
+        """
+        spools the command if the database is known to be unreachable
+
+        Returns
+        -------
+        True if the command was spooled
+        """
+        with self.spool_lock:
+            if self.healthy:
+                return False
+            self.spool.append(machine_id, run, command, payload)
+            self.spooled += 1
+        return True
+
+    def markUnhealthy(self, error):
+        with self.spool_lock:
+            if self.healthy:
+                print(f"Database unreachable, spooling stores: {error}")
+            self.healthy = False
+
+    def spoolCommand(self, machine_id, run, command, payload, error):
+        with self.spool_lock:
+            if self.healthy:
+                print(f"Database unreachable, spooling stores: {error}")
+            self.healthy = False
+            self.spool.append(machine_id, run, command, payload)
+            self.spooled += 1
+
+    def replayLoop(self):
+        # checks the database every spool retry interval and replays the spool
+        while True:
+            time.sleep(self.spool_retry)
+            if self.healthy:
+                continue
+            try:
+                if not self.setup_done:
+                    self.setupDatabase()
+                self.replay()
+            except TRANSIENT_ERRORS as e:
+                print(f"Database still unreachable, {self.spool.backlog()['commands']} stores spooled: {e}")
+            except SchemaError as e:
+                # stores stay spooled until the tables are migrated
+                print(f"Database reachable, but {e}")
+
+    def replay(self):
+        """
+        Writes the spooled commands to the database, spool replay batch
+        commands per transaction with one COPY per table. Marks the
+        database healthy once the spool is empty.
+        """
+        with psycopg.connect(self.dbaddr) as conn:
+            while True:
+                with self.spool_lock:
+                    items = self.spool.peek(self.spool_batch)
+                    if not items:
+                        self.healthy = True
+                        print("Database reachable, spool replayed")
+                        return
+                batch = CopyBatch(conn)
+                writes = [(self.execute, self.commands[command] + (machine_id, run, payload))
+                          for _, machine_id, run, command, payload in items]
+                with conn.cursor() as cur:
+                    outcomes = executeWrites(cur, batch, writes)
+                batch.flush()
+                conn.commit()
+                failed = [(item[0], error) for item, (_, error) in zip(items, outcomes) if error is not None]
+                for id, error in failed:
+                    print(f"Error replaying spooled store {id}: {error}")
+                self.spool.remove(items[-1][0], failed)
+                self.replayed += len(items) - len(failed)
+                print(f"Replayed {len(items) - len(failed)} spooled stores")
 
     def start(self):
         # Start the MQTT loop to listen for messages
         self.client.loop_forever()
 
 
-    def storeMeasurement(self, measurement):
+    def createRunSequence(self, conn):
+        """
+        Creates the sequence that run ids are allocated from, if it
+        does not exist yet, and makes sure it continues after the
+        highest run id already in the run table.
+        """
+        with conn.cursor() as cur:
+            # serialize the initialization of concurrent writers
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('run_id_seq'))")
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS run_id_seq")
+            cur.execute("SELECT setval('run_id_seq', m) \
+                        FROM (SELECT MAX(run_id) AS m FROM run) AS r \
+                        WHERE m >= (SELECT last_value FROM run_id_seq)")
+
+    def createExecutionReportTable(self, conn):
+        """
+        Creates the table for the execution reports of the runs, if it
+        does not exist yet. One column per entry of the report.
+        """
+        columns = ", ".join(key.replace(" ", "_") + " double precision" for key in REPORT_KEYS)
+        with conn.cursor() as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS execution_report \
+                        (run_id integer, machine_id integer, " + columns + ", \
+                        PRIMARY KEY (run_id, machine_id))")
+
+    def storeExecutionReport(self, batch, machine_id, run, report):
+        """
+        report is a dict as returned by telemetry.executionReport, an
+        existing report of the run is replaced.
+        """
+        columns = [key.replace(" ", "_") for key in REPORT_KEYS]
+        updates = ", ".join(c + " = EXCLUDED." + c for c in columns)
+        with batch.connection.cursor() as cur:
+            cur.execute("INSERT INTO execution_report (run_id, machine_id, " + ", ".join(columns) + ") \
+                        VALUES (%s, %s" + ", %s"*len(columns) + ") \
+                        ON CONFLICT (run_id, machine_id) DO UPDATE SET " + updates,
+                        [run, machine_id] + [report.get(key) for key in REPORT_KEYS])
+
+    def allocateRunIds(self, batch, machine_id, run, count):
+        """
+        Allocates count new run ids. The ids come from a database
+        sequence, so they are unique over all controllers and writers,
+        also across restarts.
+        """
+        return self.nextRunIds(batch.connection, int(count))
+
+    def nextRunIds(self, conn, count):
+        """
+        Returns count run ids from run_id_seq, and tops up the reserve of
+        run ids in the spool to run id reserve with the same query.
+        Sequence values are never handed out twice, also if the
+        transaction is rolled back.
+        """
+        missing = max(0, self.run_id_reserve - self.spool.reservedRunIds())
+        if count + missing == 0:
+            return []
+        with conn.cursor() as cur:
+            cur.execute("SELECT nextval('run_id_seq') FROM generate_series(1, %s)", (count + missing,))
+            run_ids = [row[0] for row in cur.fetchall()]
+        self.spool.addRunIds(run_ids[count:])
+        return run_ids[:count]
+
+    def reservedRunIds(self, payload):
+        """
+        hands out the run ids of an allocate-run-ids request from the
+        reserve, while the database is unreachable
+
+        Returns
+        -------
+        (run ids, None), or (None, error) if the reserve is empty
+        """
+        count = self.commands["allocate-run-ids"][0](payload)
+        run_ids = self.spool.takeRunIds(count)
+        if not run_ids:
+            return None, ConnectionError("database unreachable and no reserved run ids left")
+        print(f"Database unreachable, allocated reserved run ids {run_ids}")
+        return run_ids, None
+
+    def readRuns(self, batch, machine_id, request_id, request):
+        """
+        Reads runs as numpy arrays, see gantry_system/run_reader.py.
+
+        request is a dict with "runs", a list of run ids, optionally
+        "tables", a list with measurement and/or trajectory (default
+        both), and "machine_id" to read the runs of another machine.
+
+        Returns
+        -------
+        dict of table to dict of run id to dict with "t" and an array per
+        quantity
+        """
+        machine_id = request.get("machine_id", machine_id)
+        tables = request.get("tables", ["measurement", "trajectory"])
+        unknown = [table for table in tables if table not in QUANTITIES]
+        if unknown:
+            raise ValueError("unknown tables " + str(unknown))
+        return {table: self.reader.read(batch.connection, machine_id, request["runs"], table, self.wide)
+                for table in tables}
+
+    def storeMeasurement(self, batch, machine_id, run, measurement):
         """
         Note: name of functions is chose to match the names of the
         tables in the database.
@@ -105,24 +429,105 @@ class DatabaseMQTTWrapper:
         theta : angular position [rad]
         omega : angular velocity [rad/s]
         """
-        # returned t needs to be in datetime format for writing to database
-        t0_datetime = datetime.min
-        t = [t0_datetime + timedelta(seconds=ts) for ts in measurement[0]]
-
-        with self.dbconn.cursor() as cur:
-            # insert the data into measurement
-            with cur.copy("COPY measurement (ts, machine_id, run_id, quantity,\
-                           value) FROM stdin") as copy:
-                # write all quantities
-                quantities = ['position', 'velocity', 'acceleration', 'angular position',\
-                              'angular velocity']
+        # insert the data into measurement
+        self.copyQuantities(batch, machine_id, run, "measurement", MEASUREMENT_QUANTITIES, measurement)
+        # and its aggregates into run_summary
+        storeSummary(batch.connection, machine_id, run, "measurement",
+                     summarize(measurement, MEASUREMENT_QUANTITIES))
+
+    def createWideTables(self, conn):
+        """
+        Creates measurement_wide and trajectory_wide and, for a new
+        database, the narrow views on them.
+
+        Raises
+        ------
+        SchemaError if measurement or trajectory is not migrated yet, the
+        runs written to the wide tables would be missing from them
+        """
+        for table in QUANTITIES:
+            if schemaOf(conn, table) == "narrow":
+                raise SchemaError(f"table {table} is not migrated to the wide layout yet, "
+                                  "run python -m gantry_system.db_schema migrate or set database schema: narrow")
+        for table in QUANTITIES:
+            createWideTable(conn, table)
+            if schemaOf(conn, table) is None:
+                createNarrowView(conn, table)
+
+    def checkNarrowTables(self, conn):
+        """
+        Raises
+        ------
+        SchemaError if measurement or trajectory is migrated to the wide
+        layout, it can then not be written as a narrow table
+        """
+        for table in QUANTITIES:
+            if schemaOf(conn, table) == "wide":
+                raise SchemaError(f"table {table} is migrated to the wide layout, set database schema: wide")
+
+    def encoder(self, conn, table, columns = COPY_COLUMNS):
+        """
+        BinaryCopyEncoder for the columns of table, None if the column
+        types have no binary encoding
+        """
+        if table not in self.encoders:
+            try:
+                self.encoders[table] = BinaryCopyEncoder(columnTypes(conn, table, columns))
+            except ValueError as e:
+                print(f"No binary COPY for table {table}, writing rows: {e}")
+                self.encoders[table] = None
+        return self.encoders[table]
+
+    def copyQuantities(self, batch, machine_id, run, table, quantities, data):
+        """
+        Adds the quantities of a measurement or trajectory to the COPY of
+        table in batch. data is (t, quantity 1, quantity 2, ...), with t
+        in seconds relative to datetime.min.
+        """
+        # the timestamps in the database require at least a year, month
+        # and day, times are stored relative to datetime.min
+        ts = relativeTimestamps(data[0])
+        if self.wide:
+            self.copyWide(batch, machine_id, run, table, ts, data)
+            return
+        encoder = self.encoder(batch.connection, table)
+        if encoder is None:
+            self.writeQuantities(batch.connection, machine_id, run, table, quantities, ts, data)
+            return
+        for idx, qty in enumerate(quantities, 1):
+            block = encoder.encodeRows([ts, machine_id, int(run), qty, np.asarray(data[idx], dtype=float)])
+            batch.add(table, COPY_COLUMNS, block, len(ts))
+
+    def copyWide(self, batch, machine_id, run, table, ts, data):
+        """
+        Adds a measurement or trajectory to the COPY of table_wide in
+        batch, a row per timestamp.
+        """
+        target = table + "_wide"
+        columns = wideColumns(table)
+        values = [np.asarray(data[idx], dtype=float) for idx in range(1, len(columns) - 2)]
+        encoder = self.encoder(batch.connection, target, columns)
+        if encoder is None:
+            with batch.connection.cursor() as cur:
+                with cur.copy("COPY " + target + " (" + ", ".join(columns) + ") FROM stdin") as copy:
+                    for row in zip(ts.astype(datetime), *values):
+                        copy.write_row((row[0], machine_id, run) + row[1:])
+            return
+        batch.add(target, columns, encoder.encodeRows([ts, machine_id, int(run)] + values), len(ts))
+
+    def writeQuantities(self, conn, machine_id, run, table, quantities, ts, data):
+        """
+        row by row text COPY, for tables with column types that
+        BinaryCopyEncoder does not support
+        """
+        ts = ts.astype(datetime)
+        with conn.cursor() as cur:
+            with cur.copy("COPY " + table + " (" + ", ".join(COPY_COLUMNS) + ") FROM stdin") as copy:
                 for idx, qty in enumerate(quantities, 1):
-                    for (ts, data) in zip(t, measurement[idx]):
-                        copy.write_row((ts, self.id, self.run, qty, data))
-        # commit to database
-        self.dbconn.commit()
+                    for (t, value) in zip(ts, data[idx]):
+                        copy.write_row((t, machine_id, run, qty, value))
 
-    def storeTrajectory(self, traj):
+    def storeTrajectory(self, batch, machine_id, run, traj):
         """
         traj is assumed to be tuple as returned by generateTrajectory
         format: (ts, xs, dxs, ddxs, thetas, dthetas, ddthetas)
@@ -135,34 +540,16 @@ class DatabaseMQTTWrapper:
         ddthetas: angular acceleration of solution  [rad/s^2]
         us      : input force acting on cart [N]
         """
-        pass 
-        # replace with pub to
-        # command/bip-server/crane-1/req/db-write/store-trajectory
-        if self.dbconn:
-            # the datetime stamps in the database require at least a year,
-            # month and day, given that it's required, I might as well
-            # store the trace with an offset from now, then you know
-            # when it was generated.
-            curr_time = datetime.min
-            ts = [curr_time + timedelta(seconds=ts) for ts in traj[0]]
-            with self.dbconn.cursor() as cur:
-                # create the run
-                cur.execute("INSERT INTO \
-                            run (run_id, machine_id, starttime) \
-                            VALUES (%s, %s, %s)",
-                            (self.run, self.id, datetime.now()))
-                # insert the data into trajectory
-                with cur.copy("COPY trajectory (ts, machine_id, run_id, quantity,\
-                            value) FROM stdin") as copy:
-                    # write all quantities
-                    quantities = ['position', 'velocity', 'acceleration',\
-                                'angular position', 'angular velocity',\
-                                    'angular acceleration', 'force']
-                    for idx, qty in enumerate(quantities, 1):
-                        for (t, data) in zip(ts, traj[idx]):
-                            copy.write_row((t, self.id, self.run, qty, data))
-            # commit to database
-            self.dbconn.commit()
+        with batch.connection.cursor() as cur:
+            # create the run
+            cur.execute("INSERT INTO \
+                        run (run_id, machine_id, starttime) \
+                        VALUES (%s, %s, %s)",
+                        (run, machine_id, datetime.now()))
+        # insert the data into trajectory
+        self.copyQuantities(batch, machine_id, run, "trajectory", TRAJECTORY_QUANTITIES, traj)
+        storeSummary(batch.connection, machine_id, run, "trajectory",
+                     summarize(traj, TRAJECTORY_QUANTITIES))
 
 if __name__ == "__main__":
     wrapper = DatabaseMQTTWrapper(config_path="./crane_optimal_control/gantry_system/crane-properties.yaml")
@@ -5,6 +5,10 @@ import json
 import paho.mqtt.client as mqtt
 import pickle
 import os
+from threading import Thread, Lock
+
+# commands that move the gantry on their own, rejected while a plan runs
+MOTION_COMMANDS = ("hoist", "move", "simplemove")
 
 # Load the ID from the YAML configuration file
 def load_config(config_file="config.yaml"):
@@ -13,15 +17,23 @@ def load_config(config_file="config.yaml"):
     return config.get("machine id")
 
 class ControllerMQTTWrapper:
-    def __init__(self, config_path='config.yaml', mock = False):
+    def __init__(self, config_path='config.yaml', mock = False, clock = None):
+        """
+        clock is only used for the mock controller, it can be any of
+        the clocks in gantry_system.clock, e.g. VirtualClock() to
+        execute moves instantly. If None, the "clock mode" in the
+        configuration file is used.
+        """
         # Load the ID from the YAML configuration file
         self.id = load_config(config_path)
         if not self.id:
             raise ValueError("ID not found in configuration file.")
         if mock:
-            self.ctl = MockGantryController(config_path)
+            self.ctl = MockGantryController(config_path, clock=clock)
         else:
-            self.ctl = PhysicalGantryController(config_path)
+            self.ctl = PhysicalGantryController(config_path, clock=clock)
+        # only one plan is executed at a time
+        self.plan_lock = Lock()
 
         # MQTT Client setup
         self.client = mqtt.Client()
@@ -42,7 +54,34 @@ class ControllerMQTTWrapper:
         res_topic = topic_parts[-2]
         command_action = topic_parts[-1]
 
-        # Validate if the command is the correct one
+        if command_action in MOTION_COMMANDS:
+            # the gantry is not moved while a plan is running, the request
+            # is answered with an error instead
+            if not self.plan_lock.acquire(blocking=False):
+                response_topic = f"command/bip-server/{self.id}/res/{res_topic}/{command_action}"
+                client.publish(response_topic, json.dumps({"error": "a plan is running"}))
+                print(f"Rejected {command_action}, a plan is running")
+                return
+            try:
+                self.motionCommand(client, res_topic, command_action, msg)
+            finally:
+                self.plan_lock.release()
+
+        if command_action == "plan":
+            try:
+                payload = json.loads(msg.payload.decode('utf-8'))
+                steps = payload["steps"]
+                # executed in a separate thread, such that progress events
+                # are published while the plan is running.
+                Thread(target=self.executePlan, args=(client, res_topic, steps), daemon=True).start()
+            except Exception as e:
+                print(f"Error processing message: {e}")
+
+    def motionCommand(self, client, res_topic, command_action, msg):
+        """
+        Executes a hoist, move or simplemove request and publishes the
+        result. The caller holds plan_lock.
+        """
         if command_action == "hoist":
             try:
                 payload = json.loads(msg.payload.decode('utf-8'))
@@ -72,7 +111,8 @@ class ControllerMQTTWrapper:
                 # Respond with the final position to the response topic
                 response_topic = f"command/bip-server/{self.id}/res/{res_topic}/move"
                 payload = {
-                    "position" : final_position
+                    "position" : final_position,
+                    "report" : self.ctl.executionReport
                 }
                 serialized_trajectory = json.dumps(payload)
                 client.publish(response_topic, serialized_trajectory)
@@ -98,6 +138,40 @@ class ControllerMQTTWrapper:
             except Exception as e:
                 print(f"Error processing message: {e}")
 
+    def executePlan(self, client, res_topic, steps):
+        """
+        Executes a plan on the controller, publishes a progress event
+        after every step and the final result once the plan is done.
+        """
+        progress_topic = f"command/bip-server/{self.id}/res/{res_topic}/plan-progress"
+        response_topic = f"command/bip-server/{self.id}/res/{res_topic}/plan"
+
+        def progress(idx, step, result):
+            payload = {
+                "step": idx,
+                "action": step["action"],
+                "result": result
+            }
+            if step["action"] == "move":
+                payload["report"] = self.ctl.executionReport
+            client.publish(progress_topic, json.dumps(payload), qos=2)
+            print(f"Published progress to topic: {progress_topic}")
+
+        with self.plan_lock:
+            try:
+                results = self.ctl.executePlan(steps, progress=progress)
+                payload = {
+                    "results": results,
+                    "position": self.ctl.position
+                }
+            except Exception as e:
+                print(f"Error executing plan: {e}")
+                payload = {
+                    "error": str(e)
+                }
+        client.publish(response_topic, json.dumps(payload), qos=2)
+        print(f"Published plan result to topic: {response_topic}")
+
     def start(self):
         # Start the MQTT loop to listen for messages
         self.client.loop_forever()
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from gantry_system.angle_reader import AngleLineParser, BinaryAngleParser, ClockSync, crc8
+from gantry_system.sampling import RingBuffer
+
+
+def frame(us, a, theta, omega, crc = None):
+    payload = BinaryAngleParser.FRAME.pack(us, a, theta, omega)
+    return BinaryAngleParser.SYNC + payload + bytes([crc8(payload) if crc is None else crc])
+
+def lineParser(max_line = 64):
+    samples = RingBuffer(1000, ["t", "a", "theta", "omega"])
+    return AngleLineParser(samples, max_line), samples
+
+def binaryParser():
+    samples = RingBuffer(1000, ["t", "a", "theta", "omega"])
+    return BinaryAngleParser(samples), samples
+
+
+def test_lines_are_parsed():
+    parser, samples = lineParser()
+    assert parser.feed(b"0.5 -1.25 2.0\r\n.1 2. -.5\n", 3.0) == 2
+    rows = samples.snapshot()
+    assert rows["t"] == pytest.approx([3.0, 3.0])
+    assert rows["a"] == pytest.approx([0.5, 0.1])
+    assert rows["theta"] == pytest.approx([-1.25, 2.0])
+    assert rows["omega"] == pytest.approx([2.0, -0.5])
+    assert parser.lines == 2
+
+def test_line_split_across_reads():
+    parser, samples = lineParser()
+    assert parser.feed(b"0.5 1.2", 1.0) == 0
+    assert parser.feed(b"5 2.0\r", 1.1) == 0
+    assert parser.feed(b"\n0.1", 1.2) == 1
+    # timestamped when the line is complete
+    assert samples.snapshot()["t"] == pytest.approx([1.2])
+    assert samples.snapshot()["theta"] == pytest.approx([1.25])
+
+def test_garbled_lines_are_counted():
+    parser, samples = lineParser()
+    assert parser.feed(b"hello\n. . .\n-. 1.0 1.0\n1.0 2.0\n0.0 0.5 0.0\n", 1.0) == 1
+    assert parser.garbled == 4
+    assert samples.snapshot()["theta"] == pytest.approx([0.5])
+
+def test_too_long_line_is_dropped():
+    parser, samples = lineParser(max_line=16)
+    # the start of the line arrives without a newline and overflows
+    assert parser.feed(b"1.0 " + b"9"*40, 1.0) == 0
+    assert parser.feed(b"9.0 1.0\n0.0 3.0 0.0\n", 1.1) == 1
+    assert parser.dropped == 1
+    assert parser.garbled == 0
+    assert samples.snapshot()["theta"] == pytest.approx([3.0])
+    assert len(parser.partial) == 0
+
+def test_reset_forgets_partial_line():
+    parser, samples = lineParser()
+    parser.feed(b"1.0 2.", 1.0)
+    parser.reset()
+    assert parser.feed(b"0 3.0 0.0\n", 1.1) == 0
+    assert parser.garbled == 1
+
+
+def test_crc8_check_value():
+    # CRC-8/SMBUS check value
+    assert crc8(b"123456789") == 0xF4
+
+def test_binary_frames_are_parsed():
+    parser, samples = binaryParser()
+    assert parser.feed(frame(1000, 0.5, 1.25, -2.0), 1.0) == 1
+    assert parser.feed(frame(6000, 0.25, 1.5, -1.0), 1.005) == 1
+    rows = samples.snapshot()
+    assert rows["theta"] == pytest.approx([1.25, 1.5])
+    assert rows["omega"] == pytest.approx([-2.0, -1.0])
+    assert rows["t"][1] - rows["t"][0] == pytest.approx(0.005)
+    assert (parser.lines, parser.garbled, parser.dropped) == (2, 0, 0)
+
+def test_bad_checksum_is_rejected():
+    parser, samples = binaryParser()
+    good = frame(2000, 0.0, 2.0, 0.0)
+    bad = frame(1000, 0.0, 1.0, 0.0, crc=good[-1] ^ 0xFF)
+    assert parser.feed(bad + good, 1.0) == 1
+    assert samples.snapshot()["theta"] == pytest.approx([2.0])
+    assert parser.garbled == 1
+
+def test_resync_after_garbage():
+    parser, samples = binaryParser()
+    data = b"\x00\x13\xa5\x37garbage\xa5" + frame(1000, 0.0, 1.0, 0.0) + b"\x5a\xa5" + frame(2000, 0.0, 2.0, 0.0)
+    # fed in pieces that split the frames
+    added = sum(parser.feed(data[i:i + 7], 1.0) for i in range(0, len(data), 7))
+    assert added == 2
+    assert samples.snapshot()["theta"] == pytest.approx([1.0, 2.0])
+    assert parser.dropped == 14
+
+def test_device_time_wrap():
+    parser, samples = binaryParser()
+    last = 2**32 - 3000
+    data = b"".join(frame((last + i*5000) % 2**32, 0.0, float(i), 0.0) for i in range(4))
+    # the host receives every frame 1 ms after it is taken
+    for i in range(4):
+        chunk = data[i*BinaryAngleParser.FRAME_LENGTH:(i + 1)*BinaryAngleParser.FRAME_LENGTH]
+        parser.feed(chunk, 10.0 + i*0.005 + 0.001)
+    assert np.diff(samples.snapshot()["t"]) == pytest.approx([0.005]*3)
+
+def test_clock_sync_recovers_offset_and_drift():
+    rng = np.random.default_rng(1)
+    offset, drift = 123.456, 50e-6
+    sync = ClockSync(segment_length=1.0, window=30)
+    device = np.arange(0, 40, 0.005) + 7.0
+    host = device + offset + drift*(device - device[0])
+    # transport delay of at least 1 ms, mostly a few ms more
+    received = host + 0.001 + rng.exponential(0.003, len(device))
+    for d, r in zip(device, received):
+        sync.update(d, r)
+    estimate = np.array([sync.toHost(d) for d in device[-1000:]])
+    assert np.max(np.abs(estimate - host[-1000:] - 0.001)) < 0.0005
+    assert sync.drift == pytest.approx(drift, abs=5e-6)
+
+def test_clock_sync_single_observation():
+    sync = ClockSync()
+    sync.update(5.0, 105.002)
+    assert sync.toHost(5.5) == pytest.approx(105.502)
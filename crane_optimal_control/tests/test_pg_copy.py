@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from gantry_system.pg_copy import BinaryCopyEncoder, CopyBatch, PGCOPY_HEADER, PGCOPY_TRAILER, \
+    PG_EPOCH, relativeTimestamps
+from gantry_system.run_reader import decodeBinaryCopy, _seconds
+
+TYPES = ["timestamp without time zone", "integer", "integer", "character varying", "double precision"]
+FIELDS = [("ts", ">i8"), ("machine", ">i4"), ("run", ">i4"), ("quantity", "S8"), ("value", ">f8")]
+
+
+def encode(t, runs, values, quantity = "position"):
+    return BinaryCopyEncoder(TYPES).encodeRows([relativeTimestamps(t), 3, runs, quantity, values])
+
+
+def test_rows_round_trip():
+    t = np.array([0.0, 0.001, 1.5, 12345.678901])
+    values = np.array([1.0, -2.5, np.nan, 1e-300])
+    rows = decodeBinaryCopy(PGCOPY_HEADER + encode(t, np.array([7, 7, 8, 9]), values) + PGCOPY_TRAILER, FIELDS)
+    assert len(rows) == 4
+    assert _seconds(rows["ts"]) == pytest.approx(t, abs=1e-6)
+    assert list(rows["machine"]) == [3]*4
+    assert list(rows["run"]) == [7, 7, 8, 9]
+    assert list(rows["quantity"]) == [b"position"]*4
+    assert np.isnan(rows["value"][2])
+    assert rows["value"][[0, 1, 3]] == pytest.approx(values[[0, 1, 3]])
+    # field lengths as PostgreSQL expects them
+    assert list(rows["l_ts"]) == [8]*4
+    assert list(rows["l_machine"]) == [4]*4
+    assert list(rows["l_quantity"]) == [8]*4
+    assert list(rows["l_value"]) == [8]*4
+
+def test_timestamps_relative_to_postgres_epoch():
+    rows = decodeBinaryCopy(PGCOPY_HEADER + encode([0.0], 1, [0.0]) + PGCOPY_TRAILER, FIELDS)
+    # datetime.min is before the PostgreSQL epoch
+    expected = (np.datetime64("0001-01-01T00:00:00", "us") - PG_EPOCH).astype(np.int64)
+    assert rows["ts"][0] == expected
+
+def test_blocks_of_a_batch_form_one_stream():
+    streams = []
+
+    class Copy:
+        def __init__(self):
+            self.data = b""
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            streams.append(self.data)
+        def write(self, data):
+            self.data += data
+
+    class Cursor:
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+        def copy(self, statement):
+            assert statement.startswith("COPY measurement (ts, machine_id, run_id, quantity, value) FROM STDIN")
+            return Copy()
+
+    class Connection:
+        def cursor(self):
+            return Cursor()
+
+    columns = ["ts", "machine_id", "run_id", "quantity", "value"]
+    batch = CopyBatch(Connection())
+    batch.add("measurement", columns, encode([0.0, 0.1], 1, [1.0, 2.0]), 2)
+    batch.add("measurement", columns, encode([0.0], 2, [3.0], "velocity"), 1)
+    assert batch.rows == 3
+    batch.flush()
+    assert len(streams) == 1
+    rows = decodeBinaryCopy(streams[0], FIELDS)
+    assert list(rows["value"]) == [1.0, 2.0, 3.0]
+    assert list(rows["run"]) == [1, 1, 2]
+    assert list(rows["quantity"]) == [b"position", b"position", b"velocity"]
+    assert batch.rows == 0 and not batch.blocks
+
+def test_unsupported_columns_are_rejected():
+    with pytest.raises(ValueError):
+        BinaryCopyEncoder(["integer", "jsonb"])
+    with pytest.raises(TypeError):
+        BinaryCopyEncoder(["text"]).encodeRows([np.array(["a", "b"])])
+    with pytest.raises(TypeError):
+        BinaryCopyEncoder(["timestamp without time zone"]).encodeRows([np.array([1.0])])
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from gantry_system.pg_copy import BinaryCopyEncoder, PGCOPY_HEADER, PGCOPY_TRAILER, relativeTimestamps
+from gantry_system.run_reader import decodeBinaryCopy, readRuns
+from gantry_system.db_schema import MEASUREMENT_QUANTITIES
+
+
+class Connection:
+    # answers every COPY ... TO STDOUT with the given stream, in chunks
+    def __init__(self, data):
+        self.data = data
+        self.queries = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def copy(self, query, params):
+        self.queries.append(query)
+        return self
+
+    def __iter__(self):
+        return iter([self.data[i:i + 7] for i in range(0, len(self.data), 7)])
+
+
+def stream(types, *blocks):
+    encoder = BinaryCopyEncoder(types)
+    return PGCOPY_HEADER + b"".join(encoder.encodeRows(block) for block in blocks) + PGCOPY_TRAILER
+
+
+NARROW = ["integer", "smallint", "timestamp without time zone", "double precision"]
+
+
+def test_decode_rejects_other_streams():
+    with pytest.raises(ValueError):
+        decodeBinaryCopy(b"run_id,ts\n1,0\n", [("run", ">i4")])
+
+def test_decode_rejects_other_column_counts():
+    data = stream(["integer", "double precision"], [np.array([1, 2]), np.array([0.5, 1.5])])
+    with pytest.raises(ValueError):
+        decodeBinaryCopy(data, [("run", ">i4"), ("value", ">f8"), ("value2", ">f8")])
+
+def test_decode_empty_stream():
+    rows = decodeBinaryCopy(PGCOPY_HEADER + PGCOPY_TRAILER, [("run", ">i4"), ("value", ">f8")])
+    assert len(rows) == 0
+
+def test_narrow_rows_are_pivoted_per_run_and_time():
+    # one row per (run, ts, quantity), sorted by run and time, position is
+    # quantity 1 and velocity quantity 2
+    conn = Connection(stream(NARROW,
+                             [5, 1, relativeTimestamps([0.0]), np.array([1.0])],
+                             [5, 2, relativeTimestamps([0.0]), np.array([10.0])],
+                             [5, 1, relativeTimestamps([0.1]), np.array([2.0])],
+                             [6, 1, relativeTimestamps([0.5]), np.array([3.0])]))
+
+    runs = readRuns(conn, 3, [5, 6], wide=False)
+
+    assert "::int4" in conn.queries[0] and "::timestamp" in conn.queries[0] and "::float8" in conn.queries[0]
+    assert sorted(runs) == [5, 6]
+    assert runs[5]["t"] == pytest.approx([0.0, 0.1])
+    assert runs[5]["position"] == pytest.approx([1.0, 2.0])
+    assert runs[5]["velocity"][0] == 10.0
+    assert np.isnan(runs[5]["velocity"][1])
+    assert np.all(np.isnan(runs[5]["angular velocity"]))
+    assert runs[6]["t"] == pytest.approx([0.5])
+    assert runs[6]["position"] == pytest.approx([3.0])
+    assert set(runs[6]) == {"t"} | set(MEASUREMENT_QUANTITIES)
+
+def test_wide_rows_are_split_per_run():
+    types = ["integer", "timestamp without time zone"] + ["double precision"]*len(MEASUREMENT_QUANTITIES)
+    values = [np.array([1.0, np.nan, 2.0])] + [np.zeros(3)]*(len(MEASUREMENT_QUANTITIES) - 1)
+    conn = Connection(stream(types, [np.array([5, 5, 6]), relativeTimestamps([0.0, 0.1, 0.2])] + values))
+
+    runs = readRuns(conn, 3, [5, 6], wide=True)
+
+    assert "coalesce(angular_position, 'NaN')::float8" in conn.queries[0]
+    assert runs[5]["t"] == pytest.approx([0.0, 0.1])
+    assert runs[5]["position"][0] == 1.0
+    assert np.isnan(runs[5]["position"][1])
+    assert runs[6]["position"] == pytest.approx([2.0])
+
+def test_no_samples():
+    assert readRuns(Connection(PGCOPY_HEADER + PGCOPY_TRAILER), 3, [5], wide=False) == {}
@@ -0,0 +1,105 @@
+import pickle
+from threading import Lock
+import psycopg
+import pytest
+import mqtt_database_writer
+from mqtt_database_writer import DatabaseMQTTWrapper
+from gantry_system.spool import Spool
+from .test_write_queue import Connections
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = Spool(str(tmp_path / "spool.sqlite"))
+    yield spool
+    spool.close()
+
+
+def test_commands_are_kept_in_order(spool):
+    for run in range(5):
+        spool.append(1, str(run), "store-measurement", b"payload " + str(run).encode())
+    items = spool.peek(3)
+    assert [item[2] for item in items] == ["0", "1", "2"]
+    assert items[0][1:] == (1, "0", "store-measurement", b"payload 0")
+    spool.remove(items[-1][0], [(items[1][0], ValueError("broken"))])
+    assert [item[2] for item in spool.peek(10)] == ["3", "4"]
+    backlog = spool.backlog()
+    assert (backlog["commands"], backlog["bytes"], backlog["failed"]) == (2, 18, 1)
+    assert backlog["oldest"] >= 0
+
+def test_spool_survives_a_restart(tmp_path):
+    spool = Spool(str(tmp_path / "spool.sqlite"))
+    spool.append(2, "7", "store-trajectory", b"x")
+    spool.addRunIds([11, 12])
+    spool.close()
+    spool = Spool(str(tmp_path / "spool.sqlite"))
+    assert spool.peek(10)[0][1:] == (2, "7", "store-trajectory", b"x")
+    assert spool.reservedRunIds() == 2
+    spool.close()
+
+def test_run_id_reserve(spool):
+    spool.addRunIds([5, 3, 4])
+    spool.addRunIds([4])
+    assert spool.reservedRunIds() == 3
+    assert spool.takeRunIds(2) == [3, 4]
+    assert spool.takeRunIds(2) == [5]
+    assert spool.takeRunIds(2) == []
+
+
+def writer(spool, batch = 2):
+    # a database writer without MQTT, with stores that record what they write
+    writer = DatabaseMQTTWrapper.__new__(DatabaseMQTTWrapper)
+    writer.dbaddr = "dsn"
+    writer.spool = spool
+    writer.spool_lock = Lock()
+    writer.spool_batch = batch
+    writer.replayed = 0
+    writer.healthy = False
+    writer.stored = []
+
+    def store(batch, machine_id, run, data):
+        if data == "broken":
+            raise ValueError("broken payload")
+        batch.connection.cursor().execute("INSERT " + run)
+        writer.stored.append((machine_id, run, data))
+    writer.commands = {"store-measurement": (pickle.loads, store), "store-trajectory": (pickle.loads, store)}
+    return writer
+
+def test_replay_writes_the_spool_in_order(spool, monkeypatch):
+    connections = Connections()
+    monkeypatch.setattr(mqtt_database_writer.psycopg, "connect", connections.connect)
+    for run, data in enumerate(["a", "b", "broken", "d", "e"]):
+        spool.append(1, str(run), "store-measurement", pickle.dumps(data))
+    replaying = writer(spool)
+    replaying.replay()
+    assert replaying.stored == [(1, "0", "a"), (1, "1", "b"), (1, "3", "d"), (1, "4", "e")]
+    assert replaying.healthy and replaying.replayed == 4
+    # spool replay batch stores per transaction, the broken one rolled back
+    conn, = connections
+    assert conn.commits == 3
+    assert conn.statements.count("ROLLBACK TO SAVEPOINT write") == 1
+    backlog = spool.backlog()
+    assert (backlog["commands"], backlog["failed"]) == (0, 1)
+
+def test_replay_stops_when_the_database_goes_down(spool, monkeypatch):
+    connections = Connections()
+    monkeypatch.setattr(mqtt_database_writer.psycopg, "connect", connections.connect)
+    for run in range(3):
+        spool.append(1, str(run), "store-trajectory", pickle.dumps(str(run)))
+    replaying = writer(spool, batch=1)
+    writes = replaying.commands["store-trajectory"][1]
+
+    def down(batch, machine_id, run, data):
+        if run == "1":
+            raise psycopg.OperationalError("server closed the connection")
+        writes(batch, machine_id, run, data)
+    replaying.commands["store-trajectory"] = (pickle.loads, down)
+    with pytest.raises(psycopg.OperationalError):
+        replaying.replay()
+    # the store that was not written stays spooled, for the next replay
+    assert not replaying.healthy
+    assert [item[2] for item in spool.peek(10)] == ["1", "2"]
+    replaying.commands["store-trajectory"] = (pickle.loads, writes)
+    replaying.replay()
+    assert [run for _, run, _ in replaying.stored] == ["0", "1", "2"]
+    assert replaying.healthy
@@ -0,0 +1,167 @@
+from queue import Full
+from threading import Event
+import psycopg
+import pytest
+from gantry_system import write_queue
+from gantry_system.write_queue import WriteQueue
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params = None):
+        self.conn.statements.append(sql)
+
+
+class FakeConnection:
+    """
+    records the statements, commits and rollbacks, fail_commits commits
+    raise before one succeeds
+    """
+
+    def __init__(self, fail_commits = 0):
+        self.closed = False
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail_commits = fail_commits
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self.fail_commits:
+            self.fail_commits -= 1
+            raise ValueError("commit failed")
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class Connections(list):
+    """
+    the connections opened by the writer threads, the next one fails
+    fail_commits commits
+    """
+
+    fail_commits = 0
+
+    def connect(self, dsn):
+        self.append(FakeConnection(self.fail_commits))
+        self.fail_commits = 0
+        return self[-1]
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = Connections()
+    monkeypatch.setattr(write_queue.psycopg, "connect", opened.connect)
+    return opened
+
+def run(writes, *submissions):
+    # submits (fn, args) and returns the (result, error) per write once done
+    outcomes = {}
+    for i, (fn, args) in enumerate(submissions):
+        writes.submit(fn, *args, on_done=lambda result, error, i=i: outcomes.__setitem__(i, (result, error)))
+    writes.stop()
+    return [outcomes[i] for i in range(len(submissions))]
+
+
+def test_writes_are_committed(connections):
+    writes = WriteQueue("dsn", workers=1)
+    outcomes = run(writes, (lambda batch, x: x*2, (1,)), (lambda batch, x: x*2, (5,)))
+    assert outcomes == [(2, None), (10, None)]
+    assert connections[0].commits == 2
+    metrics = writes.metrics()
+    assert (metrics["completed"], metrics["failed"], metrics["commits"]) == (2, 0, 2)
+
+def test_errors_are_reported_without_retry(connections):
+    calls = []
+
+    def fail(batch):
+        calls.append(1)
+        raise ValueError("bad data")
+    writes = WriteQueue("dsn", workers=1, backoff=0)
+    (result, error), = run(writes, (fail, ()))
+    assert isinstance(error, ValueError)
+    assert len(calls) == 1
+    assert connections[0].rollbacks == 1
+    assert writes.metrics()["failed"] == 1
+
+def test_transient_errors_are_retried_on_a_new_connection(connections):
+    attempts = []
+
+    def flaky(batch):
+        attempts.append(batch.connection)
+        if len(attempts) < 3:
+            raise psycopg.OperationalError("server closed the connection")
+        return "stored"
+    writes = WriteQueue("dsn", workers=1, retries=5, backoff=0)
+    assert run(writes, (flaky, ())) == [("stored", None)]
+    assert len(connections) == 3 and connections[0].closed
+    assert attempts[-1] is connections[-1]
+    metrics = writes.metrics()
+    assert (metrics["retries"], metrics["reconnects"], metrics["completed"]) == (2, 2, 1)
+
+def test_retries_give_up(connections):
+    def down(batch):
+        raise psycopg.OperationalError("connection refused")
+    writes = WriteQueue("dsn", workers=1, retries=2, backoff=0)
+    (result, error), = run(writes, (down, ()))
+    assert isinstance(error, psycopg.OperationalError)
+    assert writes.metrics()["retries"] == 2
+
+def test_full_queue_rejects(connections):
+    started, release = Event(), Event()
+
+    def block(batch):
+        started.set()
+        release.wait(5)
+    writes = WriteQueue("dsn", workers=1, maxsize=1)
+    writes.submit(block)
+    started.wait(5)
+    writes.submit(block)
+    with pytest.raises(Full):
+        writes.submit(block)
+    release.set()
+    writes.stop()
+    metrics = writes.metrics()
+    assert (metrics["rejected"], metrics["completed"], metrics["max depth"]) == (1, 2, 1)
+
+def test_group_commit_isolates_failing_writes(connections):
+    def fail(batch):
+        raise ValueError("bad data")
+    writes = WriteQueue("dsn", workers=1, group_window=0.5)
+    outcomes = run(writes, (lambda batch: 1, ()), (fail, ()), (lambda batch: 3, ()))
+    assert outcomes[0] == (1, None) and outcomes[2] == (3, None)
+    assert isinstance(outcomes[1][1], ValueError)
+    # one transaction, the failing write rolled back to its savepoint
+    assert connections[0].commits == 1
+    assert connections[0].statements.count("SAVEPOINT write") == 3
+    assert connections[0].statements.count("ROLLBACK TO SAVEPOINT write") == 1
+    assert writes.metrics()["commits"] == 1
+
+def test_group_is_written_one_by_one_if_its_commit_fails(connections):
+    connections.fail_commits = 1
+    writes = WriteQueue("dsn", workers=1, group_window=0.5)
+    outcomes = run(writes, (lambda batch: 1, ()), (lambda batch: 2, ()))
+    assert outcomes == [(1, None), (2, None)]
+    assert connections[0].commits == 2
+    assert writes.metrics()["commits"] == 2